@@ -1,15 +1,30 @@
+import io
+import os
 import json
+import time
 import uuid
+import bisect
 import acidfs
 import churro
+import asyncio
+import hashlib
+import importlib
 import logging
 import subprocess
 import transaction
+import threading
+import weakref
+import collections
 import collections.abc
+import concurrent.futures
+
+from churrodb import git
 
 
 log = logging.getLogger(__name__)
 
+_missing = object()
+
 
 def unique_branch_name(prefix=""):
     if prefix:
@@ -18,8 +33,11 @@ def unique_branch_name(prefix=""):
 
 
 class JsonCodec(churro.JsonCodec):
+    dump_options = {"indent": 4, "sort_keys": True}
+
     def encode(self, obj, stream):
-        json.dump(obj, stream, default=self.encode_hook, indent=4, sort_keys=True)
+        # json.dumps encodes in one go, json.dump writes piecemeal
+        stream.write(json.dumps(obj, default=self.encode_hook, **self.dump_options))
 
 # monkey-patch churro's codec object
 # so that object get serialized in a reproducable manner
@@ -28,18 +46,71 @@ class JsonCodec(churro.JsonCodec):
 churro.codec = JsonCodec()
 
 
+class CompactJsonCodec(JsonCodec):
+    """
+    canonical JSON without whitespace. keys are still sorted, so oids stay
+    reproducible, but blobs are smaller and quicker to encode. decoding is
+    the same as for :class:`JsonCodec`, so indented data remains readable.
+    """
+    dump_options = {"separators": (",", ":"), "sort_keys": True}
+
+
+def flush_stats(fs):
+    """
+    :return: counters of what was written to the AcidFS ``fs`` by the
+    last flush: ``objects``, ``folders``, ``removed`` and ``skipped``
+    (loaded children which were clean)
+    """
+    stats = getattr(fs, "churrodb_flush_stats", None)
+    if stats is None:
+        stats = fs.churrodb_flush_stats = collections.Counter()
+    return stats
+
+
+def _flush(self):
+    self.fs.churrodb_flush_stats = collections.Counter()
+    root = self.root
+    if root is None or not root._dirty:
+        # Nothing to do
+        return
+
+    root._save(self.fs)
+    log.debug("flushed %s", dict(self.fs.churrodb_flush_stats))
+
+# monkey-patch churro's session flush, so that the write counters
+# start over with every flush
+churro._Session.flush = _flush
+
+
+def codec_for(fs):
+    """:return: the codec objects are written with to the AcidFS ``fs``"""
+    return getattr(fs, "churrodb_codec", churro.codec)
+
+
 def _save(self, fs):
     self._fs = fs
     path = churro.resource_path(self)
     if not fs.exists(path):
         fs.mkdir(path)
+    stats = flush_stats(fs)
+    _restore_dirty(self)
+    track_change = getattr(self, "track_change", None)
     for name, (type, obj) in self._contents.items():
         if obj is None:
             continue
+        if obj is not churro._removed and not obj._dirty and obj._fs is fs:
+            # churro marks all ancestors of a changed object dirty, so
+            # clean children have nothing to write below them. children
+            # read from another fs (see ChurroDb.switch) are written anyway
+            stats["skipped"] += 1
+            continue
+        if track_change is not None:
+            track_change(name)
         if type == 'folder':
             if obj is churro._removed:
                 try:
                     fs.rmtree(churro.resource_path(self, name))
+                    stats["removed"] += 1
                 except FileNotFoundError as why:
                     log.warn(str(why) + " (probably a subsequent call to flush)")
             else:
@@ -49,23 +120,933 @@ def _save(self, fs):
             if obj is churro._removed:
                 try:
                     fs.rm(fspath)
+                    stats["removed"] += 1
                 except FileNotFoundError as why:
                     log.warn(str(why) + " (probably a subsequent call to flush)")
             else:
-                churro.codec.encode(obj, fs.open(fspath, churro.ENCODE_MODE))
+                codec_for(fs).encode(obj, fs.open(fspath, churro.ENCODE_MODE))
+                stats["objects"] += 1
                 obj._dirty = False
                 obj._fs = fs
     fspath = '%s/%s' % (path, churro.CHURRO_FOLDER)
-    churro.codec.encode(self, fs.open(fspath,churro. ENCODE_MODE))
+    codec_for(fs).encode(self, fs.open(fspath,churro. ENCODE_MODE))
+    stats["folders"] += 1
     self._dirty = False
 
+def _restore_dirty(folder):
+    """puts evicted children which were changed since back into the folder"""
+    evicted = folder.__dict__.get("_evicted")
+    if not evicted:
+        return
+    contents = folder._contents
+    for name, obj in list(evicted.items()):
+        objref = contents.get(name)
+        if obj._dirty and objref is not None and objref[1] is None:
+            contents[name] = (objref[0], obj)
+            del evicted[name]
+
 # monkey-patch _save method of PersistentFolder. original version
 # contains a bug. multiple calls to flush() result in multiple calls
 # to fs.rm() which causes acidfs to raise FileNotFoundError on subsequent
-# flushes.
+# flushes. it also rewrote every loaded child on each flush, this one
+# only descends into dirty subtrees.
 churro.PersistentFolder._save = _save
 
 
+def _get(self, name, default=None):
+    objref = self._contents.get(name)
+    if not objref or objref[1] is churro._removed:
+        return default
+    type, obj = objref
+    if obj is None:
+        obj = self._load(name, type)
+    else:
+        _touch(self, name)
+    return obj
+
+
+def _touch(folder, name):
+    child_cache = getattr(folder._fs, "churrodb_child_cache", None)
+    if child_cache is not None:
+        child_cache.touch(folder, name)
+
+
+def _contains(self, name):
+    objref = self._contents.get(name)
+    return bool(objref) and objref[1] is not churro._removed
+
+# monkey-patch get and __contains__ of PersistentFolder. original versions
+# build a filtered copy of the whole folder contents on every call, which
+# makes a single lookup O(n) in the size of the folder.
+churro.PersistentFolder.get = _get
+churro.PersistentFolder.__contains__ = _contains
+
+
+def _load(self, name, type, cache=True):
+    evicted = self.__dict__.get("_evicted")
+    obj = evicted.get(name) if evicted is not None else None
+    if obj is not None:
+        if cache:
+            del evicted[name]
+        # evicted, but still referenced elsewhere. handing out a second
+        # copy would lose the changes made to this one
+        size = None
+    else:
+        if type == 'folder':
+            fspath = churro.resource_path(self, name, churro.CHURRO_FOLDER)
+        else:
+            fspath = churro.resource_path(self, name) + churro.CHURRO_EXT
+        data = self._fs.open(fspath, "rb").read()
+        size = len(data)
+        obj = churro.codec.decode(io.StringIO(data.decode("utf-8")))
+        obj.__parent__ = self
+        obj.__name__ = name
+        obj._fs = self._fs
+        obj._dirty = False
+    if cache:
+        self._contents[name] = (type, obj)
+        child_cache = getattr(self._fs, "churrodb_child_cache", None)
+        if child_cache is not None and type == 'object':
+            child_cache.loaded(self, name, obj, size)
+    return obj
+
+# monkey-patch _load of PersistentFolder, so that children are handed
+# to the ChildCache of the db, if any, which may evict them again
+churro.PersistentFolder._load = _load
+
+
+def _items(self):
+    contents = self._filtered_contents
+    names = list(contents)
+    for start in range(0, len(names), git.BATCH_SIZE):
+        chunk = names[start:start + git.BATCH_SIZE]
+        _prefetch(self, [name for name in chunk if contents[name][1] is None])
+        for name in chunk:
+            type, obj = contents[name]
+            if obj is None:
+                obj = self._load(name, type)
+            else:
+                _touch(self, name)
+            yield name, obj
+
+
+def _prefetch(folder, names):
+    fs = folder._fs
+    if fs is None or not names:
+        return
+    oids = []
+    for name in names:
+        type, obj = folder._contents[name]
+        if type == 'folder':
+            path = churro.resource_path(folder, name, churro.CHURRO_FOLDER)
+        else:
+            path = churro.resource_path(folder, name) + churro.CHURRO_EXT
+        oids.append(fs.hash(path))
+    git.repository(fs.db).prefetch(oids)
+
+# monkey-patch items of PersistentFolder so that the children are read
+# in pipelined batches instead of one git process per child
+churro.PersistentFolder.items = _items
+
+
+def _blob_open(self):
+    oid, type, data = git.repository(self.db).read(self.oid)
+    return io.BytesIO(data)
+
+
+@classmethod
+def _tree_read(cls, db, oid, path_encoding):
+    node = cls(db, path_encoding)
+    node.oid = oid
+    contents = node.contents
+    for mode, type, entry_oid, name in git.repository(db).tree(oid):
+        contents[name.decode(path_encoding)] = (type, entry_oid, None)
+    return node
+
+# monkey-patch acidfs' blob and tree readers. originals spawn a
+# git cat-file or git ls-tree process for every single object, these
+# go through the long-lived processes of churrodb.git instead
+acidfs._Blob.open = _blob_open
+acidfs._TreeNode.read = _tree_read
+
+
+_commit_locks = collections.defaultdict(threading.Lock)
+_commit_locks_lock = threading.Lock()
+_acidfs_acquire_lock = acidfs._Session.acquire_lock
+_acidfs_release_lock = acidfs._Session.release_lock
+
+
+def _acquire_lock(self):
+    with _commit_locks_lock:
+        lock = _commit_locks[self.lock_file]
+    lock.acquire()
+    try:
+        _acidfs_acquire_lock(self)
+    except BaseException:
+        lock.release()
+        raise
+
+
+def _release_lock(self):
+    held = self.lockfd is not None
+    _acidfs_release_lock(self)
+    if held:
+        with _commit_locks_lock:
+            lock = _commit_locks[self.lock_file]
+        lock.release()
+
+# monkey-patch acidfs' commit lock. the original takes an fcntl lock,
+# which is held per process: it doesn't keep threads of one process from
+# committing at the same time, and one thread releasing it releases it
+# for all others. threads wait for an in-process lock first
+acidfs._Session.acquire_lock = _acquire_lock
+acidfs._Session.release_lock = _release_lock
+
+
+# how often a merging save merges again when HEAD moved before it got the
+# commit lock, and the first pause before it does (doubled every time)
+MERGE_RETRIES = 5
+MERGE_BACKOFF = 0.005
+
+
+def _merge_json(base, ours, theirs, merged=None):
+    """
+    three-way merge of decoded JSON values, dicts are merged key by key.
+    values which are the oids of two merged documents (``merged``, by the
+    oids of ours and theirs) become the merged oid, e.g. in hash indexes,
+    and so do such oids used as keys, e.g. in inverse hash indexes.
+    ``_missing`` stands for absent values, raises acidfs.ConflictError
+    """
+    if merged is None:
+        merged = {}
+    if ours == theirs or theirs == base:
+        return ours
+    if ours == base:
+        return theirs
+    if isinstance(ours, str) and (ours, theirs) in merged:
+        return merged[ours, theirs]
+    if (isinstance(ours, dict) and isinstance(theirs, dict)
+            and (base is _missing or isinstance(base, dict))):
+        if base is _missing:
+            base = {}
+        result = {}
+        for key in set(base) | set(ours) | set(theirs):
+            value = _merge_json(
+                base.get(key, _missing), ours.get(key, _missing), theirs.get(key, _missing),
+                merged)
+            if value is not _missing:
+                result[key] = value
+        for (ours_oid, theirs_oid), oid in merged.items():
+            if ours_oid in result and theirs_oid in result and ours_oid not in base\
+                    and theirs_oid not in base and result[ours_oid] == result[theirs_oid]:
+                del result[theirs_oid]
+                result[oid] = result.pop(ours_oid)
+        return result
+    raise acidfs.ConflictError()
+
+
+def _churro_class(doc):
+    """:return: the class of the decoded JSON ``doc``, None if there is none"""
+    if not isinstance(doc, dict) or "__churro_class__" not in doc:
+        return None
+    module, _, name = doc["__churro_class__"].rpartition(".")
+    try:
+        return getattr(importlib.import_module(module), name)
+    except (ImportError, AttributeError, ValueError):
+        return None
+
+
+def _merge_dropped(docs, merged):
+    """
+    drops the properties named by ``merge_dropped`` of the documents'
+    class (see GitObjectHashIndexMixin) from all of ``docs`` wherever
+    they conflict
+    """
+    found = [doc for doc in docs if _churro_class(doc) is not None]
+    if not found:
+        return
+    cls = _churro_class(found[0])
+    data = [doc.get("__churro_data__", {}) if isinstance(doc, dict) else {} for doc in docs]
+    for key in getattr(cls, "merge_dropped", ()):
+        try:
+            _merge_json(*[d.get(key, _missing) for d in data], merged=merged)
+        except acidfs.ConflictError:
+            for d in data:
+                d.pop(key, None)
+
+
+def _strings(value):
+    """yields the strings of the decoded JSON ``value``, keys included"""
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield key
+            yield from _strings(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _strings(item)
+
+
+def _read_json(repo, oid):
+    return json.loads(repo.read(oid)[2].decode("utf-8"))
+
+
+def _write_json(session, value):
+    """:return: the oid of the blob of the JSON ``value``, as the session's codec writes it"""
+    codec = getattr(session, "churrodb_codec", churro.codec)
+    options = getattr(codec, "dump_options", JsonCodec.dump_options)
+    data = json.dumps(value, **options).encode("utf-8")
+    return subprocess.check_output(
+        ["git", "hash-object", "-w", "--stdin"], input=data, cwd=session.db).strip().decode("ascii")
+
+
+def _merge_document(session, repo, base, ours, theirs, waiting=()):
+    """
+    :return: the oid of the merged blob, None if ours or theirs refer to
+    one of the oids ``waiting`` to be merged
+    """
+    docs = [_missing if oid is None else _read_json(repo, oid) for oid in (base, ours, theirs)]
+    if waiting and any(value in waiting for doc in docs[1:] for value in _strings(doc)):
+        return None
+    merged = session.churrodb_merged
+    _merge_dropped(docs, merged)
+    oid = merged[ours, theirs] = _write_json(session, _merge_json(*docs, merged=merged))
+    return oid
+
+
+def _index_class(repo, oid):
+    """
+    :return: the class of the blob ``oid``, or of the folder of the tree
+    ``oid``, if it is an index which re-derives its entries when merged
+    """
+    found = repo.read(oid)
+    if found[1] == "tree":
+        oid = dict(
+            (name, entry_oid) for mode, type, entry_oid, name in repo.tree(oid)
+        ).get(churro.CHURRO_FOLDER.encode("ascii"))
+        if oid is None:
+            return None
+        found = repo.read(oid)
+    cls = _churro_class(json.loads(found[2].decode("utf-8")))
+    if cls is not None and hasattr(cls, "idx_merge"):
+        return cls
+    return None
+
+
+def _subtree(repo, tree, path, path_encoding):
+    """:return: the oid of the tree at ``path`` (a list of names) in ``tree``, None if missing"""
+    for name in path:
+        entries = dict(
+            (entry_name.decode(path_encoding), (type, oid))
+            for mode, type, oid, entry_name in repo.tree(tree))
+        entry = entries.get(name)
+        if entry is None or entry[0] != b"tree":
+            return None
+        tree = entry[1]
+    return tree
+
+
+def _merge_index(session, repo, ours_root, path, base, ours, theirs):
+    """
+    merges an index changed on both sides: its entries are those of ours,
+    updated (see ``idx_merge`` of the index classes) for the items of its
+    collection which the merge changed. everything else merges as in any
+    other document. indexes are members of the :class:`IndexesFolder` in
+    their collection. :return: the oid of the merged blob, None for
+    indexes stored as folders, which are merged in place
+    """
+    collection, held = path[:-2], path[-2]
+    previous = _subtree(repo, ours_root, collection, session.path_encoding)
+    tree = session.find(collection).save()
+    tree = tree.decode("ascii") if isinstance(tree, bytes) else tree
+    old = _tree_items(repo, previous, session.path_encoding) if previous else {}
+    new = _tree_items(repo, tree, session.path_encoding)
+    changes = [
+        (name, old.get(name), new.get(name)) for name in sorted(set(old) | set(new))
+        if name != held and old.get(name) != new.get(name)]
+    # the oids of ours which the merge replaced were never committed
+    dropped = set(oid for oid, theirs_oid in session.churrodb_merged)
+
+    codec = getattr(session, "churrodb_codec", churro.codec)
+
+    def load(oid):
+        found = repo.read(oid)
+        if found[1] != "blob":
+            return None
+        return codec.decode(io.StringIO(found[2].decode("utf-8")))
+
+    if repo.read(ours)[1] == "tree":
+        _merge_index_folder(session, repo, path, base, ours, theirs, load, changes, tree, dropped)
+        return None
+
+    docs = [_missing if oid is None else _read_json(repo, oid) for oid in (base, ours, theirs)]
+    merged = session.churrodb_merged
+    _merge_dropped(docs, merged)
+    cls = _churro_class(docs[1])
+    data = [doc.get("__churro_data__", {}) if isinstance(doc, dict) else {} for doc in docs]
+    result = {}
+    for key in set(data[0]) | set(data[1]) | set(data[2]):
+        if key in cls.merge_derived:
+            value = data[1].get(key, _missing)
+        else:
+            value = _merge_json(*[d.get(key, _missing) for d in data], merged=merged)
+        if value is not _missing:
+            result[key] = value
+
+    index = codec.decode(io.StringIO(json.dumps(
+        {"__churro_class__": docs[1]["__churro_class__"], "__churro_data__": result})))
+    index.idx_merge(changes, load, tree, dropped)
+    stream = io.StringIO()
+    codec.encode(index, stream)
+    return _write_json(session, json.loads(stream.getvalue()))
+
+
+def _merge_index_folder(session, repo, path, base, ours, theirs, load, changes, tree, dropped):
+    """
+    merges an index stored as a folder, such as a
+    :class:`ShardedGitObjectHashIndex`: its shards are those of ours,
+    updated by ``idx_merge``, its subfolders were merged as any other
+    (see _merge_tree), and its own document as in _merge_index
+    """
+    folder_name = churro.CHURRO_FOLDER
+
+    def entries(tree):
+        if tree is None:
+            return {}
+        return dict(
+            (name.decode(session.path_encoding), oid)
+            for mode, type, oid, name in repo.tree(tree) if type == b"blob")
+
+    base, ours, theirs = entries(base), entries(ours), entries(theirs)
+    docs = [_read_json(repo, side[folder_name]) if folder_name in side else _missing
+            for side in (base, ours, theirs)]
+    merged = session.churrodb_merged
+    _merge_dropped(docs, merged)
+    codec = getattr(session, "churrodb_codec", churro.codec)
+    index = codec.decode(io.StringIO(json.dumps(_merge_json(*docs, merged=merged))))
+    for name, oid in ours.items():
+        if name != folder_name and name.endswith(churro.CHURRO_EXT):
+            shard = load(oid)
+            churro.PersistentFolder.__setitem__(index, name[:-len(churro.CHURRO_EXT)], shard)
+            shard._dirty = False
+
+    index.idx_merge(changes, load, tree, dropped)
+
+    folder = session.find(path)
+    for name, (type, obj) in list(index._contents.items()) + [("", ("object", index))]:
+        file_name = name + churro.CHURRO_EXT if name else folder_name
+        if obj is churro._removed:
+            folder.remove(file_name)
+            continue
+        if type != "object" or (name and not obj._dirty):
+            continue
+        stream = io.StringIO()
+        codec.encode(obj, stream)
+        folder.set(file_name, (b"blob", _write_json(session, json.loads(stream.getvalue())), None))
+
+
+def _merge_tree(session, repo, path, base, ours, theirs, pending):
+    """
+    merges the changes between the trees ``base`` and ``theirs`` into the
+    session's folder at ``path``, whose tree is ``ours``. documents which
+    don't merge (yet) are added to ``pending``
+    """
+    def entries(tree):
+        if tree is None:
+            return {}
+        return dict(
+            (name.decode(session.path_encoding), (type, oid))
+            for mode, type, oid, name in repo.tree(tree))
+
+    index = path and _index_class(repo, ours)
+    base, ours, theirs = entries(base), entries(ours), entries(theirs)
+    folder = session.find(path)
+    for name in set(base) | set(theirs):
+        b, o, t = base.get(name), ours.get(name), theirs.get(name)
+        if t == b or t == o:
+            continue
+        if index and t[0] == b"blob":
+            # the shards and the document of an index stored as a folder
+            # merge once its collection is merged, see _merge_index_folder
+            continue
+        if o == b:
+            if t is None:
+                folder.remove(name)
+            else:
+                folder.set(name, (t[0], t[1], None))
+        elif o is None or t is None or o[0] != t[0] or (b is not None and b[0] != t[0]):
+            raise acidfs.ConflictError(
+                "'{path}' was changed and replaced or removed".format(path="/".join(path + [name])))
+        elif t[0] == b"tree":
+            if _index_class(repo, o[1]):
+                pending.append((folder, path + [name], b and b[1], o[1], t[1]))
+            _merge_tree(session, repo, path + [name], b and b[1], o[1], t[1], pending)
+        elif name.endswith(churro.CHURRO_EXT):
+            pending.append((folder, path + [name], b and b[1], o[1], t[1]))
+        else:
+            raise acidfs.ConflictError(
+                "can't merge '{path}'".format(path="/".join(path + [name])))
+
+
+def _merge(session, base, current):
+    """
+    merges the changes between the commits (or trees) ``base`` and
+    ``current`` into the session's tree
+    """
+    repo = git.repository(session.db)
+    stats = session.churrodb_merge_stats
+    session.churrodb_merged = {}
+    ours = session.tree.save()
+    found = []
+    _merge_tree(session, repo, [], base, ours, current, found)
+    pending, indexes = [], []
+    for entry in found:
+        (indexes if _index_class(repo, entry[3]) else pending).append(entry)
+
+    # documents refering to documents merged on both sides, such as the
+    # shards of hash indexes, merge once those are merged
+    while pending:
+        waiting = set(oid for entry in pending for oid in entry[3:])
+        deferred = []
+        for entry in pending:
+            folder, path, b, o, t = entry
+            try:
+                oid = _merge_document(session, repo, b, o, t, waiting - {o, t})
+            except acidfs.ConflictError:
+                raise acidfs.ConflictError(
+                    "conflicting changes to '{path}'".format(path="/".join(path)))
+            if oid is None:
+                deferred.append(entry)
+                continue
+            folder.set(path[-1], (b"blob", oid, None))
+            stats["documents"] += 1
+        if len(deferred) == len(pending):
+            raise acidfs.ConflictError(
+                "conflicting changes to '{path}'".format(path="/".join(deferred[0][1])))
+        pending = deferred
+
+    # indexes are updated once the items of their collections are merged,
+    # those of nested collections first
+    for entry in sorted(indexes, key=lambda entry: -len(entry[1])):
+        folder, path, b, o, t = entry
+        try:
+            oid = _merge_index(session, repo, ours, path, b, o, t)
+        except acidfs.ConflictError:
+            raise acidfs.ConflictError(
+                "conflicting changes to '{path}'".format(path="/".join(path)))
+        if oid is not None:
+            # saving the collection's tree replaced the folders read before
+            session.find(path[:-1]).set(path[-1], (b"blob", oid, None))
+        stats["documents"] += 1
+    stats["merges"] += 1
+
+
+def _update_indexes(session, base, paths):
+    """
+    updates the indexes of the collections at ``paths`` (lists of names)
+    in the session's tree for the items which changed since the tree
+    ``base``, from those changes alone (see ``idx_merge`` of the index
+    classes), those of nested collections first. :return: number of
+    indexes updated
+    """
+    repo = git.repository(session.db)
+    session.churrodb_merged = {}
+    found = []
+    for path in sorted(paths, key=lambda path: -len(path)):
+        tree = session.find(list(path)).save()
+        tree = tree.decode("ascii") if isinstance(tree, bytes) else tree
+        previous = _subtree(repo, base, list(path), session.path_encoding)
+        if previous == tree:
+            continue
+        indexes = _subtree(repo, tree, ["_index"], session.path_encoding)
+        if indexes is None:
+            continue
+        for mode, type, oid, name in repo.tree(indexes):
+            name = name.decode(session.path_encoding)
+            if name == churro.CHURRO_FOLDER or not _index_class(repo, oid):
+                continue
+            index_path = list(path) + ["_index", name]
+            oid = _merge_index(session, repo, base, index_path, oid, oid, oid)
+            if oid is not None:
+                session.find(index_path[:-1]).set(name, (b"blob", oid, None))
+            found.append(index_path)
+    return len(found)
+
+
+def _head(session):
+    return subprocess.check_output(
+        ["git", "rev-list", "--max-count=1", session.head], cwd=session.db).strip()
+
+
+def _tpc_vote(self, tx):
+    group_commit = getattr(self, "churrodb_group_commit", None)
+    if group_commit is not None and self.tree.dirty:
+        return group_commit.commit(self, tx)
+
+    stats = getattr(self, "churrodb_merge_stats", None)
+    if stats is None or not self.tree.dirty or not self.prev_commit:
+        return _acidfs_tpc_vote(self, tx)
+
+    base = self.prev_commit
+    attempt = 0
+    while True:
+        current = _head(self)
+        if current != base:
+            # merge outside of the lock, other sessions may commit meanwhile
+            _merge(self, base, current)
+            base = current
+        self.acquire_lock()
+        current = _head(self)
+        if current == base:
+            break
+        if attempt == MERGE_RETRIES:
+            _merge(self, base, current)
+            base = current
+            break
+        self.release_lock()
+        stats["retries"] += 1
+        time.sleep(MERGE_BACKOFF * 2 ** attempt)
+        attempt += 1
+
+    # a rebase rather than a merge commit, HEAD is the only parent
+    self.next_commit = self.mkcommit(tx, self.tree.save(), [base])
+
+_acidfs_tpc_vote = acidfs._Session.tpc_vote
+# monkey-patch acidfs' vote, so that sessions of merging ChurroDbs (see
+# ChurroDb.save) rebase their tree onto a HEAD which moved meanwhile,
+# merging documents changed on both sides key by key. the original merge
+# gives up on any blob changed on both sides (and, with current versions
+# of git, on blobs changed on one side as well)
+acidfs._Session.tpc_vote = _tpc_vote
+
+
+def _tpc_finish(self, tx):
+    if getattr(self, "churrodb_committed", False):
+        # committed by its group, see GroupCommit
+        self.close()
+        return
+    _acidfs_tpc_finish(self, tx)
+
+
+def _sort_key(self):
+    if getattr(self, "churrodb_group_commit", None) is not None:
+        # grouped sessions commit while they vote, after all others voted
+        return "~" + self.name
+    return self.name
+
+_acidfs_tpc_finish = acidfs._Session.tpc_finish
+# monkey-patch acidfs' finish and sort key for group commits
+acidfs._Session.tpc_finish = _tpc_finish
+acidfs._Session.sortKey = _sort_key
+
+
+class _MergeTarget(object):
+    """the tree a group commit merges its sessions into, see _merge"""
+    find = acidfs._Session.find
+
+    def __init__(self, db, commit, path_encoding, codec, stats):
+        self.db = db
+        self.path_encoding = path_encoding
+        self.churrodb_codec = codec
+        self.churrodb_merge_stats = stats
+        self.reset(commit)
+
+    def reset(self, treeish):
+        if treeish is None:
+            self.tree = acidfs._TreeNode(self.db, self.path_encoding)
+        else:
+            self.tree = acidfs._TreeNode.read(self.db, treeish, self.path_encoding)
+
+
+class _Group(object):
+    def __init__(self):
+        self.members = []
+        self.errors = {}
+        self.done = threading.Event()
+
+
+class GroupCommit(object):
+    """
+    commits the saves of the ChurroDbs sharing it (see ``group_commit`` of
+    :class:`ChurroDb`) which arrive within ``window`` seconds, up to
+    ``size`` of them, as one git commit. their changes are merged as by a
+    merging save, saves whose changes conflict fail on their own.
+
+    the indexes of a collection are updated once for the group, from the
+    changes of the merged tree (see _update_indexes), if those of the
+    collection and of the collections holding it can all be (see
+    _idx_derivable). otherwise every save updates them in its own
+    before-commit hook, and the merge re-derives their entries for the
+    items which the saves before it changed.
+
+    the commit is written while the transactions vote, so the AcidFS
+    sessions vote after all other data managers. :attr:`stats` counts
+    groups, saves, merged documents, conflicts and indexes updated.
+    """
+    def __init__(self, window=0.01, size=64):
+        self.window = window
+        self.size = size
+        self.stats = collections.Counter()
+        self._groups = {}
+        self._lock = threading.Condition()
+
+    def commit(self, session, tx):
+        """commits the AcidFS ``session`` with its group"""
+        member = (session, tx, session.tree.save())
+        key = (session.db, session.head)
+        with self._lock:
+            group = self._groups.get(key)
+            leader = group is None
+            if leader:
+                group = self._groups[key] = _Group()
+            group.members.append(member)
+            if len(group.members) >= self.size:
+                self._lock.notify_all()
+            elif leader:
+                self._lock.wait_for(lambda: len(group.members) >= self.size, self.window)
+            if leader:
+                del self._groups[key]
+
+        if leader:
+            self._commit(group)
+        else:
+            group.done.wait()
+        error = group.errors.get(id(session))
+        if error is not None:
+            raise error
+
+    def _commit(self, group):
+        leader, tx, tree = group.members[0]
+        try:
+            leader.acquire_lock()
+            head = _head(leader) if os.path.exists(leader.headref) else None
+            target = _MergeTarget(
+                leader.db, head, leader.path_encoding,
+                getattr(leader, "churrodb_codec", churro.codec), self.stats)
+            base = target.tree.save()
+            base = base.decode("ascii") if isinstance(base, bytes) else base
+            committed = []
+            for session, session_tx, session_tree in group.members:
+                merged = target.tree.save()
+                try:
+                    _merge(target, session.prev_commit, session_tree)
+                    committed.append(session)
+                except acidfs.ConflictError as why:
+                    self.stats["conflicts"] += 1
+                    group.errors[id(session)] = why
+                    target.reset(merged)
+
+            if committed:
+                # the saves left the indexes of their collections to the group
+                paths = set()
+                for session in committed:
+                    paths.update(getattr(session, "churrodb_indexes", ()))
+                self.stats["indexes"] += _update_indexes(target, base, paths)
+                leader.next_commit = leader.mkcommit(
+                    tx, target.tree.save(), [head] if head else [])
+                # moves HEAD and releases the lock
+                _acidfs_tpc_finish(leader, tx)
+                for session in committed:
+                    session.churrodb_committed = True
+                self.stats["groups"] += 1
+                self.stats["saves"] += len(committed)
+        except Exception as why:
+            for session, session_tx, session_tree in group.members:
+                group.errors.setdefault(id(session), why)
+        finally:
+            leader.release_lock()
+            group.done.set()
+
+
+# maintenance runs once per repository at a time within a process
+_maintenance_locks = collections.defaultdict(threading.Lock)
+_maintenance_locks_lock = threading.Lock()
+
+
+def _count_objects(db):
+    """:return: the counts of ``git count-objects -v``, sizes in KiB"""
+    output = subprocess.check_output(["git", "count-objects", "-v"], cwd=db)
+    counts = {}
+    for line in output.decode("ascii").splitlines():
+        name, value = line.split(":")
+        counts[name.strip().replace("-", "_")] = int(value)
+    return counts
+
+
+def _loose_estimate(db):
+    """estimates the number of loose objects from one of their 256 directories, as git gc does"""
+    try:
+        return 256 * len(os.listdir(os.path.join(db, "objects", "17")))
+    except FileNotFoundError:
+        return 0
+
+
+def _pack_count(db):
+    try:
+        return len([
+            name for name in os.listdir(os.path.join(db, "objects", "pack"))
+            if name.endswith(".pack")])
+    except FileNotFoundError:
+        return 0
+
+
+class Maintenance(object):
+    """
+    keeps the object database of a repository compact. every commit leaves
+    loose objects behind, one file each, which take up far more space than
+    packed objects and slow down everything listing or copying them.
+
+    passed as ``maintenance`` to :class:`ChurroDb`, the number of loose
+    objects is estimated every ``check_every`` commits. above
+    ``loose_objects`` they are packed into a new pack, above ``packs`` packs
+    the packs are rolled up geometrically. after repacking, a multi-pack-index
+    and a split commit-graph are written. the repacking runs in a
+    background thread, saves don't wait for it.
+
+    repacking neither drops nor rewrites reachable objects and leaves loose
+    objects of running transactions alone, so it's safe while the repository
+    is in use. it isn't a latency fix: packed objects are stored as deltas,
+    which take longer to read than loose objects until their bases are
+    cached. :attr:`stats` counts checks, runs and each step taken,
+    :attr:`report` is the report of the last run, lookup latency included.
+    """
+    def __init__(
+            self, loose_objects=6700, packs=50, check_every=100,
+            multi_pack_index=True, commit_graph=True, sample=100):
+        self.loose_objects = loose_objects
+        self.packs = packs
+        self.check_every = check_every
+        self.multi_pack_index = multi_pack_index
+        self.commit_graph = commit_graph
+        # objects whose lookup latency is reported
+        self.sample = sample
+        self.stats = collections.Counter()
+        self.report = None
+        self._commits = collections.Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def committed(self, db):
+        """
+        counts a commit to the git directory ``db``, starts the maintenance
+        in a background thread when due. :return: the thread, None if
+        nothing is due
+        """
+        with self._lock:
+            self._commits[db] += 1
+            if self._commits[db] < self.check_every:
+                return None
+            self._commits[db] = 0
+            self.stats["checks"] += 1
+        if _loose_estimate(db) < self.loose_objects and _pack_count(db) <= self.packs:
+            return None
+        thread = threading.Thread(
+            target=self._background, args=(db,), name="churrodb-maintenance", daemon=True)
+        thread.start()
+        self._thread = thread
+        return thread
+
+    def join(self, timeout=None):
+        """waits for the maintenance started last by :meth:`committed`"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _background(self, db):
+        try:
+            self.run(db, wait=False)
+        except Exception:
+            log.exception("maintenance of '{db}' failed".format(db=db))
+
+    def run(self, db, force=False, wait=True):
+        """
+        repacks the git directory ``db`` as far as the thresholds ask for,
+        everything with ``force``. without ``wait`` nothing is done while
+        another thread maintains ``db``.
+
+        :return: a report with the object counts (see ``git count-objects``)
+        and the mean lookup latency in seconds before and after, the steps
+        taken and the time they took, None if nothing was done
+        """
+        with _maintenance_locks_lock:
+            lock = _maintenance_locks[os.path.realpath(db)]
+        if not lock.acquire(wait):
+            return None
+        try:
+            started = time.perf_counter()
+            sample = self._sample(db)
+            before = _count_objects(db)
+            before["latency"] = self._latency(db, sample)
+            steps = []
+            if force or before["packs"] > self.packs:
+                # rolls up the loose objects and the smaller packs
+                subprocess.check_call(
+                    ["git", "repack", "-d", "-q", "--geometric=2"], cwd=db)
+                steps.append("geometric_repack")
+            elif before["count"] >= self.loose_objects:
+                subprocess.check_call(["git", "repack", "-d", "-q"], cwd=db)
+                steps.append("repack")
+            if steps and self.multi_pack_index:
+                subprocess.check_call(["git", "multi-pack-index", "write"], cwd=db)
+                steps.append("multi_pack_index")
+            if steps and self.commit_graph:
+                subprocess.check_call(
+                    ["git", "commit-graph", "write", "--reachable", "--split"], cwd=db)
+                steps.append("commit_graph")
+            if not steps:
+                return None
+            after = _count_objects(db)
+            after["latency"] = self._latency(db, sample)
+
+            self.stats["runs"] += 1
+            self.stats.update(steps)
+            self.report = {
+                "before": before, "after": after, "steps": steps,
+                "seconds": time.perf_counter() - started}
+            log.info(
+                "maintained '{db}': {steps}, {before} loose objects in {before_packs} packs "
+                "before, {after} in {after_packs} after".format(
+                    db=db, steps=", ".join(steps),
+                    before=before["count"], before_packs=before["packs"],
+                    after=after["count"], after_packs=after["packs"]))
+            return self.report
+        finally:
+            lock.release()
+
+    def _sample(self, db):
+        """:return: up to :attr:`sample` oids of blobs in HEAD"""
+        repo = git.repository(db)
+        oids = []
+        trees = ["HEAD"]
+        try:
+            while trees and len(oids) < self.sample:
+                for mode, type, oid, name in repo.tree(trees.pop()):
+                    if type == b"tree":
+                        trees.append(oid)
+                    elif len(oids) < self.sample:
+                        oids.append(oid)
+        except KeyError:
+            # no commit yet
+            pass
+        return oids
+
+    def _latency(self, db, oids):
+        """:return: the mean time a fresh object database takes to look up one of ``oids``"""
+        if not oids:
+            return None
+        objects = git.ObjectDatabase(db)
+        try:
+            # opening the packs isn't part of a lookup
+            objects._refresh_packs()
+            started = time.perf_counter()
+            for oid in oids:
+                objects.read(oid)
+            return (time.perf_counter() - started) / len(oids)
+        finally:
+            objects.close()
+
+
 def idx_find_first(self, key, subindex=None):
     found = self.idx_find(key, subindex)
     if len(found) > 0:
@@ -73,6 +1054,39 @@ def idx_find_first(self, key, subindex=None):
     return None
 
 
+def idx_find_many(self, keys, subindex=None):
+    """:return: dict of the first value found for each of ``keys``, missing keys are left out"""
+    found = {}
+    for key in keys:
+        values = self.idx_find(key, subindex)
+        if len(values) > 0:
+            found[key] = values[0]
+    return found
+
+
+def _inherited_churrodb(obj):
+    """
+    looks up the db reference of the closest ancestor which has one, if that
+    db uses deferred registration. ancestors are followed through
+    ``__parent__`` or, for objects held in a persistent property, through
+    ``__instance__``.
+    """
+    node = obj
+    while True:
+        parent = getattr(node, "__parent__", None)
+        if parent is None:
+            instance = getattr(node, "__instance__", None)
+            parent = instance if instance is not node else None
+        if parent is None or not isinstance(parent, ChurroDbAware):
+            return None
+        db = parent.churrodb
+        if db is not None:
+            if getattr(db, "deferred_registration", False):
+                return db
+            return None
+        node = parent
+
+
 class ChurroDbAware(object):
     def __new__(cls, *args, **kwargs):
         obj = super().__new__(cls, *args, **kwargs)
@@ -81,18 +1095,35 @@ class ChurroDbAware(object):
 
     @property
     def churrodb(self):
+        if self._churrodb is None:
+            self._churrodb = _inherited_churrodb(self)
         return self._churrodb
 
     @churrodb.setter
     def churrodb(self, value):
         self._churrodb = value
+        if getattr(value, "deferred_registration", False):
+            # descendants look the db up on first access or get it in _load
+            return
         for name, attr in self.__dict__.items():
             if name not in ["__parent__", "__instance__"]:
                 self.register(attr)
         if hasattr(self, "__iter__"):
-            for key, item in self.items():
+            for key, item in self._registrable_items():
                 self.register(item)
 
+    def _registrable_items(self):
+        """
+        items to hand the db reference on to. children of a folder which have
+        not been loaded yet are skipped, :meth:`_load` registers them later.
+        """
+        if not isinstance(self, churro.PersistentFolder):
+            return self.items()
+        contents = self.__dict__.get("_contents", {})
+        return [
+            (name, obj) for name, (type, obj) in contents.items()
+            if obj is not None and obj is not churro._removed]
+
     def register(self, obj):
         if hasattr(obj, "churrodb"):
             if self.churrodb is not None:
@@ -100,13 +1131,30 @@ class ChurroDbAware(object):
 
     def __setattr__(self, key, value):
         super().__setattr__(key, value)
-        if key not in ["churrodb", "_churrodb"]:
+        if key not in ["churrodb", "_churrodb", "__parent__", "__instance__"]:
             self.register(value)
 
     def __setitem__(self, name, other):
+        self.track_change(name)
         super().__setitem__(name, other)
         self.register(other)
 
+    def __delitem__(self, name):
+        self.track_change(name)
+        super().__delitem__(name)
+
+    remove = __delitem__
+
+    def pop(self, name, *args):
+        self.track_change(name)
+        return super().pop(name, *args)
+
+    def track_change(self, name):
+        """
+        called whenever the item ``name`` is about to be added, replaced,
+        changed or removed
+        """
+
     def _load(self, name, type, cache=True):
         obj = super()._load(name, type, cache)
         self.register(obj)
@@ -136,14 +1184,281 @@ class ChurroDbRoot(ChurroDbAware, churro.PersistentFolder):
     pass
 
 
+class ObjectCache(object):
+    """
+    bounded LRU cache of decoded objects keyed by git oid. since blobs are
+    immutable by oid, entries never have to be invalidated. objects handed
+    out by the cache are shared, they must be treated as read-only.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._objects = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, oid, default=None):
+        with self._lock:
+            try:
+                obj = self._objects[oid]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._objects.move_to_end(oid)
+            self.hits += 1
+            return obj
+
+    def put(self, oid, obj):
+        with self._lock:
+            self._objects[oid] = obj
+            self._objects.move_to_end(oid)
+            while len(self._objects) > self.maxsize:
+                self._objects.popitem(last=False)
+                self.evictions += 1
+
+    def setdefault(self, oid, obj):
+        """
+        caches ``obj`` unless another thread cached ``oid`` meanwhile.
+        :return: the cached object
+        """
+        with self._lock:
+            obj = self._objects.setdefault(oid, obj)
+            self._objects.move_to_end(oid)
+            while len(self._objects) > self.maxsize:
+                self._objects.popitem(last=False)
+                self.evictions += 1
+            return obj
+
+    def clear(self):
+        with self._lock:
+            self._objects.clear()
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __contains__(self, oid):
+        return oid in self._objects
+
+    def stats(self):
+        return {
+            "size": len(self._objects),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class _BoundData(object):
+    """
+    the blob of an object which refers to its db, cached instead of the
+    object, see ChurroDb.object_by_hash
+    """
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+
+def _unbound(cached):
+    """:return: whether the cached object can be shared by all dbs"""
+    return cached is not _missing and not isinstance(cached, _BoundData)\
+        and not hasattr(cached, "churrodb")
+
+
+class ChildCache(object):
+    """
+    bounds the object children folders keep loaded, by number
+    (``max_objects``) and/or total blob size (``max_bytes``). beyond that,
+    clean children are evicted, least recently (``policy="lru"``) or least
+    frequently (``policy="lfu"``) used first, and read from git again when
+    accessed. dirty children are never evicted. evicted children which are
+    still referenced elsewhere are handed out again instead of a copy.
+    subfolders and children created in this process are not tracked.
+    """
+    def __init__(self, max_objects=None, max_bytes=None, policy="lru"):
+        if policy not in ("lru", "lfu"):
+            raise ValueError("unknown cache policy '{policy}'".format(policy=policy))
+        self.max_objects = max_objects
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._uses = {}
+        self._buckets = collections.defaultdict(collections.OrderedDict)
+        self._lock = threading.Lock()
+
+    def loaded(self, folder, name, obj, size=None):
+        """``obj`` was loaded as child ``name`` of ``folder``"""
+        key = (id(folder), name)
+        with self._lock:
+            if size is None:
+                # handed out again after eviction
+                size = 0
+            else:
+                self.misses += 1
+            self._discard(key)
+            self._entries[key] = (weakref.ref(folder), name, weakref.ref(obj), size)
+            self.bytes += size
+            self._uses[key] = 1
+            self._buckets[1][key] = None
+            self._evict()
+
+    def touch(self, folder, name):
+        """the loaded child ``name`` of ``folder`` was accessed"""
+        key = (id(folder), name)
+        with self._lock:
+            if key not in self._entries:
+                return
+            self.hits += 1
+            self._use(key)
+
+    def _use(self, key):
+        self._entries.move_to_end(key)
+        uses = self._uses[key]
+        self._unbucket(key, uses)
+        self._uses[key] = uses + 1
+        self._buckets[uses + 1][key] = None
+
+    def _unbucket(self, key, uses):
+        bucket = self._buckets[uses]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[uses]
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[3]
+            self._unbucket(key, self._uses.pop(key))
+
+    def _full(self):
+        return (self.max_objects is not None and len(self._entries) > self.max_objects)\
+            or (self.max_bytes is not None and self.bytes > self.max_bytes)
+
+    def _victim(self):
+        """:return: the key of the entry to evict next"""
+        if self.policy == "lru":
+            return next(iter(self._entries))
+        return next(iter(self._buckets[min(self._buckets)]))
+
+    def _evict(self):
+        # every entry is looked at once at most, dirty ones are moved
+        # behind the others as if they were used
+        for attempt in range(len(self._entries)):
+            if not self._full():
+                break
+            key = self._victim()
+            folder_ref, name, obj_ref, size = self._entries[key]
+            folder, obj = folder_ref(), obj_ref()
+            objref = None
+            if folder is not None:
+                objref = folder.__dict__.get("_contents", {}).get(name)
+            if obj is None or objref is None or objref[1] is not obj:
+                # removed or replaced since
+                self._discard(key)
+                continue
+            if obj._dirty:
+                self._use(key)
+                continue
+
+            folder._contents[name] = (objref[0], None)
+            evicted = folder.__dict__.get("_evicted")
+            if evicted is None:
+                evicted = folder.__dict__["_evicted"] = weakref.WeakValueDictionary()
+            evicted[name] = obj
+            self._discard(key)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._uses.clear()
+            self._buckets.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "bytes": self.bytes,
+            "max_objects": self.max_objects,
+            "max_bytes": self.max_bytes,
+            "policy": self.policy,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class _LazyRootData(collections.abc.MutableMapping):
+    """
+    stands in for the data dict of a lazy ChurroDb. names, lengths and
+    membership are answered by the root folder, children are loaded and
+    remembered on first access.
+    """
+    def __init__(self, db):
+        self._db = db
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        try:
+            return self.loaded[name]
+        except KeyError:
+            obj = self.loaded[name] = self._db.root()[name]
+            return obj
+
+    def __setitem__(self, name, value):
+        self.loaded[name] = value
+
+    def __delitem__(self, name):
+        self.loaded.pop(name, None)
+
+    def __iter__(self):
+        return iter(self._db.root())
+
+    def __len__(self):
+        return len(self._db.root())
+
+    def __contains__(self, name):
+        return name in self._db.root()
+
+
 class ChurroDb(IIndex):
-    def __init__(self, repo, head="HEAD", factory=None, **kwargs):
+    def __init__(
+            self, repo, head="HEAD", factory=None, object_cache=None,
+            lazy=False, deferred_registration=False, codec=None,
+            child_cache=None, index_workers=None, merge=False, group_commit=None,
+            maintenance=None, path_encoding=None, **kwargs):
         self._path = repo
         self._head = head
         self._churro_kwargs = kwargs
-        self._data = {}
+        # encoding of the names in git trees, AcidFS' default if None
+        self.path_encoding = path_encoding
+        self._lazy = lazy
+        self.deferred_registration = deferred_registration
+        self._data = _LazyRootData(self) if lazy else {}
         self._churro = None
         self.fs = None
+        if object_cache is None:
+            object_cache = ObjectCache()
+        self.object_cache = object_cache
+        if codec is None:
+            codec = churro.codec
+        self.codec = codec
+        self.child_cache = child_cache
+        # threads reading ahead while indexes are rebuilt, see RebuildSet
+        self.index_workers = index_workers
+        self.merge = merge
+        self.merge_stats = collections.Counter()
+        self.group_commit = group_commit
+        self.maintenance = maintenance
 
         self.make_churro(repo, head, factory, **kwargs)
         self.refresh_data()
@@ -151,6 +1466,8 @@ class ChurroDb(IIndex):
     def __new__(cls, *args, **kwargs):
         obj = super().__new__(cls)
         obj.named_indexes = {}
+        # objects of object_by_hash bound to this db, while they are in use
+        obj._bound_objects = weakref.WeakValueDictionary()
         return obj
 
     def make_churro(self, repo, head="HEAD", factory=None, **kwargs):
@@ -158,18 +1475,39 @@ class ChurroDb(IIndex):
             factory = ChurroDbRoot
         self._churro = churro.Churro(repo, head, factory, **kwargs)
         self.fs = self._churro.fs
+        if self.path_encoding is not None:
+            # read by AcidFS when it opens a session
+            self.fs.path_encoding = self.path_encoding
+        self.fs.churrodb_codec = self.codec
+        self.fs.churrodb_child_cache = self.child_cache
         root = self.root()
         if hasattr(root, "churrodb"):
             root.churrodb = self
 
+    def named_index(self, name):
+        """
+        :return: the index registered under ``name``. with deferred
+        registration, members of the root's indexes folder are loaded
+        (and thereby registered) when the name is not known yet.
+        """
+        if name not in self.named_indexes:
+            index = getattr(self.root(), "idx", None)
+            if isinstance(index, IndexesFolder):
+                list(index.values())
+        return self.named_indexes[name]
+
     def refresh_data(self):
+        if self._lazy:
+            self._data.loaded.clear()
+            return
         root = self.root()
         for k, v in root.items():
             self._data[k] = v
 
     def refresh_dbroot(self):
         root = self.root()
-        for k, v in self.items():
+        items = self._data.loaded.items() if self._lazy else self.items()
+        for k, v in list(items):
             root[k] = v
 
     def switch(self, branch="HEAD"):
@@ -177,10 +1515,28 @@ class ChurroDb(IIndex):
         self.refresh_dbroot()
 
     def save(self):
+        """
+        commits the transaction. with ``merge``, changes committed since the
+        transaction began are merged, documents changed on both sides key by
+        key. only conflicts which can't be merged that way end up on a
+        conflict branch. :attr:`merge_stats` counts merges, merged
+        documents, retries and conflicts. with a :class:`GroupCommit`, the
+        changes are committed together with other saves. with a
+        :class:`Maintenance`, the repository is repacked in the background
+        when due.
+        """
+        if self.merge or self.group_commit is not None:
+            session = self.fs._session()
+            session.churrodb_codec = self.codec
+            if self.merge:
+                session.churrodb_merge_stats = self.merge_stats
+            session.churrodb_group_commit = self.group_commit
         try:
             transaction.commit()
         except Exception as why:
             transaction.abort()
+            if self.merge and isinstance(why, acidfs.ConflictError):
+                self.merge_stats["conflicts"] += 1
             if isinstance(why, acidfs.ConflictError):
                 message = "trying to commit this transaction caused a conflict"
             elif isinstance(why, subprocess.CalledProcessError):
@@ -211,6 +1567,20 @@ class ChurroDb(IIndex):
                 raise why
             finally:
                 self.switch("HEAD")
+        else:
+            if self.maintenance is not None:
+                self.maintenance.committed(self.fs.db)
+
+    def maintain(self, force=False):
+        """
+        repacks the repository now, see :class:`Maintenance`.
+
+        :return: the report of the run, None if nothing was due
+        """
+        maintenance = self.maintenance
+        if maintenance is None:
+            maintenance = Maintenance()
+        return maintenance.run(self.fs.db, force=force)
 
     def root(self):
         return self._churro.root()
@@ -218,6 +1588,11 @@ class ChurroDb(IIndex):
     def flush(self):
         self._churro.flush()
 
+    @property
+    def flush_stats(self):
+        """counters of the objects written by the last flush"""
+        return flush_stats(self.fs)
+
     def keys(self):
         return self._data.keys()
 
@@ -279,6 +1654,11 @@ class ChurroDb(IIndex):
         if hasattr(root, "idx_update"):
             root.idx_update(*args, **kwargs)
 
+    def idx_rebuild(self):
+        root = self.root()
+        if hasattr(root, "idx_rebuild"):
+            root.idx_rebuild()
+
     def idx_find(self, *args, **kwargs):
         root = self.root()
 
@@ -287,24 +1667,638 @@ class ChurroDb(IIndex):
 
     idx_find_first = idx_find_first
 
+    def idx_find_many(self, *args, **kwargs):
+        root = self.root()
+
+        if hasattr(root, "idx_find_many"):
+            return root.idx_find_many(*args, **kwargs)
+
+    def idx_lag(self):
+        root = self.root()
+
+        if hasattr(root, "idx_lag"):
+            return root.idx_lag()
+        return 0
+
+    def query(self, conditions):
+        return self.explain(conditions).execute()
+
+    def explain(self, conditions):
+        root = self.root()
+
+        if hasattr(root, "explain"):
+            return root.explain(conditions)
+        return QueryPlan(root, conditions, [])
+
     def idx_validate(self):
         pass
 
+    def scan(self, path="", batch_size=git.BATCH_SIZE):
+        """
+        yields (name, object) for the children of the folder at ``path``
+        (e.g. ``"a/b"``, the root by default). children are read from git
+        ``batch_size`` at a time and not cached by the folder, so memory
+        stays flat however large the folder is. changes to such children
+        are not saved. children loaded before are yielded as they are.
+        """
+        folder = self.root()
+        for name in path.strip("/").split("/"):
+            if name:
+                folder = folder[name]
+        return _scan_folder(folder, batch_size)
+
+    def bulk_load(self, items, path="", batch_size=10000):
+        """
+        adds the (name, object) pairs of ``items`` to the folder at ``path``
+        and commits. the objects are encoded ``batch_size`` at a time and
+        written into one pack by ``git fast-import``, bypassing the
+        per-object bookkeeping of churro. the objects themselves are not
+        attached to the folder, it reads them from git when asked for them.
+        indexes of the folder are rebuilt once, at the end, those of its
+        ancestors are updated as for any other change. if loading fails,
+        the transaction has to be aborted.
+
+        :return: number of objects loaded
+        """
+        folder = self.root()
+        for name in path.strip("/").split("/"):
+            if name:
+                folder = folder[name]
+        # new folders need their directory before entries can be added
+        self.flush()
+        # the ancestors' indexes see the folder changed, with its oid from
+        # before the load
+        node = folder
+        while node.__parent__ is not None:
+            track_change = getattr(node.__parent__, "track_change", None)
+            if track_change is not None:
+                track_change(node.__name__)
+            node = node.__parent__
+
+        fs = self.fs
+        node = fs._session().find(fs._mkpath(churro.resource_path(folder)))
+        contents = folder._contents
+        evicted = folder.__dict__.get("_evicted", {})
+
+        def write(writer, batch):
+            oids = writer.write_many([data for name, data in batch])
+            for (name, data), oid in zip(batch, oids):
+                node.set(name + churro.CHURRO_EXT, (b"blob", oid, None))
+                contents[name] = ("object", None)
+                evicted.pop(name, None)
+            return len(batch)
+
+        log.info("bulk loading into '%s'...", churro.resource_path(folder))
+        loaded = 0
+        with git.BlobWriter(fs.db) as writer:
+            batch = []
+            for name, obj in items:
+                if "/" in name or contents.get(name, ("object",))[0] == "folder":
+                    raise ValueError("can't bulk load '{name}'".format(name=name))
+                stream = io.StringIO()
+                self.codec.encode(obj, stream)
+                batch.append((name, stream.getvalue().encode("utf-8")))
+                if len(batch) >= batch_size:
+                    loaded += write(writer, batch)
+                    batch = []
+            loaded += write(writer, batch)
+
+        if folder is self.root():
+            self.refresh_data()
+        # marks the ancestors dirty as well
+        churro._set_dirty(folder)
+        if isinstance(folder, IndexMixin) and folder.idx is not None:
+            folder.idx_rebuild()
+        self.save()
+        return loaded
+
+    def snapshot(self, commit="HEAD"):
+        """
+        :return: a read-only :class:`Snapshot` of ``commit``, sharing
+        :attr:`object_cache` with this db and its other snapshots
+        """
+        return Snapshot(
+            self.fs.db, commit, self.object_cache, self.codec, self.fs.path_encoding)
+
+    def changes(self, since_commit, until="HEAD", path=None):
+        """
+        yields a :class:`Change` for every object added, modified or removed
+        between the commits ``since_commit`` and ``until``, below ``path``.
+        only the trees which differ are listed, so it takes time in
+        proportion to the changes rather than to the collections.
+        """
+        repo = git.repository(self.fs.db)
+        prefix = "/" + path.strip("/") if path and path.strip("/") else ""
+        old = self._change_tree(repo, _resolve_commit(self.fs.db, since_commit), prefix)
+        new = self._change_tree(repo, _resolve_commit(self.fs.db, until), prefix)
+        return self._diff_trees(repo, prefix, old, new)
+
+    def _change_tree(self, repo, commit, prefix):
+        """:return: the oid of the tree at ``prefix`` in ``commit``, None if missing"""
+        tree = commit
+        for name in filter(None, prefix.split("/")):
+            entries = dict(
+                (entry_name.decode(self.fs.path_encoding), (type, oid))
+                for mode, type, oid, entry_name in repo.tree(tree))
+            entry = entries.get(name)
+            if entry is None or entry[0] != b"tree":
+                return None
+            tree = entry[1]
+        return tree
+
+    def _diff_trees(self, repo, path, old, new):
+        if old == new:
+            return
+
+        def entries(tree):
+            if tree is None:
+                return {}
+            return dict(
+                (name.decode(self.fs.path_encoding), (type, oid))
+                for mode, type, oid, name in repo.tree(tree))
+
+        old, new = entries(old), entries(new)
+        for name in sorted(set(old) | set(new)):
+            old_type, old_oid = old.get(name, (None, None))
+            new_type, new_oid = new.get(name, (None, None))
+            if old_oid == new_oid:
+                continue
+            if b"tree" in (old_type, new_type):
+                yield from self._diff_trees(
+                    repo, path + "/" + name,
+                    old_oid if old_type == b"tree" else None,
+                    new_oid if new_type == b"tree" else None)
+                if old_type == new_type:
+                    continue
+                # a folder replaced an object or the other way round
+                if old_type == b"tree":
+                    old_oid = None
+                else:
+                    new_oid = None
+            if not name.endswith(churro.CHURRO_EXT):
+                continue
+            if name == churro.CHURRO_FOLDER:
+                child = path or "/"
+            else:
+                child = path + "/" + name[:-len(churro.CHURRO_EXT)]
+            if old_oid is None:
+                action = Change.ADDED
+            elif new_oid is None:
+                action = Change.REMOVED
+            else:
+                action = Change.MODIFIED
+            yield Change(self, action, child, old_oid, new_oid)
+
     def object_by_hash(self, hashstr, text_mode=True):
-        git = subprocess.Popen(
-            ["git", "show", hashstr],
-            cwd=self._path, stdout=subprocess.PIPE, universal_newlines=text_mode)
-        object = churro.codec.decode(git.stdout)
+        """
+        decodes the blob ``hashstr``. objects looked up by full oid are
+        served from :attr:`object_cache` and must be treated as read-only.
+        objects which refer to their db are cached as their blob, and bound
+        to each db on its own, which keeps them while they are in use.
+        """
+        cached = _missing
+        if git.is_oid(hashstr):
+            cached = self.object_cache.get(hashstr, _missing)
+        return self._object_by_hash(hashstr, text_mode, cached)
+
+    def _object_by_hash(self, hashstr, text_mode, cached):
+        """see object_by_hash, ``cached`` is what the object cache holds"""
+        if _unbound(cached):
+            return cached
+        cacheable = git.is_oid(hashstr)
+        if cacheable:
+            object = self._bound_objects.get(hashstr)
+            if object is not None:
+                return object
+
+        if isinstance(cached, _BoundData):
+            data = cached.data
+        else:
+            oid, type, data = git.repository(self.fs.db).read(hashstr)
+        if text_mode:
+            stream = io.StringIO(data.decode("utf-8"))
+        else:
+            stream = io.BytesIO(data)
+        object = self.codec.decode(stream)
         if hasattr(object, "churrodb"):
             object.churrodb = self
-
+            if cacheable:
+                self._bound_objects[hashstr] = object
+                if cached is _missing:
+                    self.object_cache.put(hashstr, _BoundData(data))
+        elif cacheable:
+            self.object_cache.put(hashstr, object)
         return object
 
 
+def _scan_folder(folder, batch_size=git.BATCH_SIZE):
+    """yields (name, child) of ``folder`` without caching the children, see ChurroDb.scan"""
+    contents = folder._filtered_contents
+    names = list(contents)
+    for start in range(0, len(names), batch_size):
+        chunk = names[start:start + batch_size]
+        _prefetch(folder, [name for name in chunk if contents[name][1] is None])
+        for name in chunk:
+            type, obj = contents[name]
+            if obj is None:
+                obj = folder._load(name, type, False)
+            yield name, obj
+
+
+def _resolve_commit(db, commit):
+    """:return: the oid of ``commit``, raises KeyError if there is none"""
+    if git.is_oid(commit):
+        return commit
+    # refs move, resolve them by a git process of their own
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--verify", "--quiet", commit + "^{commit}"],
+            cwd=db).decode("ascii").strip()
+    except subprocess.CalledProcessError:
+        raise KeyError("no such commit '{commit}'".format(commit=commit))
+
+
+class Change(object):
+    """
+    an object added, modified or removed between two commits, see
+    :meth:`ChurroDb.changes`. changes of a folder's own properties are
+    reported for the folder's path. :attr:`old` and :attr:`new` are decoded
+    when asked for, they are shared and must be treated as read-only.
+    """
+    ADDED = "added"
+    MODIFIED = "modified"
+    REMOVED = "removed"
+
+    def __init__(self, db, action, path, old_oid, new_oid):
+        self.db = db
+        self.action = action
+        self.path = path
+        self.old_oid = old_oid
+        self.new_oid = new_oid
+
+    @property
+    def old(self):
+        if self.old_oid is None:
+            return None
+        return self.db.object_by_hash(self.old_oid)
+
+    @property
+    def new(self):
+        if self.new_oid is None:
+            return None
+        return self.db.object_by_hash(self.new_oid)
+
+    def __repr__(self):
+        return "<Change {action} {path!r}>".format(action=self.action, path=self.path)
+
+
+class SnapshotFolder(collections.abc.Mapping):
+    """
+    read-only folder of a :class:`Snapshot`. maps the names of the children
+    to :class:`SnapshotFolder` objects or the decoded objects.
+    """
+    def __init__(self, snapshot, tree, path):
+        self.snapshot = snapshot
+        self.tree = tree
+        self.path = path
+
+    def _entries(self):
+        return self.snapshot._tree_entries(self.tree)
+
+    def _child(self, name, type, oid, decoded=None):
+        if type == "tree":
+            return SnapshotFolder(self.snapshot, oid, self.path + "/" + name)
+        if decoded is not None and oid in decoded:
+            return decoded[oid]
+        return self.snapshot._object(oid)
+
+    def _find(self, name):
+        entries = self._entries()
+        entry = entries.get(name)
+        if entry is not None and entry[0] == "tree":
+            return entry
+        if name + churro.CHURRO_EXT != churro.CHURRO_FOLDER:
+            return entries.get(name + churro.CHURRO_EXT)
+
+    def __getitem__(self, name):
+        entry = self._find(name)
+        if entry is None:
+            raise KeyError(name)
+        return self._child(name, *entry)
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def __iter__(self):
+        for name, (type, oid) in sorted(self._entries().items()):
+            if type == "tree":
+                yield name
+            elif name.endswith(churro.CHURRO_EXT) and name != churro.CHURRO_FOLDER:
+                yield name[:-len(churro.CHURRO_EXT)]
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+    def items(self):
+        """yields (name, child), objects not cached yet are read in batches"""
+        names = list(self)
+        for start in range(0, len(names), git.BATCH_SIZE):
+            chunk = [(name, self._find(name)) for name in names[start:start + git.BATCH_SIZE]]
+            decoded = self.snapshot._read([oid for name, (type, oid) in chunk if type != "tree"])
+            for name, (type, oid) in chunk:
+                yield name, self._child(name, type, oid, decoded)
+
+    def values(self):
+        for name, child in self.items():
+            yield child
+
+    def __repr__(self):
+        return "<{cls} {path!r} of {oid}>".format(
+            cls=type(self).__name__, path=self.path or "/", oid=self.snapshot.oid)
+
+
+class Snapshot(SnapshotFolder):
+    """
+    read-only view of the root as of ``commit``. reads the git objects
+    directly, without churro, acidfs or a transaction, so it is cheap to
+    make and safe to share between threads while others commit.
+
+    decoded objects and trees are kept in ``object_cache`` by oid, which
+    snapshots of any commit can share. objects are shared as well, they
+    must not be changed. ``db`` is the git directory, ``path_encoding``
+    the encoding of the names in its trees (AcidFS' by default).
+    """
+    def __init__(self, db, commit="HEAD", object_cache=None, codec=None, path_encoding=None):
+        self.db = db
+        self.repository = git.repository(db)
+        self.oid = _resolve_commit(db, commit)
+        if object_cache is None:
+            object_cache = ObjectCache()
+        self.object_cache = object_cache
+        if codec is None:
+            codec = churro.codec
+        self.codec = codec
+        if path_encoding is None:
+            path_encoding = "ascii"
+        self.path_encoding = path_encoding
+        super().__init__(self, self.oid, "")
+
+    def resolve(self, path):
+        """:return: the child at ``path`` (e.g. ``"a/b"``), raises KeyError"""
+        found = self
+        for name in path.strip("/").split("/"):
+            if name:
+                if not isinstance(found, SnapshotFolder):
+                    raise KeyError(path)
+                found = found[name]
+        return found
+
+    def _tree_entries(self, tree):
+        key = ("tree", tree, self.path_encoding)
+        entries = self.object_cache.get(key)
+        if entries is None:
+            entries = dict(
+                (name.decode(self.path_encoding), (type.decode("ascii"), oid))
+                for mode, type, oid, name in self.repository.tree(tree))
+            self.object_cache.put(key, entries)
+        return entries
+
+    def _object(self, oid):
+        obj = self.object_cache.get(oid, _missing)
+        if isinstance(obj, _BoundData):
+            # cached by a ChurroDb, as the object refers to its db
+            return self.codec.decode(io.StringIO(obj.data.decode("utf-8")))
+        if obj is _missing:
+            obj = self._read([oid])[oid]
+        return obj
+
+    def _read(self, oids):
+        """
+        decodes the objects ``oids`` which are not cached, in one pass.
+        :return: dict of the objects decoded
+        """
+        decoded = {}
+        pending = [oid for oid in oids if oid not in self.object_cache]
+        for oid, type, data in filter(None, self.repository.read_many(pending)):
+            obj = self.codec.decode(io.StringIO(data.decode("utf-8")))
+            decoded[oid] = self.object_cache.setdefault(oid, obj)
+        return decoded
+
+
+class ThreadedChurroDb(object):
+    """
+    a ChurroDb to share between threads. every thread works with a
+    ChurroDb of its own (:attr:`local`), made for its current transaction
+    (transaction's default manager is thread-local), so roots, loaded
+    folders and registered indexes are never shared. decoded objects are
+    shared by oid through one :class:`ObjectCache`, the git processes and
+    pack files through :func:`churrodb.git.repository`.
+
+    ``child_cache`` is a callable making a :class:`ChildCache` for each
+    thread's db. views are lazy by default, threads load the root items
+    they use only.
+    """
+    def __init__(
+            self, repo, head="HEAD", factory=None, object_cache=None,
+            child_cache=None, **kwargs):
+        self._path = repo
+        self._head = head
+        self._factory = factory
+        if object_cache is None:
+            object_cache = ObjectCache()
+        self.object_cache = object_cache
+        self._child_cache = child_cache
+        kwargs.setdefault("lazy", True)
+        self._kwargs = kwargs
+        self._local = threading.local()
+
+    @property
+    def local(self):
+        """the calling thread's ChurroDb, new with every transaction"""
+        current = transaction.get()
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.transaction is not current:
+            child_cache = self._child_cache() if self._child_cache else None
+            db = ChurroDb(
+                self._path, getattr(self._local, "head", self._head), self._factory,
+                object_cache=self.object_cache, child_cache=child_cache,
+                **self._kwargs)
+            self._local.db = db
+            self._local.transaction = current
+        return db
+
+    @property
+    def git_dir(self):
+        """the git directory of the repository, found as AcidFS finds it"""
+        git_dir = os.path.join(self._path, ".git")
+        if os.path.exists(git_dir):
+            return git_dir
+        return self._path
+
+    def snapshot(self, commit="HEAD"):
+        """
+        :return: a read-only :class:`Snapshot`, for threads which only read.
+        snapshots share their decoded objects through :attr:`object_cache`
+        and the git processes and packs through git.repository, threads
+        which only read make no ChurroDb
+        """
+        return Snapshot(
+            self.git_dir, commit, self.object_cache,
+            self._kwargs.get("codec"), self._kwargs.get("path_encoding"))
+
+    def switch(self, branch="HEAD"):
+        """
+        switches the calling thread's db, and the dbs made for its later
+        transactions, to ``branch``
+        """
+        self._local.head = branch
+        db = getattr(self._local, "db", None)
+        if db is not None and self._local.transaction is transaction.get():
+            db.switch(branch)
+
+    def save(self):
+        self.local.save()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.local, name)
+
+    def __iter__(self):
+        return iter(self.local)
+
+    def __len__(self):
+        return len(self.local)
+
+    def __getitem__(self, name):
+        return self.local[name]
+
+    def __setitem__(self, name, value):
+        self.local[name] = value
+
+    def __delitem__(self, name):
+        del self.local[name]
+
+    def __contains__(self, name):
+        return name in self.local
+
+
+class AsyncChurroDb(object):
+    """
+    asyncio front-end of a :class:`ThreadedChurroDb`, git I/O runs in
+    executors so that the event loop never blocks on it.
+
+    :meth:`transact` is the only way to write: it runs a change and its
+    commit as one unit in the one writer thread, where the writable view
+    and its transaction live, so that objects of the view never reach the
+    event loop. :meth:`get` and :meth:`snapshot` return read-only data as
+    of a commit. reads run in up to ``max_readers`` threads, concurrent
+    reads of one oid are done once.
+    """
+    def __init__(
+            self, repo, head="HEAD", factory=None, object_cache=None,
+            max_readers=4, **kwargs):
+        self.db = ThreadedChurroDb(repo, head, factory, object_cache, **kwargs)
+        self.object_cache = self.db.object_cache
+        self._writer = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix="churrodb-writer")
+        self._readers = concurrent.futures.ThreadPoolExecutor(
+            max_readers, thread_name_prefix="churrodb-reader")
+        self._reading = {}
+        self._branch = head
+
+    async def _run(self, executor, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    # the ThreadedChurroDb's attributes are the calling thread's, they have
+    # to be looked up in the executor's threads
+
+    async def get(self, name, default=None, commit=None):
+        """
+        the root item ``name`` as of ``commit`` (the branch switched to by
+        default), read-only: a :class:`SnapshotFolder` or a shared object,
+        see :meth:`snapshot`
+        """
+        snapshot = await self.snapshot(commit)
+        return await self._run(self._readers, lambda: snapshot.get(name, default))
+
+    async def switch(self, branch="HEAD"):
+        """switches the branch :meth:`transact` commits to and reads default to"""
+        await self._run(self._writer, lambda: self.db.switch(branch))
+        self._branch = branch
+
+    async def transact(self, func, *args):
+        """
+        runs ``func(db, *args)`` in a transaction of its own and commits it,
+        in the writer thread. ``func`` must not hand out the objects of
+        ``db``, they belong to its transaction. :return: what ``func``
+        returned
+        """
+        def transact():
+            transaction.begin()
+            try:
+                result = func(self.db, *args)
+            except BaseException:
+                transaction.abort()
+                raise
+            self.db.save()
+            return result
+        return await self._run(self._writer, transact)
+
+    async def object_by_hash(self, hashstr, text_mode=True):
+        """see :meth:`ChurroDb.object_by_hash`, objects are shared"""
+        cached = _missing
+        if git.is_oid(hashstr):
+            cached = self.object_cache.get(hashstr, _missing)
+            if _unbound(cached):
+                return cached
+        key = (hashstr, text_mode)
+        reading = self._reading.get(key)
+        if reading is None:
+            reading = self._reading[key] = asyncio.ensure_future(self._run(
+                self._readers,
+                lambda: self.db.local._object_by_hash(hashstr, text_mode, cached)))
+            reading.add_done_callback(lambda done: self._reading.pop(key, None))
+        # one cancelled caller must not cancel the read for the others
+        return await asyncio.shield(reading)
+
+    async def snapshot(self, commit=None):
+        """
+        :return: a read-only :class:`Snapshot` of ``commit``, the branch
+        switched to by default, see :meth:`read`
+        """
+        if commit is None:
+            commit = self._branch
+        return await self._run(self._readers, self.db.snapshot, commit)
+
+    async def read(self, func, *args):
+        """
+        runs the read-only ``func(*args)`` in a reader thread, for
+        reading snapshots, e.g. ``await adb.read(snapshot.resolve, path)``
+        """
+        return await self._run(self._readers, func, *args)
+
+    def close(self):
+        self._writer.shutdown()
+        self._readers.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
 class IndexUpdateError(Exception):
     pass
 
 
+def _duplicate_key(key, value_a, value_b):
+    return IndexUpdateError(
+        "duplicate key '{key}' for values '{value_a}' and '{value_b}'"
+        .format(key=key, value_a=value_a, value_b=value_b))
+
+
 class IndexesFolder(ChurroDbAware, IIndex, churro.PersistentFolder):
     def __init__(self, parent):
         parent["_index"] = self
@@ -321,8 +2315,33 @@ class IndexesFolder(ChurroDbAware, IIndex, churro.PersistentFolder):
 
         return found
 
-    def idx_update(self, data=None):
+    def idx_find_many(self, keys, subindex=None):
+        if subindex is not None:
+            if subindex not in self:
+                raise Exception("there is no index called '" + subindex + "'")
+            return self[subindex].idx_find_many(keys)
+
+        found = {}
+        pending = list(keys)
         for idx in self.values():
+            if not pending:
+                break
+            found.update(idx.idx_find_many(pending))
+            pending = [key for key in pending if key not in found]
+
+        return found
+
+    def idx_update(self, data=None):
+        indexes = list(self.values())
+        if data is not None and getattr(data, "changed", None) is None\
+                and not isinstance(data, RebuildSet):
+            # a full rebuild, every member index sees the same items
+            db = self.churrodb
+            hashed = any(isinstance(idx, GitObjectHashIndexMixin) for idx in indexes)
+            data = RebuildSet(
+                data, db if hashed else None, getattr(db, "index_workers", None))
+
+        for idx in indexes:
             idx.idx_update(data)
 
     def idx_validate(self):
@@ -333,6 +2352,11 @@ class IndexesFolder(ChurroDbAware, IIndex, churro.PersistentFolder):
     def idx(self):
         return self
 
+    def _registrable_items(self):
+        # all member indexes are loaded, so that named indexes are known
+        # to the db before anyone asks for them as supply index
+        return self.items()
+
     def by_name(self, name):
         for index in self.values():
             if isinstance(index, IIndex) and getattr(index, "name", "") == name:
@@ -345,6 +2369,8 @@ class AbstractDictIndex(ChurroDbAware, IIndex, churro.PersistentDict):
         found.extend(self.get(key, []))
         return found
 
+    idx_find_many = idx_find_many
+
     def idx_update(self, data=None):
         pass
 
@@ -380,6 +2406,190 @@ class DotLookupDictProxy(collections.abc.Mapping):
         return self._dict.__len__()
 
 
+class ChangeSet(collections.abc.Mapping):
+    """
+    mapping proxy for an indexed collection which additionally knows the
+    names of the items added, changed or removed in the current transaction.
+
+    ``changed`` maps item names to the git oid they had before the
+    transaction (``None`` for new items). indexes which are able to update
+    incrementally only look at :meth:`changes`, all others see the whole
+    collection.
+    """
+    def __init__(self, obj, changed):
+        self._obj = obj
+        self.changed = changed
+
+    def __getitem__(self, key):
+        return self._obj.__getitem__(key)
+
+    def __iter__(self):
+        return self._obj.__iter__()
+
+    def __len__(self):
+        return self._obj.__len__()
+
+    def changes(self):
+        """yields (name, value, previous oid) for every changed item still present"""
+        for name, previous in sorted(self.changed.items()):
+            value = self._obj.get(name, _missing)
+            if value is not _missing:
+                yield name, value, previous
+
+
+class RebuildSet(collections.abc.Mapping):
+    """
+    mapping proxy for an indexed collection which is rebuilt by several
+    indexes. every item is read once and kept until the rebuild is done.
+
+    given the ``db``, the git oids of the items are taken from a single
+    listing of the collection's tree, instead of being looked up item by
+    item by every hash index. given ``workers``, that many threads read the
+    items from git ahead of decoding them. nothing is read before an index
+    asks for it, hash indexes with a checkpoint may not.
+    """
+    changed = None
+
+    def __init__(self, obj, db=None, workers=None):
+        self._obj = obj
+        self._db = db
+        self.workers = workers
+        self._hashes = None
+        self._loaded = None
+
+    @property
+    def hashes(self):
+        if self._hashes is None:
+            self._hashes = self._read_hashes(self._db) if self._db is not None else {}
+        return self._hashes
+
+    @property
+    def _items(self):
+        if self._loaded is None:
+            self._loaded = collections.OrderedDict(self._read())
+        return self._loaded
+
+    def __getitem__(self, key):
+        return self._items.__getitem__(key)
+
+    def __iter__(self):
+        return self._items.__iter__()
+
+    def __len__(self):
+        return self._items.__len__()
+
+    def object_hash(self, db, value):
+        """:return: the git oid of the file of ``value``"""
+        if getattr(value, "__parent__", None) is self._obj and not isinstance(value, IIndex):
+            found = self.hashes.get(value.__name__)
+            if found is not None:
+                return found
+        return GitObjectHashIndexMixin._hash(db, value)
+
+    def _read_hashes(self, db):
+        """
+        :return: dict of the oids of the files of the children which are
+        objects. folders may change while the indexes are written
+        """
+        folder = self._obj
+        if not isinstance(folder, churro.PersistentFolder) or folder._fs is None:
+            return {}
+
+        db.flush()
+        fs = folder._fs
+        path = churro.resource_path(folder)
+        if not fs.isdir(path):
+            return {}
+
+        hashes = {}
+        for mode, type, oid, name in git.repository(fs.db).tree(fs.hash(path)):
+            name = name.decode(fs.path_encoding)
+            if type == b"blob" and name.endswith(churro.CHURRO_EXT)\
+                    and name != churro.CHURRO_FOLDER:
+                hashes[name[:-len(churro.CHURRO_EXT)]] = oid
+        return hashes
+
+    def _read(self):
+        folder = self._obj
+        if not self.hashes:
+            return list(folder.items())
+
+        # like PersistentFolder.items, but the oids are known already
+        contents = folder._filtered_contents
+        names = list(contents)
+        repo = git.repository(folder._fs.db)
+        items = []
+        reads = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(self.workers or 1) as pool:
+            for start in range(0, len(names), git.BATCH_SIZE):
+                chunk = names[start:start + git.BATCH_SIZE]
+                oids = [
+                    self.hashes[name] for name in chunk
+                    if contents[name][1] is None and name in self.hashes]
+                if self.workers:
+                    found = pool.submit(repo.read_many, oids)
+                else:
+                    found = None
+                reads.append((chunk, oids, found))
+                if len(reads) > (self.workers or 0):
+                    items.extend(self._decode(folder, repo, contents, *reads.popleft()))
+            while reads:
+                items.extend(self._decode(folder, repo, contents, *reads.popleft()))
+        return items
+
+    @staticmethod
+    def _decode(folder, repo, contents, chunk, oids, found):
+        repo.prefetch(oids, found.result() if found is not None else None)
+        for name in chunk:
+            type, obj = contents[name]
+            if obj is None:
+                obj = folder._load(name, type)
+            else:
+                _touch(folder, name)
+            yield name, obj
+
+
+def _fs_hash(fs, path):
+    """:return: the oid of ``path`` as str, acidfs has bytes for trees saved in between"""
+    oid = fs.hash(path)
+    return oid.decode("ascii") if isinstance(oid, bytes) else oid
+
+
+def _indexed_folder(data):
+    """
+    :return: the folder behind the ``data`` an index is updated with, None
+    if the index keys depend on the items (see :class:`GitObjectProxy`)
+    """
+    while not isinstance(data, churro.PersistentFolder):
+        if getattr(data, "_key_mapper", None) is not None or not hasattr(data, "_obj"):
+            return None
+        data = data._obj
+    return data
+
+
+def _folder_tree(folder):
+    """:return: the git tree oid of ``folder`` as flushed, None if unknown"""
+    fs = getattr(folder, "_fs", None)
+    if fs is None:
+        return None
+    path = churro.resource_path(folder)
+    if not fs.isdir(path):
+        return None
+    return _fs_hash(fs, path)
+
+
+def _tree_items(repo, tree, path_encoding):
+    """:return: dict of the oids of the items of a folder's ``tree`` by name"""
+    items = {}
+    for mode, type, oid, name in repo.tree(tree):
+        name = name.decode(path_encoding)
+        if type == b"tree":
+            items[name] = oid
+        elif name.endswith(churro.CHURRO_EXT) and name != churro.CHURRO_FOLDER:
+            items[name[:-len(churro.CHURRO_EXT)]] = oid
+    return items
+
+
 class GitObjectProxy(collections.abc.Mapping, collections.abc.Iterator):
     def __init__(self, obj, key_mapper=None):
         assert hasattr(obj, "__getitem__")
@@ -390,6 +2600,8 @@ class GitObjectProxy(collections.abc.Mapping, collections.abc.Iterator):
         self._iterator = None
         self._dict = {}
         self._key_mapper = key_mapper
+        self.changed = getattr(obj, "changed", None)
+        self.object_hash = getattr(obj, "object_hash", None)
 
     def __getitem__(self, key):
         return self._dict.__getitem__(key)
@@ -399,22 +2611,33 @@ class GitObjectProxy(collections.abc.Mapping, collections.abc.Iterator):
         while key is None:
             key = self._iterator.__next__()
             value = self._obj.__getitem__(key)
-            if self._key_mapper is not None:
-                if hasattr(value, "__getitem__")\
-                        and hasattr(value, "__iter__")\
-                        and hasattr(value, "__len__"):
-                    proxy_value = DotLookupDictProxy(value)
-                else:
-                    proxy_value = value
-
-                if hasattr(self._key_mapper, "__func__"):
-                    key = self._key_mapper.__func__(key, proxy_value)
-                else:
-                    key = self._key_mapper(key, proxy_value)
+            key = self._map_key(key, value)
 
         self._dict[key] = value
         return key
 
+    def _map_key(self, key, value):
+        if self._key_mapper is None:
+            return key
+
+        if hasattr(value, "__getitem__")\
+                and hasattr(value, "__iter__")\
+                and hasattr(value, "__len__"):
+            proxy_value = DotLookupDictProxy(value)
+        else:
+            proxy_value = value
+
+        if hasattr(self._key_mapper, "__func__"):
+            return self._key_mapper.__func__(key, proxy_value)
+        return self._key_mapper(key, proxy_value)
+
+    def changes(self):
+        for key, value, previous in self._obj.changes():
+            key = self._map_key(key, value)
+            if key is not None:
+                self._dict[key] = value
+                yield key, value, previous
+
     def __iter__(self):
         self._iterator = self._obj.__iter__()
         return self
@@ -423,12 +2646,29 @@ class GitObjectProxy(collections.abc.Mapping, collections.abc.Iterator):
         return self._obj.__len__()
 
 
-class GitObjectHashIndex(AbstractDictIndex):
+class GitObjectHashIndexMixin(ChurroDbAware, IIndex, metaclass=churro.PersistentType):
+    """
+    maps the names of the items of a collection to the git oids of their
+    files (or the other way round, if ``inverse``). entries are kept in the
+    index itself, entries supplied by other indexes in :attr:`auxiliary`.
+
+    :attr:`trees` keeps the git tree oid of the collection as of the last
+    update, by namespace (``""`` for the index's own entries). updates diff
+    it against the current tree, so that only the entries of items whose
+    files changed are touched, and nothing is done if none did.
+
+    keys held by several namespaces are found in the one created first,
+    :attr:`namespace_ranks` keeps the order of creation.
+    """
     _inverse = churro.PersistentProperty()
     name = churro.PersistentProperty()
     supply = churro.PersistentProperty()
-    auxiliary = churro.PersistentProperty()
     clear_before_update = churro.PersistentProperty()
+    trees = churro.PersistentProperty()
+    namespace_ranks = churro.PersistentProperty()
+    # concurrent updates checkpoint different trees, a merged index gets
+    # its checkpoint from its next update
+    merge_dropped = ("trees",)
 
     def __init__(
             self, inverse=False, clear_before_update=False,
@@ -438,7 +2678,6 @@ class GitObjectHashIndex(AbstractDictIndex):
         self.name = name
         self.supply = supply
         self.clear_before_update = clear_before_update
-        self.auxiliary = churro.PersistentDict()
         super().__init__()
 
     def __new__(cls, *args, **kwargs):
@@ -448,6 +2687,8 @@ class GitObjectHashIndex(AbstractDictIndex):
 
     @property
     def churrodb(self):
+        if self._db is None:
+            self.churrodb = _inherited_churrodb(self)
         return self._db
 
     @churrodb.setter
@@ -463,7 +2704,7 @@ class GitObjectHashIndex(AbstractDictIndex):
         if self.supply is not None:
             if self.name is None:
                 raise Exception("must provide name for this sub-index")
-            return self.churrodb.named_indexes[self.supply]
+            return self.churrodb.named_index(self.supply)
         return None
 
     def idx_update(self, data=None, namespace=None):
@@ -479,47 +2720,280 @@ class GitObjectHashIndex(AbstractDictIndex):
 
         if namespace is not None:
             if namespace not in self.auxiliary:
-                self.auxiliary[namespace] = churro.PersistentDict()
+                self._rank_namespace(namespace)
+                self.auxiliary[namespace] = self._new_namespace()
             target = self.auxiliary[namespace]
         else:
             target = self
 
         if self.clear_before_update:
             target.clear()
+            self._idx_rebuild(db, target, data, namespace)
+            if namespace is not None:
+                self._prune_namespace(namespace, target)
+            return
 
-        seen_keys = []
+        folder = _indexed_folder(data)
+        tree = _folder_tree(folder)
+        previous = (self.trees or {}).get(namespace or "")
+        if tree is not None and tree == previous:
+            log.debug("tree of git object hash index (%s) unchanged", self)
+            return
 
-        log.info("building git object hash index (" + str(self) + ")...")
+        changed = None
+        if previous is None and not target:
+            # never built, e.g. added to a collection which has items
+            # already, the changes of this transaction are not all of them
+            self._idx_rebuild(db, target, data, namespace)
+            changed = True
+        elif previous is not None and tree is not None:
+            changed = self._idx_update_tree(db, target, folder, previous, tree, namespace)
+            if changed is False:
+                log.debug("items of git object hash index (%s) unchanged", self)
+                return
+
+        if changed is None:
+            if getattr(data, "changed", None) is None:
+                self._idx_rebuild(db, target, data, namespace)
+            elif not self._idx_update_changes(db, target, data, namespace):
+                log.info(
+                    "changes collide with existing entries of git object hash index "
+                    "(%s), falling back to full rebuild...", self)
+                self._idx_rebuild(db, target, data, namespace)
+
+        if tree is not None:
+            trees = dict(self.trees or {})
+            trees[namespace or ""] = tree
+            self.trees = trees
+
+    def _idx_rebuild(self, db, target, data, namespace=None):
+        entries = {}
+        hash = getattr(data, "object_hash", None) or self._hash
+
+        log.info("building git object hash index (%s)...", self)
         for key, value in data.items():
-            resource_path = churro.resource_path(value)
-            if not db.fs.isdir(resource_path):
-                resource_path += churro.CHURRO_EXT
+            target_key, target_value = self._entry(key, hash(db, value))
+
+            if target_key in entries:
+                raise _duplicate_key(target_key, entries[target_key], target_value)
+
+            entries[target_key] = target_value
+
+        self._write(target, entries, namespace)
+
+    def _idx_update_changes(self, db, target, data, namespace=None):
+        """
+        rehashes only the items changed in the current transaction. entries of
+        removed items are kept, just like a full rebuild without
+        ``clear_before_update`` keeps them.
+
+        :return: False if an entry collides with an existing entry which may
+        belong to another item, which only a full rebuild can tell
+        """
+        updates = {}
+
+        log.info("updating git object hash index (%s)...", self)
+        for key, value, previous in data.changes():
+            target_key, target_value = self._entry(key, self._hash(db, value))
+
+            if target_key in updates:
+                raise _duplicate_key(target_key, updates[target_key], target_value)
+
+            current = target.get(target_key)
+            if current is not None and current != target_value:
+                # the entry of the folder holding this index is outdated
+                # by definition, every other entry must match the oid
+                # the item had before this transaction
+                if self._inverse or (current != previous and not self._holds_index(value)):
+                    return False
 
-            hash = db.fs.hash(resource_path)
+            updates[target_key] = target_value
 
-            if self._inverse:
-                target_key = hash
-                target_value = key
+        if updates:
+            self._write(target, updates, namespace)
+        return True
+
+    def _idx_update_tree(self, db, target, folder, previous, tree, namespace=None):
+        """
+        updates the entries of the items whose files differ between the
+        trees ``previous`` and ``tree`` of ``folder``, which are all it
+        takes to know their oids. entries of removed items are kept, just
+        like a full rebuild keeps them.
+
+        :return: None if the previous tree is gone, or an entry is not
+        what the previous tree says, which only a full rebuild can tell.
+        otherwise whether any item changed, besides the one holding this
+        index
+        """
+        repo = git.repository(db.fs.db)
+        try:
+            old = _tree_items(repo, previous, db.fs.path_encoding)
+        except KeyError:
+            return None
+        new = _tree_items(repo, tree, db.fs.path_encoding)
+
+        # the entry of the item holding this index is outdated by definition
+        holder = self
+        while holder is not None and holder.__parent__ is not folder:
+            holder = holder.__parent__
+        held = getattr(holder, "__name__", None)
+        if all(old.get(name) == new.get(name) for name in set(old) | set(new) if name != held):
+            return False
+
+        updates = {}
+        log.info("updating git object hash index (%s) from tree changes...", self)
+        for name, oid in new.items():
+            if name == held or old.get(name) == oid:
+                continue
+            target_key, target_value = self._entry(name, oid)
+
+            if target_key in updates:
+                raise _duplicate_key(target_key, updates[target_key], target_value)
+
+            current = target.get(target_key)
+            if current is not None and current != target_value:
+                if self._inverse or current != old.get(name):
+                    return None
+
+            updates[target_key] = target_value
+
+        if updates:
+            self._write(target, updates, namespace)
+        return True
+
+    def _write(self, target, entries, namespace):
+        target.update(entries)
+        if namespace is not None:
+            self._map_namespace(namespace, entries)
+
+    def _map_namespace(self, namespace, keys):
+        """
+        records ``namespace`` as where to find ``keys``, unless a namespace
+        which comes first in :attr:`auxiliary` holds them as well
+        """
+        namespaces = self._namespaces(create=True)
+        ranks = dict((name, rank) for rank, name in enumerate(self._ranked_namespaces()))
+        rank = ranks[namespace]
+        updates = {}
+        for key in keys:
+            current = namespaces.get(key)
+            if current == namespace:
+                continue
+            if current in ranks and ranks[current] < rank\
+                    and self.auxiliary[current].get(key) is not None:
+                continue
+            updates[key] = namespace
+        if updates:
+            namespaces.update(updates)
+
+    def _prune_namespace(self, namespace, target):
+        """
+        maps the keys of ``namespace`` which ``target``, its rebuilt
+        entries, doesn't hold to the next namespace holding them, or drops
+        them, so that lookups never scan all namespaces for them
+        """
+        namespaces = self._namespaces(create=True)
+        removed = [
+            key for key, current in namespaces.items()
+            if current == namespace and target.get(key) is None]
+        if not removed:
+            return
+        others = [name for name in self._ranked_namespaces() if name != namespace]
+        for key in removed:
+            for name in others:
+                if self.auxiliary[name].get(key) is not None:
+                    namespaces[key] = name
+                    break
             else:
-                target_key = key
-                target_value = hash
+                del namespaces[key]
 
-            if target_key in seen_keys:
-                raise IndexUpdateError(
-                    "duplicate key '{key}' for values '{value_a}' and '{value_b}'l"
-                        .format(key=target_key, value_a=target[target_key], value_b=target_value))
+    def _rank_namespace(self, namespace):
+        """ranks ``namespace``, about to be created, after all others"""
+        ranks = dict(self.namespace_ranks or {})
+        for name in self._ranked_namespaces() + [namespace]:
+            if name not in ranks:
+                ranks[name] = max(ranks.values(), default=-1) + 1
+        self.namespace_ranks = ranks
 
-            seen_keys.append(target_key)
-            target[target_key] = target_value
+    def _ranked_namespaces(self):
+        """
+        :return: the names of the auxiliary namespaces, in the order they
+        were created. namespaces of indexes written before
+        :attr:`namespace_ranks` existed come last, by name
+        """
+        ranks = self.namespace_ranks or {}
+        return sorted(
+            self.auxiliary.keys(),
+            key=lambda name: (name not in ranks, ranks.get(name, 0), name))
+
+    def _scan_namespaces(self):
+        """:return: dict of the first namespace holding each auxiliary key"""
+        namespaces = {}
+        for namespace in self._ranked_namespaces():
+            for key in self.auxiliary[namespace].keys():
+                namespaces.setdefault(key, namespace)
+        return namespaces
+
+    def _namespaces(self, create=False):
+        """
+        :return: mapping of the keys of all auxiliary namespaces to the
+        namespace. storages which keep the mapping override this, and only
+        write it with ``create`` so that lookups leave the index clean
+        """
+        return self._scan_namespaces()
+
+    def idx_merge(self, changes, load, tree, dropped=()):
+        """
+        updates the entries of an index merged with a concurrent commit for
+        the items of its collection which the merge changed. ``changes``
+        are (name, oid before, oid after) tuples, ``load`` decodes an oid
+        and ``tree`` is the merged tree of the collection. entries of the
+        oids ``dropped``, replaced by the merge and never committed, are
+        removed.
+        """
+        if self.supply is not None:
+            # the entries are kept by the supplied index
+            return
+        for name, previous, oid in changes:
+            if previous is not None and (
+                    previous in dropped or (oid is None and self.clear_before_update)):
+                key, value = self._entry(name, previous)
+                if self.get(key) == value:
+                    self.pop(key)
+            if oid is not None:
+                key, value = self._entry(name, oid)
+                self[key] = value
+        if tree is not None:
+            trees = dict(self.trees or {})
+            trees[""] = tree
+            self.trees = trees
+
+    def _entry(self, key, hash):
+        if self._inverse:
+            return hash, key
+        return key, hash
+
+    def _holds_index(self, obj):
+        node = self
+        while node is not None:
+            if node is obj:
+                return True
+            node = node.__parent__
+        return False
+
+    @staticmethod
+    def _hash(db, value):
+        resource_path = churro.resource_path(value)
+        if not db.fs.isdir(resource_path):
+            resource_path += churro.CHURRO_EXT
+
+        return _fs_hash(db.fs, resource_path)
 
     def idx_find(self, key, subindex=None):
         found = self.get(key)
 
-        if found is None:
-            for k, v in self.auxiliary.items():
-                found = v.get(key)
-                if found is not None:
-                    break
+        if found is None and len(self.auxiliary) > 0:
+            found = self._find_auxiliary(key)
 
         if found is None:
             return []
@@ -528,11 +3002,233 @@ class GitObjectHashIndex(AbstractDictIndex):
 
     idx_find_first = idx_find_first
 
+    def idx_find_many(self, keys, subindex=None):
+        found = {}
+        pending = collections.defaultdict(list)
+        namespaces = self._namespaces() if len(self.auxiliary) > 0 else {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+                continue
+            namespace = namespaces.get(key)
+            if namespace is not None:
+                pending[namespace].append(key)
+
+        for namespace, namespace_keys in pending.items():
+            subindex = self.auxiliary.get(namespace)
+            for key in namespace_keys:
+                value = subindex.get(key) if subindex is not None else None
+                if value is None:
+                    value = self._scan_auxiliary(key)
+                if value is not None:
+                    found[key] = value
+
+        return found
+
+    def _find_auxiliary(self, key):
+        namespace = self._namespaces().get(key)
+        if namespace is None:
+            return None
+        subindex = self.auxiliary.get(namespace)
+        found = subindex.get(key) if subindex is not None else None
+        if found is None:
+            # the namespace was cleared since, the key may be elsewhere
+            found = self._scan_auxiliary(key)
+        return found
+
+    def _scan_auxiliary(self, key):
+        for namespace in self._ranked_namespaces():
+            found = self.auxiliary[namespace].get(key)
+            if found is not None:
+                return found
+        return None
+
+    def idx_validate(self):
+        pass
+
+    @property
+    def idx(self):
+        return self
+
     def by_name(self, name):
+        subindex = self.auxiliary.get(name)
+        if subindex is not None:
+            return subindex
         for key, subindex in self.auxiliary.items():
             if key.startswith(name):
                 return subindex
 
+    def _new_namespace(self):
+        """:return: an empty namespace for :attr:`auxiliary`"""
+        return churro.PersistentDict()
+
+
+class GitObjectHashIndex(GitObjectHashIndexMixin, AbstractDictIndex):
+    """hash index stored as a single file"""
+    auxiliary = churro.PersistentProperty()
+    namespace_keys = churro.PersistentProperty()
+    # properties a merge takes from ours and updates with idx_merge
+    merge_derived = ("data",)
+
+    def __init__(self, *args, **kwargs):
+        self.auxiliary = churro.PersistentDict()
+        super().__init__(*args, **kwargs)
+
+    def _namespaces(self, create=False):
+        if self.namespace_keys is None:
+            # indexes written before namespace_keys existed get it with
+            # their next update
+            namespaces = self._scan_namespaces()
+            if not create:
+                return namespaces
+            self.namespace_keys = churro.PersistentDict(namespaces)
+        return self.namespace_keys
+
+
+class ShardedDict(churro.PersistentFolder):
+    """
+    dict stored as a folder of ``churro.PersistentDict`` shards. keys are
+    bucketed by the first ``shard_digits`` hex digits of their sha1, so a
+    lookup decodes one shard and a change rewrites only the shards touched.
+    keys are expected to be strings, like those of any JSON object.
+    """
+    shard_digits = churro.PersistentProperty()
+
+    def __init__(self, data=None, shard_digits=2):
+        self.shard_digits = shard_digits
+        if data:
+            self.update(data)
+
+    def shard_name(self, key):
+        return hashlib.sha1(str(key).encode("utf-8")).hexdigest()[:self.shard_digits]
+
+    def _shard(self, key, create=False):
+        name = self.shard_name(key)
+        shard = churro.PersistentFolder.get(self, name)
+        if shard is None and create:
+            shard = churro.PersistentDict()
+            churro.PersistentFolder.__setitem__(self, name, shard)
+        return shard
+
+    def _shard_names(self):
+        return [
+            name for name, (type, obj) in self._filtered_contents.items()
+            if type == "object"]
+
+    def shards(self):
+        """yields the shards, loading each of them"""
+        for name in self._shard_names():
+            yield churro.PersistentFolder.get(self, name)
+
+    def get(self, key, default=None):
+        shard = self._shard(key)
+        if shard is None:
+            return default
+        return shard.get(key, default)
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __setitem__(self, key, value):
+        self._shard(key, create=True)[key] = value
+
+    def __delitem__(self, key):
+        shard = self._shard(key)
+        if shard is None or key not in shard:
+            raise KeyError(key)
+        del shard[key]
+        if not shard:
+            churro.PersistentFolder.__delitem__(self, self.shard_name(key))
+
+    remove = __delitem__
+
+    def pop(self, key, *args):
+        try:
+            value = self[key]
+        except KeyError:
+            if args:
+                return args[0]
+            raise
+        del self[key]
+        return value
+
+    def update(self, entries):
+        shards = collections.defaultdict(dict)
+        for key, value in entries.items():
+            shards[self.shard_name(key)][key] = value
+        for name, shard_entries in shards.items():
+            shard = churro.PersistentFolder.get(self, name)
+            if shard is None:
+                churro.PersistentFolder.__setitem__(
+                    self, name, churro.PersistentDict(shard_entries))
+            else:
+                shard.update(shard_entries)
+
+    def clear(self):
+        for name in self._shard_names():
+            churro.PersistentFolder.__delitem__(self, name)
+
+    def keys(self):
+        for shard in self.shards():
+            yield from shard.keys()
+
+    __iter__ = keys
+
+    def values(self):
+        for shard in self.shards():
+            yield from shard.values()
+
+    def items(self):
+        for shard in self.shards():
+            yield from shard.items()
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards())
+
+    def __bool__(self):
+        # shards are removed once they are emptied
+        return bool(self._shard_names())
+
+
+class ShardedGitObjectHashIndex(GitObjectHashIndexMixin, ShardedDict):
+    """
+    hash index stored as a :class:`ShardedDict`, for collections too large
+    to rewrite the whole index on every commit. namespaces supplied by other
+    indexes are sharded dicts in the ``_auxiliary`` subfolder.
+    """
+    def __init__(self, *args, shard_digits=2, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shard_digits = shard_digits
+        churro.PersistentFolder.__setitem__(
+            self, "_auxiliary", churro.PersistentFolder())
+
+    @property
+    def auxiliary(self):
+        return churro.PersistentFolder.get(self, "_auxiliary")
+
+    def _new_namespace(self):
+        return ShardedDict(shard_digits=self.shard_digits)
+
+    @property
+    def namespace_keys(self):
+        return self._namespaces()
+
+    def _namespaces(self, create=False):
+        namespaces = churro.PersistentFolder.get(self, "_namespace_keys")
+        if namespaces is None:
+            if not create:
+                return self._scan_namespaces()
+            namespaces = ShardedDict(self._scan_namespaces(), shard_digits=self.shard_digits)
+            churro.PersistentFolder.__setitem__(self, "_namespace_keys", namespaces)
+        return namespaces
+
 
 class GitDictKeyHashIndex(GitObjectHashIndex):
     dict_key = churro.PersistentProperty()
@@ -558,23 +3254,532 @@ class GitDictKeyHashIndex(GitObjectHashIndex):
     def idx_update(self, data=None):
         super().idx_update(GitObjectProxy(data, self.git_index_key_mapper))
 
+    def idx_merge(self, changes, load, tree, dropped=()):
+        keyed = []
+        for name, previous, oid in changes:
+            if previous is not None and (previous in dropped or self.clear_before_update):
+                document = load(previous)
+                key = None if document is None else self.git_index_key_mapper(name, document)
+                if key is not None:
+                    keyed.append((key, previous, None))
+            document = None if oid is None else load(oid)
+            key = None if document is None else self.git_index_key_mapper(name, document)
+            if key is not None:
+                keyed.append((key, None, oid))
+        # keys depend on the documents, there is no tree to checkpoint
+        super().idx_merge(keyed, load, None, dropped)
+
+
+class Range(object):
+    """
+    predicate for :meth:`FieldIndex.idx_find`, matches values between
+    ``low`` and ``high``. either bound may be ``None`` for an open range.
+    """
+    def __init__(self, low=None, high=None, low_inclusive=True, high_inclusive=True):
+        self.low = low
+        self.high = high
+        self.low_inclusive = low_inclusive
+        self.high_inclusive = high_inclusive
+
+    def matches(self, value):
+        rank = _sort_rank(value)
+        for bound in (self.low, self.high):
+            if bound is not None and _sort_rank(bound) != rank:
+                return False
+        if self.low is not None:
+            if value < self.low or (value == self.low and not self.low_inclusive):
+                return False
+        if self.high is not None:
+            if value > self.high or (value == self.high and not self.high_inclusive):
+                return False
+        return True
+
+    def __repr__(self):
+        return "Range({low!r}, {high!r})".format(low=self.low, high=self.high)
+
+
+class Prefix(object):
+    """predicate for :meth:`FieldIndex.idx_find`, matches strings starting with ``prefix``"""
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def matches(self, value):
+        return isinstance(value, str) and value.startswith(self.prefix)
+
+    def __repr__(self):
+        return "Prefix({prefix!r})".format(prefix=self.prefix)
+
+
+def _field_value(obj, field):
+    """
+    resolves the dotted ``field`` on a document, mappings by key, other
+    objects by attribute. :return: ``_missing`` if there is no such field
+    """
+    if isinstance(obj, churro.PersistentFolder):
+        return _missing
+    if hasattr(obj, "__getitem__") and hasattr(obj, "__iter__") and hasattr(obj, "__len__"):
+        try:
+            return DotLookupDictProxy(obj)[field]
+        except (KeyError, IndexError, TypeError):
+            return _missing
+
+    for name in field.split("."):
+        obj = getattr(obj, name, _missing)
+        if obj is _missing:
+            return _missing
+    return obj
+
+
+def _canonical(value):
+    """numbers equal in value are one value, e.g. ``1.0`` is ``1``"""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, _canonical(item)) for key, item in value.items())
+    return value
+
+
+def _encode_value(value):
+    """the key of ``value`` in a :class:`FieldIndex`, equal for equal values, see _equal"""
+    return json.dumps(_canonical(value), sort_keys=True, default=churro.codec.encode_hook)
+
+
+def _equal(value, other):
+    """
+    the equality of all query paths: numbers are equal by value, booleans
+    and None are not numbers, other values are equal by their index key
+    """
+    rank = _sort_rank(value)
+    if rank is not None or _sort_rank(other) is not None:
+        return rank == _sort_rank(other) and value == other
+    return _encode_value(value) == _encode_value(other)
+
+
+def _sort_rank(value):
+    """values of different rank are not comparable, they sort by rank"""
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    return None
+
+
+class FieldIndex(AbstractDictIndex):
+    """
+    maps the values of the dotted ``field`` of the documents of a collection
+    to the names of the documents. ``idx_find`` takes a value, a
+    :class:`Range` or a :class:`Prefix`. updated incrementally on commit,
+    only documents changed in the transaction are looked at, once the index
+    has been built from the whole collection.
+    """
+    field = churro.PersistentProperty()
+    documents = churro.PersistentProperty()
+    built = churro.PersistentProperty()
+    # properties a merge takes from ours and updates with idx_merge
+    merge_derived = ("data", "documents")
+
+    def __init__(self, field):
+        self.field = field
+        self.documents = churro.PersistentDict()
+        super().__init__()
+
+    def idx_update(self, data=None):
+        if data is None:
+            return
+
+        changed = getattr(data, "changed", None)
+        if changed is None or not (self.built or self.documents):
+            # also when added to a collection which has documents already,
+            # the changes of this transaction are not all of them
+            self._idx_clear()
+            values = {}
+            for name, document in data.items():
+                value = _field_value(document, self.field)
+                if value is not _missing:
+                    values[name] = value
+            self.documents.update(dict(
+                (name, _encode_value(value)) for name, value in values.items()))
+            self._idx_build(values)
+            self.built = True
+            return
+
+        for name in sorted(changed):
+            self._idx_change(name, data.get(name))
+
+    def idx_merge(self, changes, load, tree, dropped=()):
+        """see :meth:`GitObjectHashIndexMixin.idx_merge`"""
+        for name, previous, oid in changes:
+            self._idx_change(name, None if oid is None else load(oid))
+
+    def _idx_change(self, name, document):
+        previous = self.documents.get(name)
+        if previous is not None:
+            del self.documents[name]
+            self._idx_remove(name, json.loads(previous))
+        value = _field_value(document, self.field)
+        if value is not _missing:
+            self.documents[name] = _encode_value(value)
+            self._idx_add(name, value)
+
+    def idx_find(self, key, subindex=None):
+        if hasattr(key, "matches"):
+            found = []
+            for value, names in self.items():
+                if key.matches(json.loads(value)):
+                    found.extend(names)
+            return sorted(found)
+        return list(self.get(_encode_value(key), []))
+
+    def idx_estimate(self, key):
+        """
+        :return: upper bound of the number of documents :meth:`idx_find`
+        returns for ``key``, used to pick the index to answer a query with
+        """
+        if hasattr(key, "matches"):
+            return len(self.documents)
+        return len(self.get(_encode_value(key), []))
+
+    def _idx_clear(self):
+        self.clear()
+        self.documents.clear()
+
+    def _idx_build(self, values):
+        postings = collections.defaultdict(list)
+        for name, value in sorted(values.items()):
+            postings[_encode_value(value)].append(name)
+        self.update(postings)
+
+    def _idx_add(self, name, value):
+        key = _encode_value(value)
+        names = self.get(key, [])
+        if name not in names:
+            self[key] = sorted(names + [name])
+
+    def _idx_remove(self, name, value):
+        key = _encode_value(value)
+        names = [other for other in self.get(key, []) if other != name]
+        if names:
+            self[key] = names
+        elif key in self:
+            del self[key]
+
+
+# sorts after every name, to bound ranges of entries
+_last_name = chr(0x10ffff)
+
+
+def _bisect_pages(pages, entry):
+    """:return: the index of the page ``entry`` belongs to"""
+    lo, hi = 0, len(pages)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if pages[mid][0] <= entry:
+            lo = mid + 1
+        else:
+            hi = mid
+    return max(lo - 1, 0)
+
+
+class SortedFieldIndex(FieldIndex):
+    """
+    :class:`FieldIndex` keeping (value, name) entries sorted in pages of at
+    most ``page_size`` entries, like the leaves of a B-tree. ranges and
+    prefixes are answered by a binary search and a scan of the matching
+    entries only. values which are not numbers, strings, booleans or None
+    are not indexed.
+    """
+    page_size = 512
+    pages = churro.PersistentProperty()
+    merge_derived = FieldIndex.merge_derived + ("pages",)
+
+    def __init__(self, field):
+        self.pages = []
+        super().__init__(field)
+
+    def idx_find(self, key, subindex=None):
+        if isinstance(key, Range):
+            ranks = set(_sort_rank(bound) for bound in (key.low, key.high) if bound is not None)
+            if not ranks:
+                return [entry[2] for page in self.pages for entry in page]
+            if len(ranks) > 1 or None in ranks:
+                return []
+            rank = ranks.pop()
+            start = [rank] if key.low is None else [rank, key.low]
+            match = key.matches
+
+            def stop(value):
+                return key.high is not None and (
+                    value > key.high or (value == key.high and not key.high_inclusive))
+        elif isinstance(key, Prefix):
+            rank = _sort_rank(key.prefix)
+            start = [rank, key.prefix]
+            match = key.matches
+
+            def stop(value):
+                return not value.startswith(key.prefix)
+        else:
+            rank = _sort_rank(key)
+            if rank is None:
+                # not in the pages, e.g. lists
+                encoded = _encode_value(key)
+                return [name for name, value in sorted(self.documents.items()) if value == encoded]
+            start = [rank, key]
+
+            def match(value):
+                return True
+
+            def stop(value):
+                return value != key
+
+        found = []
+        for entry_rank, value, name in self._scan(start):
+            if entry_rank != rank or stop(value):
+                break
+            if match(value):
+                found.append(name)
+        return found
+
+    def idx_estimate(self, key):
+        # entries of the pages spanning the matching range
+        pages = self.pages
+        if not pages:
+            return 0
+        if isinstance(key, Range):
+            ranks = set(_sort_rank(bound) for bound in (key.low, key.high) if bound is not None)
+            if not ranks:
+                return len(self.documents)
+            if len(ranks) > 1 or None in ranks:
+                return 0
+            rank = ranks.pop()
+            start = [rank] if key.low is None else [rank, key.low]
+            end = [rank + 1] if key.high is None else [rank, key.high, _last_name]
+        elif isinstance(key, Prefix):
+            start = [_sort_rank(key.prefix), key.prefix]
+            end = [_sort_rank(key.prefix), key.prefix + _last_name]
+        else:
+            rank = _sort_rank(key)
+            if rank is None:
+                return len(self.documents)
+            start = [rank, key]
+            end = [rank, key, _last_name]
+
+        first = _bisect_pages(pages, start)
+        last = _bisect_pages(pages, end)
+        if first == last:
+            page = pages[first]
+            return bisect.bisect_right(page, end) - bisect.bisect_left(page, start)
+        return sum(len(page) for page in pages[first:last + 1])
+
+    def _scan(self, start):
+        pages = self.pages
+        if not pages:
+            return
+        index = _bisect_pages(pages, start)
+        position = bisect.bisect_left(pages[index], start)
+        for page in pages[index:]:
+            for entry in page[position:]:
+                yield entry
+            position = 0
+
+    def _idx_clear(self):
+        self.pages = []
+        self.documents.clear()
+
+    def _idx_build(self, values):
+        entries = sorted(
+            [_sort_rank(value), value, name] for name, value in values.items()
+            if _sort_rank(value) is not None)
+        # pages are filled half, so that inserts don't split them right away
+        size = max(self.page_size // 2, 1)
+        self.pages = [entries[i:i + size] for i in range(0, len(entries), size)]
+
+    def _idx_add(self, name, value):
+        rank = _sort_rank(value)
+        if rank is None:
+            return
+        entry = [rank, value, name]
+        pages = self.pages
+        if not pages:
+            pages.append([entry])
+        else:
+            index = _bisect_pages(pages, entry)
+            page = pages[index]
+            bisect.insort(page, entry)
+            if len(page) > self.page_size:
+                half = len(page) // 2
+                pages[index:index + 1] = [page[:half], page[half:]]
+        self.set_dirty()
+
+    def _idx_remove(self, name, value):
+        rank = _sort_rank(value)
+        if rank is None or not self.pages:
+            return
+        entry = [rank, value, name]
+        pages = self.pages
+        index = _bisect_pages(pages, entry)
+        page = pages[index]
+        position = bisect.bisect_left(page, entry)
+        if position < len(page) and page[position] == entry:
+            del page[position]
+            if not page:
+                del pages[index]
+            self.set_dirty()
+
+
+def _matches(condition, value):
+    if hasattr(condition, "matches"):
+        return condition.matches(value)
+    return _equal(value, condition)
+
+
+def _conditions(conditions):
+    if hasattr(conditions, "items"):
+        return list(conditions.items())
+    return list(conditions)
+
+
+class QueryPlan(object):
+    """
+    how a query on a collection is answered. conditions on indexed fields
+    are looked up in the index estimating the fewest documents, the most
+    selective first, and their results intersected. the remaining
+    conditions are checked on the candidate documents. only if no
+    condition is indexed, all documents are scanned, without caching them
+    (see :meth:`ChurroDb.scan`).
+
+    indexes are updated on commit, changes of the current transaction are
+    not visible to queries answered by an index.
+    """
+    def __init__(self, collection, conditions, indexes):
+        self.collection = collection
+        self.lookups = []
+        self.filters = []
+
+        for field, condition in _conditions(conditions):
+            best = None
+            for name, index in indexes:
+                if getattr(index, "field", None) != field:
+                    continue
+                estimate = index.idx_estimate(condition)
+                if best is None or estimate < best[3]:
+                    best = (field, condition, name, estimate, index)
+            if best is None:
+                self.filters.append((field, condition))
+            else:
+                self.lookups.append(best)
+
+        self.lookups.sort(key=lambda lookup: lookup[3])
+
+    def execute(self):
+        """:return: sorted names of the documents matching all conditions"""
+        if self.lookups:
+            candidates = None
+            for field, condition, name, estimate, index in self.lookups:
+                found = set(index.idx_find(condition))
+                candidates = found if candidates is None else candidates & found
+                if not candidates:
+                    return []
+            if not self.filters:
+                return sorted(candidates)
+            documents = (
+                (name, self.collection.get(name)) for name in sorted(candidates))
+        elif isinstance(self.collection, churro.PersistentFolder):
+            documents = _scan_folder(self.collection)
+        else:
+            documents = self.collection.items()
+
+        found = []
+        for name, document in documents:
+            if document is None or isinstance(document, churro.PersistentFolder):
+                continue
+            for field, condition in self.filters:
+                value = _field_value(document, field)
+                if value is _missing or not _matches(condition, value):
+                    break
+            else:
+                found.append(name)
+        return sorted(found)
+
+    def __str__(self):
+        lines = []
+        for i, (field, condition, name, estimate, index) in enumerate(self.lookups):
+            lines.append("{step} {field} {condition!r} using index {name} ({type}), ~{estimate} documents".format(
+                step="intersect" if i else "lookup", field=field, condition=condition,
+                name=name, type=type(index).__name__, estimate=estimate))
+        if not self.lookups:
+            lines.append("scan all documents")
+        for field, condition in self.filters:
+            lines.append("filter {field} {condition!r}".format(field=field, condition=condition))
+        return "\n".join(lines)
+
+
+class IndexLog(churro.PersistentFolder):
+    """
+    the changes to an indexed collection not applied to its indexes yet.
+    every commit adds an entry of its own, so that writers and the
+    :class:`IndexWorker` removing applied entries never touch the same file.
+    """
+    def append(self, changed):
+        """adds an entry for ``changed``, which maps names to previous oids"""
+        name = "{time:016x}-{uuid}".format(time=time.time_ns(), uuid=uuid.uuid4().hex)
+        self[name] = churro.PersistentDict(changed)
+        return name
+
+    def pending(self):
+        """
+        :return: (entry names, changed) of all entries, oldest first.
+        ``changed`` maps item names to the oid before the oldest change
+        """
+        names = sorted(self.keys())
+        changed = {}
+        for name in names:
+            for key, previous in self[name].items():
+                changed.setdefault(key, previous)
+        return names, changed
+
+
+def _idx_derivable(index):
+    """
+    :return: whether ``index`` can be updated from the oids of the changed
+    items of its collection alone (see ``idx_merge``). indexes supplying
+    another, rebuilt by every update or not built yet can't be
+    """
+    if not hasattr(index, "idx_merge") or getattr(index, "supply", None) is not None\
+            or getattr(index, "clear_before_update", False):
+        return False
+    if isinstance(index, FieldIndex):
+        return bool(index.built or index.documents)
+    return bool(index.trees) or len(index) > 0
+
 
 class IndexMixin(ChurroDbAware, IIndex):
     index_factory = IndexesFolder
     session = None
+    # with deferred indexes, commits only add the changed names to the
+    # IndexLog, an IndexWorker applies them to the indexes later on
+    idx_deferred = False
+    idx_log_name = "_index_log"
 
     def init_index(self):
         self.index_factory(self)
 
     def __new__(cls, *args, **kwargs):
         obj = super().__new__(cls, *args, **kwargs)
-        obj.__dirty = False
+        obj.__dirty = True
         obj._index = None
         obj._db = None
         return obj
 
     @property
     def churrodb(self):
+        if self._db is None:
+            self.churrodb = _inherited_churrodb(self)
         return self._db
 
     @churrodb.setter
@@ -591,7 +3796,7 @@ class IndexMixin(ChurroDbAware, IIndex):
 
     @property
     def _dirty(self):
-        return getattr(super(), "_dirty", self.__dirty)
+        return self.__dirty
 
     @_dirty.setter
     def _dirty(self, dirty):
@@ -620,17 +3825,153 @@ class IndexMixin(ChurroDbAware, IIndex):
         else:
             self._index = value
 
-    def idx_find(self, key, subindex=None):
+    def idx_find(self, key, subindex=None, sync=False):
+        """
+        with ``sync``, changes committed but not applied to deferred indexes
+        yet are applied first (in the current transaction), so that the
+        result reflects them
+        """
+        if sync:
+            self.idx_apply_log()
         return self.idx.idx_find(key, subindex)
 
     idx_find_first = idx_find_first
 
+    def idx_find_many(self, keys, subindex=None):
+        return self.idx.idx_find_many(keys, subindex)
+
+    @property
+    def idx_log(self):
+        """the :class:`IndexLog` of deferred indexes, ``None`` if there is none"""
+        if not isinstance(self, churro.PersistentFolder):
+            return None
+        return self.get(self.idx_log_name)
+
+    def idx_lag(self):
+        """:return: number of items changed but not applied to the indexes yet"""
+        idx_log = self.idx_log
+        if idx_log is None:
+            return 0
+        return len(idx_log.pending()[1])
+
+    def idx_apply_log(self):
+        """
+        applies the entries of the :class:`IndexLog` to the indexes and
+        removes them. :return: number of entries applied
+        """
+        idx_log = self.idx_log
+        if idx_log is None:
+            return 0
+        names, changed = idx_log.pending()
+        if not names:
+            return 0
+
+        log.info("applying %d index log entries (%s)...", len(names), self)
+        self.idx_update(ChangeSet(self, changed))
+        for name in names:
+            del idx_log[name]
+        return len(names)
+
+    def _idx_defer(self, changed):
+        """
+        adds ``changed`` to the IndexLog, instead of updating the indexes.
+        the :class:`IndexWorker` commits while writers' transactions run,
+        only merging saves (see :meth:`ChurroDb.save`) take its commits in
+        their stride, other saves would conflict with them
+        """
+        db = self.churrodb
+        if db is None or not db.merge:
+            raise Exception("deferred indexes need a ChurroDb opened with merge=True")
+        changed = dict(
+            (name, previous) for name, previous in changed.items()
+            if name not in ("_index", self.idx_log_name))
+        if not changed:
+            return
+        idx_log = self.idx_log
+        if idx_log is None:
+            if not isinstance(self, churro.PersistentFolder):
+                raise Exception("deferred indexes need a folder to keep their log in")
+            idx_log = self[self.idx_log_name] = IndexLog()
+        idx_log.append(changed)
+
+    def query(self, conditions):
+        """
+        :param conditions: dict (or sequence of pairs) of dotted field names
+        and the value, :class:`Range` or :class:`Prefix` they must match
+        :return: sorted names of the documents matching all conditions
+        """
+        return self.explain(conditions).execute()
+
+    def explain(self, conditions):
+        """:return: the :class:`QueryPlan` :meth:`query` would execute"""
+        idx = self.idx
+        if isinstance(idx, churro.PersistentFolder):
+            indexes = list(idx.items())
+        elif idx is not None:
+            indexes = [(getattr(idx, "__name__", None), idx)]
+        else:
+            indexes = []
+        return QueryPlan(self, conditions, indexes)
+
     def idx_update(self, data=None):
         self.idx.idx_update(data)
 
+    def idx_rebuild(self):
+        """updates the index from the whole collection, not just the changes"""
+        self.idx_update(self)
+
     def idx_validate(self):
         self.idx.idx_validate()
 
+    def _idx_grouped(self):
+        """
+        :return: whether the :class:`GroupCommit` of the db updates the
+        indexes once for the group of saves, see _update_indexes
+        """
+        db = self.churrodb
+        if db is None or db.group_commit is None:
+            return False
+        if not isinstance(self.idx, IndexesFolder):
+            return False
+        # the entries of a collection for the collections it holds change
+        # with their indexes, which the group updates first
+        node = self
+        while node is not None:
+            idx = node.idx if isinstance(node, IndexMixin) else None
+            if idx is not None and not (isinstance(idx, IndexesFolder) and all(
+                    _idx_derivable(index) for index in idx.values())):
+                return False
+            node = node.__parent__
+        return True
+
+    def track_change(self, name):
+        changed = self._session().changed
+        if name not in changed:
+            changed[name] = self._previous_oid(name)
+
+    def track_dirty(self):
+        """
+        tracks the loaded children changed in place. _save reports them as
+        well, but only when flushed, which may be after the index update
+        """
+        _restore_dirty(self)
+        contents = self.__dict__.get("_contents", {})
+        for name, (type, obj) in contents.items():
+            if obj is churro._removed or (obj is not None and obj._dirty):
+                self.track_change(name)
+
+    def _previous_oid(self, name):
+        fs = self._fs
+        if fs is None or not isinstance(self, churro.PersistentFolder):
+            return None
+
+        path = churro.resource_path(self, name)
+        if not fs.isdir(path):
+            path += churro.CHURRO_EXT
+        if not fs.exists(path):
+            return None
+        return _fs_hash(fs, path)
+
 
 class GitIndexMixin(IndexMixin):
     index_factory = GitObjectHashIndex
@@ -653,11 +3994,23 @@ class _IndexSession(object):
 
     def __init__(self, obj):
         self.obj = obj
+        self.changed = {}
         transaction.get().join(self)
         transaction.get().addBeforeCommitHook(self.before_commit)
 
     def before_commit(self):
-        self.obj.idx_update(self.obj)
+        self.obj.track_dirty()
+        if self.obj.idx_deferred:
+            self.obj._idx_defer(self.changed)
+            return
+        if self.obj._idx_grouped():
+            fs = self.obj.churrodb.fs
+            session = fs._session()
+            if not hasattr(session, "churrodb_indexes"):
+                session.churrodb_indexes = set()
+            session.churrodb_indexes.add(tuple(fs._mkpath(churro.resource_path(self.obj))))
+            return
+        self.obj.idx_update(ChangeSet(self.obj, self.changed))
 
     def set_dirty(self):
         self._dirty = True
@@ -690,9 +4043,116 @@ class _IndexSession(object):
         """
         Part of datamanager API.
         """
-        self.obj.idx_validate()
+        if not self.obj.idx_deferred:
+            self.obj.idx_validate()
 
     def tpc_finish(self, tx):
         """
         Part of datamanager API.
-        """
\ No newline at end of file
+        """
+        self.close()
+
+
+class IndexWorker(object):
+    """
+    applies the :class:`IndexLog` of collections with deferred indexes in a
+    background thread, one commit per round. the collections are the root
+    and those of its children which have a log (looked up in git, without
+    loading the children), or those at ``paths`` (e.g. ``"a/b"``). after a
+    conflict with a concurrent commit, it waits ``interval`` seconds before
+    trying again. the other arguments are passed on to :class:`ChurroDb`,
+    which merges (see ``merge``) like the writers of deferred indexes must.
+    """
+    def __init__(self, repo, head="HEAD", factory=None, interval=1.0, paths=None, **kwargs):
+        self._args = (repo, head, factory)
+        kwargs["merge"] = True
+        self._kwargs = kwargs
+        self.interval = interval
+        self.paths = paths
+        self.applied = 0
+        self.conflicts = 0
+        self._thread = None
+        self._stopped = threading.Event()
+        self._wake = threading.Event()
+        self._condition = threading.Condition()
+        self._round = 0
+        self._caught_up = 0
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="churrodb-index-worker", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def wait(self, timeout=None):
+        """
+        blocks until everything committed before has been applied.
+        :return: False if that did not happen within ``timeout`` seconds
+        """
+        with self._condition:
+            target = self._round + 1
+            self._wake.set()
+            return self._condition.wait_for(lambda: self._caught_up >= target, timeout)
+
+    def run_once(self):
+        """applies all pending entries in one commit, :return: number of entries"""
+        transaction.begin()
+        try:
+            db = ChurroDb(*self._args, **self._kwargs)
+            applied = 0
+            for collection in self._collections(db):
+                applied += collection.idx_apply_log()
+            if applied:
+                transaction.commit()
+            else:
+                transaction.abort()
+        except Exception:
+            transaction.abort()
+            raise
+        return applied
+
+    def _collections(self, db):
+        root = db.root()
+        if self.paths is None:
+            candidates = [root] + [
+                root[name] for name in db.fs.listdir("/")
+                if db.fs.isdir("/" + name + "/" + IndexMixin.idx_log_name)]
+        else:
+            candidates = []
+            for path in self.paths:
+                folder = root
+                for name in path.strip("/").split("/"):
+                    if name:
+                        folder = folder[name]
+                candidates.append(folder)
+        return [
+            candidate for candidate in candidates
+            if isinstance(candidate, IndexMixin) and candidate.idx_deferred]
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.clear()
+            with self._condition:
+                self._round += 1
+                current = self._round
+            try:
+                self.applied += self.run_once()
+            except acidfs.ConflictError:
+                # a concurrent commit changed the indexes, try again
+                self.conflicts += 1
+                log.info("index worker conflicted with a concurrent commit, retrying...")
+            except Exception:
+                log.exception("index worker failed to apply the index log")
+            else:
+                with self._condition:
+                    self._caught_up = current
+                    self._condition.notify_all()
+            self._wake.wait(self.interval)
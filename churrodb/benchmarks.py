@@ -0,0 +1,957 @@
+"""
+micro benchmarks for churrodb internals.
+
+run with ``python -m churrodb.benchmarks [benchmark ...]``, the results are
+printed as plain text tables.
+"""
+import gc
+import io
+import sys
+import time
+import churro
+import shutil
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import churrodb
+import subprocess
+import collections
+import concurrent.futures
+import transaction
+
+
+class _FakeFs(object):
+    """stands in for AcidFS so that the index loops can be timed without git"""
+    def isdir(self, path):
+        return False
+
+    def hash(self, path):
+        return hashlib.sha1(path.encode("utf-8")).hexdigest()
+
+
+class _FakeDb(object):
+    fs = _FakeFs()
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def _collection(size):
+    folder = churro.PersistentFolder()
+    for i in range(size):
+        obj = churro.Persistent()
+        obj.__parent__ = folder
+        obj.__name__ = "item-{i}".format(i=i)
+        folder._contents[obj.__name__] = ("object", obj)
+    return folder
+
+
+def _list_rebuild(index, db, target, data):
+    """duplicate detection as done up to churrodb 0.1 (quadratic)"""
+    seen_keys = []
+    for key, value in data.items():
+        target_key, target_value = index._entry(key, index._hash(db, value))
+        if target_key in seen_keys:
+            raise churrodb.IndexUpdateError(target_key)
+        seen_keys.append(target_key)
+        target[target_key] = target_value
+
+
+def bench_index_rebuild(sizes=(10000, 100000, 1000000), before_limit=10000):
+    """
+    full rebuild of a GitObjectHashIndex with the list based duplicate
+    detection (before) and the dict based one (after). sizes above
+    ``before_limit`` are skipped for the quadratic variant.
+    """
+    db = _FakeDb()
+    rows = []
+    for size in sizes:
+        data = _collection(size)
+        index = churrodb.GitObjectHashIndex(inverse=True)
+
+        if size <= before_limit:
+            before = _timed(_list_rebuild, index, db, churro.PersistentDict(), data)
+        else:
+            before = None
+        after = _timed(index._idx_rebuild, db, churro.PersistentDict(), data)
+        rows.append((size, before, after))
+
+    print("GitObjectHashIndex full rebuild")
+    print("{:>10} {:>12} {:>12}".format("entries", "before [s]", "after [s]"))
+    for size, before, after in rows:
+        print("{:>10} {:>12} {:>12.3f}".format(
+            size, "skipped" if before is None else "{:.3f}".format(before), after))
+    return rows
+
+
+def _document(i):
+    return churro.PersistentDict({
+        "id": "doc-{i}".format(i=i),
+        "title": "document number {i}".format(i=i),
+        "tags": ["tag-{t}".format(t=t) for t in range(i % 7)],
+        "meta": {"created": "2016-01-01T00:00:00", "version": i % 5, "flags": [True, False, None]},
+        "values": list(range(i % 50)),
+    })
+
+
+def _repository_size(path):
+    # loose objects are counted in whole disk blocks, pack first
+    subprocess.check_call(["git", "repack", "-a", "-d", "-q"], cwd=path)
+    counts = subprocess.check_output(["git", "count-objects", "-v"], cwd=path).decode()
+    sizes = dict(line.split(": ") for line in counts.strip().split("\n"))
+    return (int(sizes["size"]) + int(sizes["size-pack"])) * 1024
+
+
+def bench_codec(documents=20000, repository_documents=500):
+    """
+    encode/decode throughput of the codecs, and the size of a repository
+    holding ``repository_documents`` documents written with each of them
+    """
+    codecs = [
+        ("JsonCodec", churrodb.JsonCodec()),
+        ("CompactJsonCodec", churrodb.CompactJsonCodec()),
+    ]
+    objects = [_document(i) for i in range(documents)]
+    rows = []
+    for name, codec in codecs:
+        encoded = []
+        start = time.perf_counter()
+        for obj in objects:
+            stream = io.StringIO()
+            codec.encode(obj, stream)
+            encoded.append(stream.getvalue())
+        encode_time = time.perf_counter() - start
+        size = sum(len(data.encode("utf-8")) for data in encoded)
+
+        start = time.perf_counter()
+        for data in encoded:
+            codec.decode(io.StringIO(data))
+        decode_time = time.perf_counter() - start
+
+        path = tempfile.mkdtemp(prefix="churrodb-bench-")
+        try:
+            db = churrodb.ChurroDb(path, codec=codec)
+            db["docs"] = churro.PersistentFolder()
+            for i in range(repository_documents):
+                db["docs"][str(i)] = _document(i)
+            db.save()
+            repo_size = _repository_size(path)
+        finally:
+            transaction.abort()
+            shutil.rmtree(path)
+
+        rows.append((name, documents / encode_time, documents / decode_time, size, repo_size))
+
+    print("codecs, {n} documents, repository with {m} documents".format(
+        n=documents, m=repository_documents))
+    print("{:<18} {:>12} {:>12} {:>12} {:>12}".format(
+        "codec", "encode [1/s]", "decode [1/s]", "bytes", "repo [bytes]"))
+    for row in rows:
+        print("{:<18} {:>12.0f} {:>12.0f} {:>12} {:>12}".format(*row))
+    return rows
+
+
+def _written_bytes(path):
+    """sum of the sizes of the blobs the last commit added or changed"""
+    diff = subprocess.check_output(
+        ["git", "diff-tree", "-r", "--no-renames", "HEAD~1", "HEAD"], cwd=path).decode()
+    oids = [line.split()[3] for line in diff.strip().split("\n") if line]
+    oids = [oid for oid in oids if set(oid) != {"0"}]
+    sizes = subprocess.check_output(
+        ["git", "cat-file", "--batch-check=%(objectsize)"], cwd=path,
+        input="\n".join(oids).encode()).decode().split()
+    return sum(int(size) for size in sizes)
+
+
+def bench_index_storage(sizes=(10000, 100000, 1000000)):
+    """
+    commit of a single changed entry and lookup of a single key on a fresh
+    handle, for an index stored as one file and as shards
+    """
+    factories = [
+        ("GitObjectHashIndex", churrodb.GitObjectHashIndex),
+        ("ShardedGitObjectHashIndex", churrodb.ShardedGitObjectHashIndex),
+    ]
+    rows = []
+    for size in sizes:
+        entries = dict(
+            ("item-{i}".format(i=i), hashlib.sha1(str(i).encode()).hexdigest())
+            for i in range(size))
+        for name, factory in factories:
+            path = tempfile.mkdtemp(prefix="churrodb-bench-")
+            try:
+                db = churrodb.ChurroDb(path)
+                db["index"] = factory()
+                db["index"].update(entries)
+                db.save()
+
+                transaction.begin()
+                db = churrodb.ChurroDb(path)
+                db["index"]["item-5"] = "0" * 40
+                commit = _timed(db.save)
+                written = _written_bytes(path)
+
+                transaction.begin()
+                db = churrodb.ChurroDb(path, lazy=True)
+                lookup = _timed(lambda: db["index"]["item-7"])
+            finally:
+                transaction.abort()
+                shutil.rmtree(path)
+            rows.append((size, name, commit, written, lookup))
+
+    print("index storage, one changed entry")
+    print("{:>10} {:<26} {:>10} {:>14} {:>10}".format(
+        "entries", "index", "commit [s]", "written [bytes]", "lookup [s]"))
+    for row in rows:
+        print("{:>10} {:<26} {:>10.3f} {:>14} {:>10.4f}".format(*row))
+    return rows
+
+
+def _scan_find(index, key):
+    """cross-namespace lookup as done up to churrodb 0.1 (linear)"""
+    found = index.get(key)
+    if found is None:
+        found = index._scan_auxiliary(key)
+    return [] if found is None else [found]
+
+
+def bench_namespace_lookup(namespaces=(10, 50, 200), keys=1000, lookups=10000):
+    """
+    lookups of keys held by the last namespace and of missing keys in a
+    GitObjectHashIndex supplied by ``namespaces`` collections
+    """
+    rows = []
+    for count in namespaces:
+        index = churrodb.GitObjectHashIndex()
+        for n in range(count):
+            index.auxiliary["coll-{n}".format(n=n)] = churro.PersistentDict(
+                ("{n}-{i}".format(n=n, i=i), "0" * 40) for i in range(keys))
+        index.namespace_keys = churro.PersistentDict(index._scan_namespaces())
+
+        wanted = ["{n}-{i}".format(n=count - 1, i=i % keys) for i in range(lookups)]
+        missing = ["missing-{i}".format(i=i) for i in range(lookups)]
+        for name, find in [("before", _scan_find), ("after", type(index).idx_find)]:
+            hits = _timed(lambda: [find(index, key) for key in wanted])
+            misses = _timed(lambda: [find(index, key) for key in missing])
+            rows.append((count, name, hits, misses))
+        rows.append((count, "idx_find_many", _timed(index.idx_find_many, wanted), _timed(index.idx_find_many, missing)))
+
+    print("GitObjectHashIndex cross-namespace lookups, {n} each".format(n=lookups))
+    print("{:>10} {:<14} {:>10} {:>10}".format("namespaces", "", "hits [s]", "misses [s]"))
+    for row in rows:
+        print("{:>10} {:<14} {:>10.3f} {:>10.3f}".format(*row))
+    return rows
+
+
+def bench_field_index(sizes=(10000, 100000), queries=100):
+    """
+    equality and range queries on a FieldIndex and a SortedFieldIndex
+    against scanning all documents, and the cost of building them
+    """
+    rows = []
+    for size in sizes:
+        data = dict(
+            ("doc-{i}".format(i=i), churro.PersistentDict({
+                "status": "status-{s}".format(s=i % 50),
+                "meta": {"created": i}}))
+            for i in range(size))
+        status = churrodb.FieldIndex("status")
+        created = churrodb.SortedFieldIndex("meta.created")
+        build_status = _timed(status.idx_update, data)
+        build_created = _timed(created.idx_update, data)
+        ranges = [churrodb.Range(i * 7, i * 7 + 100) for i in range(queries)]
+
+        rows.append((size, "scan", "-",
+            _timed(lambda: [[name for name, doc in data.items() if doc["status"] == "status-7"] for i in range(queries)]),
+            _timed(lambda: [[name for name, doc in data.items() if r.matches(doc["meta"]["created"])] for r in ranges])))
+        rows.append((size, "FieldIndex", build_status,
+            _timed(lambda: [status.idx_find("status-7") for i in range(queries)]),
+            None))
+        rows.append((size, "SortedFieldIndex", build_created,
+            _timed(lambda: [created.idx_find(i) for i in range(queries)]),
+            _timed(lambda: [created.idx_find(r) for r in ranges])))
+
+    print("field indexes, {n} queries each".format(n=queries))
+    print("{:>10} {:<18} {:>10} {:>10} {:>10}".format("documents", "", "build [s]", "equal [s]", "range [s]"))
+    for size, name, build, equal, range_ in rows:
+        print("{:>10} {:<18} {:>10} {:>10.3f} {:>10}".format(
+            size, name, build if build == "-" else "{:.3f}".format(build), equal,
+            "-" if range_ is None else "{:.3f}".format(range_)))
+    return rows
+
+
+def _peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_scan(documents=5000):
+    """
+    peak memory and time of iterating a folder of ``documents`` documents
+    with PersistentFolder.items (cached) and ChurroDb.scan (streamed)
+    """
+    path = tempfile.mkdtemp(prefix="churrodb-bench-")
+    rows = []
+    try:
+        db = churrodb.ChurroDb(path)
+        db["docs"] = churro.PersistentFolder()
+        for i in range(documents):
+            db["docs"][str(i)] = _document(i)
+        db.save()
+
+        def consume(iterator):
+            for name, obj in iterator:
+                pass
+
+        for name, iterate in [
+                ("items", lambda db: db["docs"].items()),
+                ("scan", lambda db: db.scan("docs"))]:
+            transaction.begin()
+            db = churrodb.ChurroDb(path)
+            start = time.perf_counter()
+            peak = _peak_memory(lambda: consume(iterate(db)))
+            rows.append((name, time.perf_counter() - start, peak))
+    finally:
+        transaction.abort()
+        shutil.rmtree(path)
+
+    print("iterating a folder of {n} documents".format(n=documents))
+    print("{:<8} {:>10} {:>16}".format("", "time [s]", "peak memory [kB]"))
+    for name, seconds, peak in rows:
+        print("{:<8} {:>10.3f} {:>16}".format(name, seconds, peak // 1024))
+    return rows
+
+
+def bench_child_cache(documents=5000, max_objects=500):
+    """
+    memory retained after reading every document of a folder twice, with
+    and without a ChildCache, and the time it takes
+    """
+    path = tempfile.mkdtemp(prefix="churrodb-bench-")
+    rows = []
+    try:
+        db = churrodb.ChurroDb(path)
+        db["docs"] = churro.PersistentFolder()
+        for i in range(documents):
+            db["docs"][str(i)] = _document(i)
+        db.save()
+
+        for name, cache in [
+                ("unbounded", None),
+                ("lru", churrodb.ChildCache(max_objects=max_objects)),
+                ("lfu", churrodb.ChildCache(max_objects=max_objects, policy="lfu"))]:
+            transaction.begin()
+            db = churrodb.ChurroDb(path, child_cache=cache)
+            folder = db["docs"]
+            gc.collect()
+            tracemalloc.start()
+            start = time.perf_counter()
+            for i in range(2):
+                for obj in folder.values():
+                    pass
+            seconds = time.perf_counter() - start
+            gc.collect()
+            retained = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            rows.append((name, seconds, retained))
+    finally:
+        transaction.abort()
+        shutil.rmtree(path)
+
+    print("reading {n} documents twice, at most {m} cached".format(n=documents, m=max_objects))
+    print("{:<10} {:>10} {:>14}".format("", "time [s]", "retained [kB]"))
+    for name, seconds, retained in rows:
+        print("{:<10} {:>10.3f} {:>14}".format(name, seconds, retained // 1024))
+    return rows
+
+
+class _IndexedCollection(churrodb.IndexMixin, churro.PersistentFolder):
+    __module__ = "churrodb.benchmarks"
+    index_factory = churrodb.IndexesFolder
+
+
+def bench_index_pipeline(documents=5000, workers=(None, 4), max_objects=500):
+    """
+    full rebuild of a collection with five indexes, member by member as
+    before and through a RebuildSet, with and without reader threads. with
+    a ChildCache, members rebuilt one by one read evicted documents again
+    """
+    path = tempfile.mkdtemp(prefix="churrodb-bench-")
+    rows = []
+    try:
+        db = churrodb.ChurroDb(path)
+        coll = db["docs"] = _IndexedCollection()
+        coll.init_index()
+        coll.idx["_hash"] = churrodb.GitObjectHashIndex(inverse=True)
+        coll.idx["_id"] = churrodb.GitDictKeyHashIndex(dict_key="id")
+        coll.idx["_title"] = churrodb.FieldIndex("title")
+        coll.idx["_version"] = churrodb.SortedFieldIndex("meta.version")
+        coll.idx["_created"] = churrodb.FieldIndex("meta.created")
+        for i in range(documents):
+            coll[str(i)] = _document(i)
+        db.save()
+
+        def members(coll):
+            for idx in coll.idx.values():
+                idx.idx_update(coll)
+
+        def pipeline(coll):
+            coll.idx_rebuild()
+
+        variants = [("members", None, members)] + [
+            ("pipeline, {w} workers".format(w=w or 0), w, pipeline) for w in workers]
+        for cached in (False, True):
+            for name, index_workers, rebuild in variants:
+                transaction.begin()
+                cache = churrodb.ChildCache(max_objects=max_objects) if cached else None
+                db = churrodb.ChurroDb(path, index_workers=index_workers, child_cache=cache)
+                rows.append((name, cached, _timed(rebuild, db["docs"])))
+    finally:
+        transaction.abort()
+        shutil.rmtree(path)
+
+    print("rebuilding five indexes over {n} documents".format(n=documents))
+    print("{:<22} {:>12} {:>10}".format("", "child cache", "time [s]"))
+    for name, cached, seconds in rows:
+        print("{:<22} {:>12} {:>10.3f}".format(
+            name, max_objects if cached else "-", seconds))
+    return rows
+
+
+class _DeferredCollection(_IndexedCollection):
+    __module__ = "churrodb.benchmarks"
+    idx_deferred = True
+
+
+def bench_deferred_index(documents=2000, commits=50):
+    """
+    time per commit of one document into a collection with four indexes,
+    updated on commit and deferred to an IndexWorker
+    """
+    rows = []
+    for name, factory in [("on commit", _IndexedCollection), ("deferred", _DeferredCollection)]:
+        path = tempfile.mkdtemp(prefix="churrodb-bench-")
+        try:
+            # writers of deferred indexes merge the worker's commits
+            db = churrodb.ChurroDb(path, merge=True)
+            coll = db["docs"] = factory()
+            coll.init_index()
+            coll.idx["_hash"] = churrodb.GitObjectHashIndex(inverse=True)
+            coll.idx["_id"] = churrodb.GitDictKeyHashIndex(dict_key="id")
+            coll.idx["_title"] = churrodb.FieldIndex("title")
+            coll.idx["_version"] = churrodb.SortedFieldIndex("meta.version")
+            for i in range(documents):
+                coll[str(i)] = _document(i)
+            db.save()
+            churrodb.IndexWorker(path).run_once()
+
+            start = time.perf_counter()
+            for i in range(documents, documents + commits):
+                transaction.begin()
+                db = churrodb.ChurroDb(path, merge=True)
+                db["docs"][str(i)] = _document(i)
+                db.save()
+            per_commit = (time.perf_counter() - start) / commits
+            catch_up = _timed(churrodb.IndexWorker(path).run_once)
+            rows.append((name, per_commit, catch_up))
+        finally:
+            transaction.abort()
+            shutil.rmtree(path)
+
+    print("{c} commits of one document into {n} documents".format(c=commits, n=documents))
+    print("{:<10} {:>16} {:>14}".format("indexes", "per commit [ms]", "catch up [s]"))
+    for name, per_commit, catch_up in rows:
+        print("{:<10} {:>16.1f} {:>14.3f}".format(name, per_commit * 1000, catch_up))
+    return rows
+
+
+def bench_bulk_load(sizes=(20000, 100000), assign_limit=20000):
+    """
+    loading documents into a collection with two indexes by assignment
+    and a single save, and with ChurroDb.bulk_load. sizes above
+    ``assign_limit`` are skipped for assignment
+    """
+    rows = []
+    for size in sizes:
+        for name in ["assign", "bulk_load"]:
+            if name == "assign" and size > assign_limit:
+                rows.append((size, name, None))
+                continue
+            path = tempfile.mkdtemp(prefix="churrodb-bench-")
+            try:
+                transaction.begin()
+                db = churrodb.ChurroDb(path, codec=churrodb.CompactJsonCodec())
+                coll = db["docs"] = _IndexedCollection()
+                coll.init_index()
+                coll.idx["_hash"] = churrodb.GitObjectHashIndex(inverse=True)
+                coll.idx["_title"] = churrodb.FieldIndex("title")
+                db.save()
+
+                transaction.begin()
+                db = churrodb.ChurroDb(path, codec=churrodb.CompactJsonCodec())
+                documents = ((str(i), _document(i)) for i in range(size))
+                start = time.perf_counter()
+                if name == "assign":
+                    coll = db["docs"]
+                    for key, document in documents:
+                        coll[key] = document
+                    db.save()
+                else:
+                    db.bulk_load(documents, "docs")
+                rows.append((size, name, time.perf_counter() - start))
+            finally:
+                transaction.abort()
+                shutil.rmtree(path)
+
+    print("loading documents into a collection with two indexes")
+    print("{:>10} {:<10} {:>10} {:>14}".format("documents", "", "time [s]", "documents/s"))
+    for size, name, seconds in rows:
+        if seconds is None:
+            print("{:>10} {:<10} {:>10} {:>14}".format(size, name, "skipped", "-"))
+        else:
+            print("{:>10} {:<10} {:>10.3f} {:>14.0f}".format(size, name, seconds, size / seconds))
+    return rows
+
+
+def bench_snapshot(documents=2000, reads=200):
+    """
+    reading ``reads`` documents of the previous commit through
+    ChurroDb.switch and through a Snapshot
+    """
+    path = tempfile.mkdtemp(prefix="churrodb-bench-")
+    rows = []
+    try:
+        db = churrodb.ChurroDb(path)
+        db["docs"] = churro.PersistentFolder()
+        for i in range(documents):
+            db["docs"][str(i)] = _document(i)
+        db.save()
+        previous = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=path).decode().strip()
+        subprocess.check_call(["git", "branch", "-q", "previous"], cwd=path)
+        transaction.begin()
+        db = churrodb.ChurroDb(path)
+        db["docs"]["0"]["title"] = "changed"
+        db.save()
+
+        def switched():
+            db = churrodb.ChurroDb(path)
+            db.switch("previous")
+            for i in range(reads):
+                db["docs"][str(i)]["title"]
+            transaction.abort()
+
+        def snapshot():
+            snapshot = db.snapshot(previous)
+            for i in range(reads):
+                snapshot["docs"][str(i)]["title"]
+
+        transaction.begin()
+        rows.append(("switch", _timed(switched)))
+        transaction.begin()
+        db = churrodb.ChurroDb(path)
+        rows.append(("snapshot", _timed(snapshot)))
+        rows.append(("snapshot, cached", _timed(snapshot)))
+    finally:
+        transaction.abort()
+        shutil.rmtree(path)
+
+    print("reading {r} of {n} documents of the previous commit".format(r=reads, n=documents))
+    print("{:<18} {:>10}".format("", "time [s]"))
+    for name, seconds in rows:
+        print("{:<18} {:>10.3f}".format(name, seconds))
+    return rows
+
+
+def bench_threaded(documents=1000, threads=8):
+    """
+    ``threads`` readers each reading all ``documents``, through a ChurroDb
+    per thread and through the snapshots of a shared ThreadedChurroDb
+    """
+    path = tempfile.mkdtemp(prefix="churrodb-bench-")
+    rows = []
+    try:
+        db = churrodb.ChurroDb(path)
+        db["docs"] = churro.PersistentFolder()
+        for i in range(documents):
+            db["docs"][str(i)] = _document(i)
+        db.save()
+        shared = churrodb.ThreadedChurroDb(path, object_cache=churrodb.ObjectCache(documents * 2))
+
+        def private(read):
+            db = churrodb.ChurroDb(path, lazy=True)
+            read.extend(doc["title"] and doc for doc in db["docs"].values())
+            transaction.abort()
+
+        def snapshot(read):
+            read.extend(doc["title"] and doc for doc in shared.snapshot()["docs"].values())
+
+        def run(reader):
+            read = [[] for i in range(threads)]
+            workers = [threading.Thread(target=reader, args=(r,)) for r in read]
+            gc.collect()
+            tracemalloc.start()
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            seconds = time.perf_counter() - start
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            distinct = len(set(id(doc) for docs in read for doc in docs))
+            return seconds, memory, distinct
+
+        rows.append(("ChurroDb per thread",) + run(private))
+        rows.append(("ThreadedChurroDb",) + run(snapshot))
+    finally:
+        transaction.abort()
+        shutil.rmtree(path)
+
+    print("{t} threads reading {n} documents each".format(t=threads, n=documents))
+    print("{:<20} {:>10} {:>12} {:>10}".format("", "time [s]", "memory [KiB]", "objects"))
+    for name, seconds, memory, distinct in rows:
+        print("{:<20} {:>10.3f} {:>12} {:>10}".format(name, seconds, memory // 1024, distinct))
+    return rows
+
+
+def bench_async(documents=500, requests=8):
+    """
+    ``requests`` overlapping object_by_hash requests for each of
+    ``documents`` oids, run in an executor one by one and coalesced by
+    AsyncChurroDb
+    """
+    path = tempfile.mkdtemp(prefix="churrodb-bench-")
+    rows = []
+    try:
+        db = churrodb.ChurroDb(path)
+        db["docs"] = churro.PersistentFolder()
+        for i in range(documents):
+            db["docs"][str(i)] = _document(i)
+        db.save()
+        oids = [db.fs.hash("/docs/{i}.churro".format(i=i)) for i in range(documents)] * requests
+        transaction.abort()
+
+        # no cached objects, only the overlapping reads are spared
+        async def executor():
+            shared = churrodb.ThreadedChurroDb(path, object_cache=churrodb.ObjectCache(0))
+            loop = asyncio.get_running_loop()
+            with concurrent.futures.ThreadPoolExecutor(4) as pool:
+                await asyncio.gather(*[
+                    loop.run_in_executor(pool, lambda oid=oid: shared.object_by_hash(oid))
+                    for oid in oids])
+
+        async def coalesced():
+            async with churrodb.AsyncChurroDb(path, object_cache=churrodb.ObjectCache(0)) as adb:
+                await asyncio.gather(*[adb.object_by_hash(oid) for oid in oids])
+
+        rows.append(("executor", _timed(asyncio.run, executor())))
+        rows.append(("AsyncChurroDb", _timed(asyncio.run, coalesced())))
+    finally:
+        transaction.abort()
+        shutil.rmtree(path)
+
+    print("{r} overlapping reads of each of {n} documents".format(r=requests, n=documents))
+    print("{:<18} {:>10}".format("", "time [s]"))
+    for name, seconds in rows:
+        print("{:<18} {:>10.3f}".format(name, seconds))
+    return rows
+
+
+def bench_merge(threads=4, commits=10):
+    """
+    ``threads`` writers each committing ``commits`` documents into one
+    indexed collection, with and without merging saves
+    """
+    rows = []
+    for merge in (False, True):
+        path = tempfile.mkdtemp(prefix="churrodb-bench-")
+        try:
+            db = churrodb.ChurroDb(path)
+            db["docs"] = _IndexedCollection()
+            db["docs"].init_index()
+            db["docs"]["_index"]["_title"] = churrodb.GitObjectHashIndex()
+            db.save()
+            shared = churrodb.ThreadedChurroDb(path, merge=merge)
+            stats = collections.Counter()
+
+            def write(n):
+                for i in range(commits):
+                    transaction.begin()
+                    db = shared.local
+                    db["docs"]["{n}-{i}".format(n=n, i=i)] = _document(i)
+                    try:
+                        db.save()
+                        stats["commits"] += 1
+                    except Exception:
+                        stats["failed"] += 1
+                    stats.update(db.merge_stats)
+
+            workers = [threading.Thread(target=write, args=(n,)) for n in range(threads)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            seconds = time.perf_counter() - start
+            rows.append((
+                "merge" if merge else "default", seconds, stats["commits"], stats["failed"],
+                stats["merges"], stats["retries"]))
+        finally:
+            transaction.abort()
+            shutil.rmtree(path)
+
+    print("{t} writers committing {c} documents each".format(t=threads, c=commits))
+    print("{:<10} {:>10} {:>8} {:>8} {:>8} {:>8}".format(
+        "", "time [s]", "commits", "failed", "merges", "retries"))
+    for row in rows:
+        print("{:<10} {:>10.3f} {:>8} {:>8} {:>8} {:>8}".format(*row))
+    return rows
+
+
+def bench_group_commit(threads=8, commits=10, window=0.05):
+    """
+    ``threads`` writers each saving ``commits`` documents into one indexed
+    collection, merging saves and a GroupCommit
+    """
+    rows = []
+    for name, kwargs in [
+            ("merge", {"merge": True}),
+            ("group commit", {"group_commit": churrodb.GroupCommit(window, threads)})]:
+        path = tempfile.mkdtemp(prefix="churrodb-bench-")
+        try:
+            db = churrodb.ChurroDb(path)
+            db["docs"] = _IndexedCollection()
+            db["docs"].init_index()
+            db["docs"]["_index"]["_title"] = churrodb.GitObjectHashIndex()
+            db.save()
+            shared = churrodb.ThreadedChurroDb(path, **kwargs)
+            failed = []
+
+            def write(n):
+                for i in range(commits):
+                    transaction.begin()
+                    shared["docs"]["{n}-{i}".format(n=n, i=i)] = _document(i)
+                    try:
+                        shared.save()
+                    except Exception as why:
+                        failed.append(why)
+
+            workers = [threading.Thread(target=write, args=(n,)) for n in range(threads)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            seconds = time.perf_counter() - start
+            count = int(subprocess.check_output(["git", "rev-list", "--count", "HEAD"], cwd=path)) - 1
+            rows.append((name, seconds, threads * commits - len(failed), count))
+        finally:
+            transaction.abort()
+            shutil.rmtree(path)
+
+    print("{t} writers saving {c} documents each".format(t=threads, c=commits))
+    print("{:<14} {:>10} {:>8} {:>8}".format("", "time [s]", "saves", "commits"))
+    for row in rows:
+        print("{:<14} {:>10.3f} {:>8} {:>8}".format(*row))
+    return rows
+
+
+def bench_index_checkpoint(documents=5000, changes=10):
+    """
+    idx_rebuild of two hash indexes of a collection of ``documents``,
+    without tree checkpoints, unchanged and with ``changes`` changed items
+    """
+    path = tempfile.mkdtemp(prefix="churrodb-bench-")
+    rows = []
+    try:
+        db = churrodb.ChurroDb(path)
+        db["docs"] = _IndexedCollection()
+        db["docs"].init_index()
+        db["docs"]["_index"]["_name"] = churrodb.GitObjectHashIndex()
+        db["docs"]["_index"]["_oid"] = churrodb.GitObjectHashIndex(True)
+        for i in range(documents):
+            db["docs"][str(i)] = _document(i)
+        db.save()
+
+        def rebuild(db):
+            db["docs"].idx_rebuild()
+            db.flush()
+
+        transaction.begin()
+        db = churrodb.ChurroDb(path)
+        for index in db["docs"]["_index"].values():
+            index.trees = None
+        rows.append(("no checkpoint", _timed(rebuild, db)))
+        db.save()
+
+        transaction.begin()
+        db = churrodb.ChurroDb(path)
+        rows.append(("unchanged", _timed(rebuild, db)))
+        transaction.abort()
+
+        transaction.begin()
+        db = churrodb.ChurroDb(path)
+        for i in range(changes):
+            db["docs"][str(i)]["title"] = "changed"
+        rows.append(("{n} changed".format(n=changes), _timed(rebuild, db)))
+    finally:
+        transaction.abort()
+        shutil.rmtree(path)
+
+    print("idx_rebuild of {n} documents".format(n=documents))
+    print("{:<16} {:>10}".format("", "time [s]"))
+    for name, seconds in rows:
+        print("{:<16} {:>10.3f}".format(name, seconds))
+    return rows
+
+
+def _tree_oids(repo, tree, path=""):
+    for mode, type, oid, name in repo.tree(tree):
+        if type == b"tree":
+            yield from _tree_oids(repo, oid, path + "/" + name.decode())
+        else:
+            yield path + "/" + name.decode(), oid
+
+
+def bench_changes(sizes=(1000, 10000, 50000), changes=10, folder_size=100):
+    """
+    finding the ``changes`` documents modified by the last commit through
+    ChurroDb.changes and by comparing the oids of every document of both
+    commits, the documents are kept in folders of ``folder_size``
+    """
+    rows = []
+    for size in sizes:
+        path = tempfile.mkdtemp(prefix="churrodb-bench-")
+        try:
+            db = churrodb.ChurroDb(path)
+            db["docs"] = churro.PersistentFolder()
+            for i in range(size):
+                folder = str(i // folder_size)
+                if folder not in db["docs"]:
+                    db["docs"][folder] = churro.PersistentFolder()
+                db["docs"][folder][str(i)] = _document(i)
+            db.save()
+            previous = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=path).decode().strip()
+            transaction.begin()
+            db = churrodb.ChurroDb(path)
+            for i in range(changes):
+                i = i * size // changes
+                db["docs"][str(i // folder_size)][str(i)]["title"] = "changed"
+            db.save()
+            transaction.begin()
+            db = churrodb.ChurroDb(path)
+
+            def compared():
+                repo = churrodb.git.repository(path)
+                old = dict(_tree_oids(repo, previous))
+                found = [name for name, oid in _tree_oids(repo, "HEAD") if old.get(name) != oid]
+                assert len(found) == changes
+                new = dict(_tree_oids(repo, "HEAD"))
+                for name in found:
+                    db.object_by_hash(new[name])
+
+            def changed():
+                found = list(db.changes(previous))
+                assert len(found) == changes
+                for change in found:
+                    change.new
+
+            rows.append((size, _timed(compared), _timed(changed)))
+        finally:
+            transaction.abort()
+            shutil.rmtree(path)
+
+    print("finding {c} changed documents between two commits".format(c=changes))
+    print("{:>10} {:>14} {:>14}".format("documents", "compare [s]", "changes [s]"))
+    for size, compare_seconds, changes_seconds in rows:
+        print("{:>10} {:>14.4f} {:>14.4f}".format(size, compare_seconds, changes_seconds))
+
+
+def bench_maintenance(commits=(100, 500), documents=10):
+    """
+    object counts, sizes and lookup latency before and after Maintenance
+    repacked the repository written by ``commits`` commits of ``documents``
+    changed documents each. packed objects are deltas, so cold lookups
+    get slower while the repository gets much smaller
+    """
+    rows = []
+    for count in commits:
+        path = tempfile.mkdtemp(prefix="churrodb-bench-")
+        try:
+            db = churrodb.ChurroDb(path)
+            db["docs"] = churro.PersistentFolder()
+            db.save()
+            for commit in range(count):
+                transaction.begin()
+                db = churrodb.ChurroDb(path)
+                for i in range(documents):
+                    db["docs"][str(i)] = _document(commit * documents + i)
+                db.save()
+            report = churrodb.Maintenance(loose_objects=0, sample=200).run(db.fs.db)
+            rows.append((count, report))
+        finally:
+            transaction.abort()
+            shutil.rmtree(path)
+
+    print("repacking after commits of {d} documents each".format(d=documents))
+    print("{:>8} {:>9} {:>9} {:>11} {:>11} {:>12} {:>12} {:>9}".format(
+        "commits", "loose", "packs", "size [KiB]", "after [KiB]",
+        "lookup [us]", "after [us]", "time [s]"))
+    for count, report in rows:
+        before, after = report["before"], report["after"]
+        print("{:>8} {:>9} {:>9} {:>11} {:>11} {:>12.1f} {:>12.1f} {:>9.3f}".format(
+            count, before["count"], after["packs"],
+            before["size"] + before["size_pack"], after["size"] + after["size_pack"],
+            before["latency"] * 1e6, after["latency"] * 1e6, report["seconds"]))
+
+
+BENCHMARKS = {
+    "index_rebuild": bench_index_rebuild,
+    "codec": bench_codec,
+    "index_storage": bench_index_storage,
+    "namespace_lookup": bench_namespace_lookup,
+    "field_index": bench_field_index,
+    "scan": bench_scan,
+    "child_cache": bench_child_cache,
+    "index_pipeline": bench_index_pipeline,
+    "deferred_index": bench_deferred_index,
+    "bulk_load": bench_bulk_load,
+    "snapshot": bench_snapshot,
+    "threaded": bench_threaded,
+    "async": bench_async,
+    "merge": bench_merge,
+    "group_commit": bench_group_commit,
+    "index_checkpoint": bench_index_checkpoint,
+    "changes": bench_changes,
+    "maintenance": bench_maintenance,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="run churrodb benchmarks")
+    parser.add_argument(
+        "benchmarks", nargs="*",
+        help="one or more of: " + ", ".join(sorted(BENCHMARKS)))
+    args = parser.parse_args(argv)
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark '{name}'".format(name=name))
+
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+        print()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
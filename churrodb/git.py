@@ -0,0 +1,517 @@
+"""
+long-lived git plumbing processes, shared per repository.
+
+instead of spawning one git process per object, requests are pipelined
+through one ``git cat-file --batch`` and one ``git cat-file --batch-check``
+process per repository. use :func:`repository` to get the shared instance.
+"""
+import os
+import mmap
+import zlib
+import atexit
+import hashlib
+import binascii
+import threading
+import subprocess
+import collections
+
+# number of requests written to a git process before reading the responses.
+# small enough that the requests always fit into the pipe buffer, so writing
+# never blocks while git waits for us to read its output
+BATCH_SIZE = 512
+
+
+class _CatFile(object):
+    def __init__(self, db, option):
+        self.db = db
+        self.option = option
+        self._proc = None
+
+    def _process(self):
+        if self._proc is None or self._proc.poll() is not None:
+            self._proc = subprocess.Popen(
+                ["git", "cat-file", self.option],
+                cwd=self.db, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        return self._proc
+
+    def request(self, names, read_data):
+        """
+        :return: list of (oid, type, data) tuples, ``None`` for missing
+        objects. ``data`` is ``None`` unless ``read_data`` is set.
+        """
+        proc = self._process()
+        proc.stdin.write(b"".join(
+            (name if isinstance(name, bytes) else name.encode("utf-8")) + b"\n"
+            for name in names))
+        proc.stdin.flush()
+
+        results = []
+        for name in names:
+            header = proc.stdout.readline()
+            if not header:
+                raise BrokenPipeError("git cat-file terminated unexpectedly")
+            fields = header.split()
+            if fields[-1] in (b"missing", b"ambiguous"):
+                results.append(None)
+                continue
+            oid, type, size = fields
+            data = None
+            if read_data:
+                data = proc.stdout.read(int(size))
+                proc.stdout.read(1)
+            results.append((oid.decode("ascii"), type.decode("ascii"), data))
+        return results
+
+    def close(self):
+        proc, self._proc = self._proc, None
+        if proc is not None and proc.poll() is None:
+            proc.stdin.close()
+            proc.wait()
+            proc.stdout.close()
+
+
+# bytes of delta bases kept per pack. objects written one after the other
+# (e.g. by git fast-import) form long delta chains, each object is the base
+# of the next one
+DELTA_BASE_CACHE_SIZE = 16 * 1024 * 1024
+
+_PACK_TYPES = {1: "commit", 2: "tree", 3: "blob", 4: "tag"}
+_OFS_DELTA = 6
+_REF_DELTA = 7
+
+
+def is_oid(name):
+    """whether ``name`` is a full hexadecimal (sha1) object id"""
+    if len(name) != 40:
+        return False
+    try:
+        int(name, 16)
+    except ValueError:
+        return False
+    return True
+
+
+class _Pack(object):
+    def __init__(self, path):
+        with open(path + ".idx", "rb") as fh:
+            self._idx = fh.read()
+        if self._idx[:8] != b"\377tOc\0\0\0\2":
+            raise ValueError("unsupported pack index " + path + ".idx")
+        self._fanout = [
+            int.from_bytes(self._idx[8 + i * 4:12 + i * 4], "big")
+            for i in range(256)]
+        self._count = self._fanout[-1]
+        with open(path + ".pack", "rb") as fh:
+            self._pack = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._bases = collections.OrderedDict()
+        self._bases_size = 0
+        self._bases_lock = threading.Lock()
+
+    def offset(self, oid):
+        first = oid[0]
+        lo = self._fanout[first - 1] if first else 0
+        hi = self._fanout[first]
+        base = 8 + 256 * 4
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = self._idx[base + mid * 20:base + mid * 20 + 20]
+            if found < oid:
+                lo = mid + 1
+            elif found > oid:
+                hi = mid
+            else:
+                pos = base + self._count * 24 + mid * 4
+                offset = int.from_bytes(self._idx[pos:pos + 4], "big")
+                if offset & 0x80000000:
+                    pos = base + self._count * 28 + (offset & 0x7fffffff) * 8
+                    offset = int.from_bytes(self._idx[pos:pos + 8], "big")
+                return offset
+        return None
+
+    def read(self, offset, objects):
+        pack = self._pack
+        byte = pack[offset]
+        type = (byte >> 4) & 7
+        pos = offset + 1
+        while byte & 0x80:
+            byte = pack[pos]
+            pos += 1
+
+        if type == _OFS_DELTA:
+            byte = pack[pos]
+            pos += 1
+            distance = byte & 0x7f
+            while byte & 0x80:
+                byte = pack[pos]
+                pos += 1
+                distance = ((distance + 1) << 7) | (byte & 0x7f)
+            base_type, base = self._base(offset - distance, objects)
+            return base_type, _apply_delta(base, self._inflate(pos))
+        if type == _REF_DELTA:
+            base = objects.read(binascii.hexlify(pack[pos:pos + 20]).decode("ascii"))
+            if base is None:
+                raise KeyError("missing delta base")
+            return base[0], _apply_delta(base[1], self._inflate(pos + 20))
+        return _PACK_TYPES[type], self._inflate(pos)
+
+    def _base(self, offset, objects):
+        with self._bases_lock:
+            found = self._bases.get(offset)
+            if found is not None:
+                self._bases.move_to_end(offset)
+                return found
+        found = self.read(offset, objects)
+        with self._bases_lock:
+            if offset not in self._bases:
+                self._bases[offset] = found
+                self._bases_size += len(found[1])
+                while self._bases_size > DELTA_BASE_CACHE_SIZE and len(self._bases) > 1:
+                    evicted_offset, evicted = self._bases.popitem(last=False)
+                    self._bases_size -= len(evicted[1])
+        return found
+
+    def _inflate(self, pos):
+        inflater = zlib.decompressobj()
+        chunks = []
+        while not inflater.eof:
+            chunk = self._pack[pos:pos + 65536]
+            if not chunk:
+                raise ValueError("truncated pack")
+            pos += len(chunk)
+            chunks.append(inflater.decompress(chunk))
+        return b"".join(chunks)
+
+    def close(self):
+        self._pack.close()
+
+
+def _delta_varint(delta, pos):
+    value = shift = 0
+    while True:
+        byte = delta[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def _apply_delta(base, delta):
+    source_size, pos = _delta_varint(delta, 0)
+    target_size, pos = _delta_varint(delta, pos)
+    if source_size != len(base):
+        raise ValueError("delta does not apply to its base")
+
+    out = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (i * 8)
+                    pos += 1
+            for i in range(3):
+                if op & (1 << (4 + i)):
+                    size |= delta[pos] << (i * 8)
+                    pos += 1
+            out += base[offset:offset + (size or 0x10000)]
+        elif op:
+            out += delta[pos:pos + op]
+            pos += op
+        else:
+            raise ValueError("invalid delta opcode")
+
+    if len(out) != target_size:
+        raise ValueError("delta result has wrong size")
+    return bytes(out)
+
+
+class ObjectDatabase(object):
+    """
+    reads loose and packed objects of a repository without leaving the
+    process. objects which can't be found here (e.g. in alternates) are
+    reported as missing, callers fall back to git.
+    """
+    def __init__(self, db):
+        self.objects = os.path.join(db, "objects")
+        self._lock = threading.Lock()
+        self._packs = {}
+        self._pack_names = None
+
+    def read(self, oid):
+        """:return: (type, data) of the object ``oid`` or ``None``"""
+        found = self._read_loose(oid)
+        if found is None:
+            found = self._read_packed(oid, self._packs_list())
+        if found is None and self._refresh_packs():
+            found = self._read_packed(oid, self._packs_list())
+        return found
+
+    def _read_loose(self, oid):
+        try:
+            with open(os.path.join(self.objects, oid[:2], oid[2:]), "rb") as fh:
+                data = zlib.decompress(fh.read())
+        except FileNotFoundError:
+            return None
+        nul = data.index(b"\0")
+        type, size = data[:nul].split()
+        return type.decode("ascii"), data[nul + 1:]
+
+    def _read_packed(self, oid, packs):
+        binary = binascii.unhexlify(oid)
+        for pack in packs:
+            offset = pack.offset(binary)
+            if offset is not None:
+                return pack.read(offset, self)
+        return None
+
+    def _packs_list(self):
+        if self._pack_names is None:
+            self._refresh_packs()
+        return list(self._packs.values())
+
+    def _refresh_packs(self):
+        """rescans the pack directory, returns True if something changed"""
+        pack_dir = os.path.join(self.objects, "pack")
+        try:
+            names = set(
+                name[:-4] for name in os.listdir(pack_dir)
+                if name.endswith(".idx"))
+        except FileNotFoundError:
+            names = set()
+
+        with self._lock:
+            if names == self._pack_names:
+                return False
+            packs = {}
+            for name in names:
+                pack = self._packs.get(name)
+                if pack is None:
+                    try:
+                        pack = _Pack(os.path.join(pack_dir, name))
+                    except (OSError, ValueError):
+                        continue
+                packs[name] = pack
+            self._packs = packs
+            self._pack_names = names
+        return True
+
+    def close(self):
+        with self._lock:
+            for pack in self._packs.values():
+                pack.close()
+            self._packs = {}
+            self._pack_names = None
+
+
+class Repository(object):
+    """
+    pipelines object lookups of one repository through long-lived
+    ``git cat-file`` processes. safe to share between threads.
+
+    ``db`` is the path to the git directory (``.git`` or a bare repository).
+    """
+    def __init__(self, db):
+        self.db = db
+        self._lock = threading.Lock()
+        self._batch = _CatFile(db, "--batch")
+        self._check = _CatFile(db, "--batch-check")
+        self.objects = ObjectDatabase(db)
+        # per thread, threads prefetch for the folders they iterate
+        self._local = threading.local()
+
+    def _request(self, cat_file, names, read_data):
+        results = []
+        with self._lock:
+            for start in range(0, len(names), BATCH_SIZE):
+                chunk = names[start:start + BATCH_SIZE]
+                try:
+                    found = cat_file.request(chunk, read_data)
+                except (OSError, ValueError):
+                    found = None
+                if found is None or (read_data and None in found):
+                    # objects are only read by names known to exist, so they
+                    # may have been written or repacked after the process
+                    # started, or the repository was recreated. a fresh
+                    # process sees the current object database
+                    cat_file.close()
+                    found = cat_file.request(chunk, read_data)
+                results.extend(found)
+        return results
+
+    def info(self, names):
+        """
+        resolves object names (oids, ``<rev>:<path>``, ...) to (oid, type,
+        None) tuples, ``None`` for names which do not exist
+        """
+        return self._request(self._check, list(names), False)
+
+    def oids(self, names):
+        """resolves object names to oids, ``None`` for names which do not exist"""
+        return [found and found[0] for found in self.info(names)]
+
+    def read_many(self, names):
+        """
+        :return: list of (oid, type, data) tuples, ``None`` for missing
+        objects. objects named by their oid are read in-process, everything
+        else is resolved by git.
+        """
+        names = list(names)
+        results = [None] * len(names)
+        pending = []
+        for i, name in enumerate(names):
+            if isinstance(name, bytes):
+                name = name.decode("ascii")
+            found = self.objects.read(name) if is_oid(name) else None
+            if found is None:
+                pending.append(i)
+            else:
+                results[i] = (name, found[0], found[1])
+
+        if pending:
+            found = self._request(self._batch, [names[i] for i in pending], True)
+            for i, result in zip(pending, found):
+                results[i] = result
+        return results
+
+    def read(self, name):
+        """:return: (oid, type, data) of a single object, raises KeyError if missing"""
+        found = getattr(self._local, "prefetched", {}).pop(name, None)
+        if found is None:
+            found = self.read_many([name])[0]
+        if found is None:
+            raise KeyError(name)
+        return found
+
+    def prefetch(self, oids, found=None):
+        """
+        reads the objects in one pipelined pass and keeps them until they
+        are consumed by :meth:`read`. replaces what an earlier call prefetched.
+        ``found`` are the results of :meth:`read_many` for ``oids``, if they
+        were read already (e.g. by another thread).
+        """
+        oids = list(oids)
+        if found is None:
+            found = self.read_many(oids)
+        self._local.prefetched = dict(zip(oids, found))
+
+    def tree(self, treeish):
+        """
+        :return: list of (mode, type, oid, name) tuples of the tree entries,
+        ``mode``, ``type`` and ``name`` being bytes, like ``git ls-tree``
+        """
+        if isinstance(treeish, bytes):
+            treeish = treeish.decode("ascii")
+        found = self.read_many([treeish])[0] if is_oid(treeish) else None
+        if found is not None and found[1] == "commit":
+            # the first line of a commit is "tree <oid>"
+            found = self.read_many([found[2][5:45].decode("ascii")])[0]
+        if found is None or found[1] != "tree":
+            # tags and other revisions are peeled by git
+            found = self.read(treeish + "^{tree}")
+        oid, type, data = found
+        entries = []
+        pos = 0
+        while pos < len(data):
+            space = data.index(b" ", pos)
+            nul = data.index(b"\0", space)
+            mode = data[pos:space]
+            name = data[space + 1:nul]
+            entry_oid = data[nul + 1:nul + 21].hex()
+            if mode == b"40000":
+                entry_type = b"tree"
+            elif mode == b"160000":
+                entry_type = b"commit"
+            else:
+                entry_type = b"blob"
+            entries.append((mode, entry_type, entry_oid, name))
+            pos = nul + 21
+        return entries
+
+    def close(self):
+        with self._lock:
+            self._batch.close()
+            self._check.close()
+        self.objects.close()
+
+
+class BlobWriter(object):
+    """
+    writes blobs into a pack through one ``git fast-import`` process, instead
+    of one ``git hash-object`` process per blob. the oids are known right
+    away, but the blobs can only be read once :meth:`close` returned.
+    """
+    def __init__(self, db):
+        self.db = db
+        self._proc = subprocess.Popen(
+            ["git", "fast-import", "--quiet", "--done"],
+            cwd=db, stdin=subprocess.PIPE)
+
+    def write_many(self, blobs):
+        """:return: the oids of ``blobs``, a sequence of bytes"""
+        oids = []
+        chunks = []
+        for data in blobs:
+            header = b"blob %d\0" % len(data)
+            oid = hashlib.sha1(header)
+            oid.update(data)
+            oids.append(oid.hexdigest())
+            chunks.extend((b"blob\ndata %d\n" % len(data), data, b"\n"))
+        self._proc.stdin.write(b"".join(chunks))
+        return oids
+
+    def close(self):
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        proc.stdin.write(b"done\n")
+        proc.stdin.close()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, "git fast-import")
+
+    def abort(self):
+        proc, self._proc = self._proc, None
+        if proc is not None:
+            proc.kill()
+            proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+_repositories = {}
+_repositories_lock = threading.Lock()
+# the repositories by the path they were asked for, resolving the real
+# path costs more than reading a small object
+_aliases = {}
+
+
+def repository(db):
+    """:return: the shared :class:`Repository` of the git directory ``db``"""
+    repo = _aliases.get(db)
+    if repo is not None:
+        return repo
+    key = os.path.realpath(db)
+    with _repositories_lock:
+        repo = _repositories.get(key)
+        if repo is None:
+            repo = _repositories[key] = Repository(key)
+        _aliases[db] = repo
+    return repo
+
+
+@atexit.register
+def close_all():
+    with _repositories_lock:
+        for repo in _repositories.values():
+            repo.close()
+        _repositories.clear()
+        _aliases.clear()
@@ -1,11 +1,15 @@
 import os
 import json
+import gc
+import time
+import asyncio
 import shutil
 import acidfs
 import churro
 import logging
 import churrodb
 import unittest
+import weakref
 import threading
 import subprocess
 import transaction
@@ -41,6 +45,11 @@ class IndexedCollection(churrodb.IndexMixin, churro.PersistentFolder):
     index_factory = churrodb.IndexesFolder
 
 
+class DeferredCollection(IndexedCollection):
+    __module__ = "churrodb.tests"
+    idx_deferred = True
+
+
 class GitIndexedCollection(churrodb.GitIndexMixin, churro.PersistentFolder):
     __module__ = "churrodb.tests"
     _index = churro.PersistentProperty()
@@ -256,6 +265,157 @@ class ChurroDbTests(unittest.TestCase):
 
         transaction.abort()
 
+    def test_lazy_root(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, factory=TestRootFactory)
+        db.init_index()
+        db["_index"]["_git"] = churrodb.GitObjectHashIndex(name="root_git", inverse=True)
+        for name in ["a", "b", "c"]:
+            db[name] = IndexedCollection()
+            db[name].init_index()
+            db[name]["x"] = Dummy(name)
+        db.save()
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, factory=TestRootFactory, lazy=True)
+        contents = db.root()._contents
+
+        self.assertEqual(4, len(db))
+        self.assertListEqual(["_index", "a", "b", "c"], sorted(db.keys()))
+        self.assertTrue("a" in db)
+        self.assertFalse("d" in db)
+        self.assertIsNone(contents["a"][1])
+        self.assertIsNone(contents["b"][1])
+
+        self.assertEqual("a", db["a"]["x"].value)
+        self.assertIs(db, db["a"].churrodb)
+        self.assertIsNotNone(contents["a"][1])
+        self.assertIsNone(contents["b"][1])
+        self.assertTrue("root_git" in db.named_indexes)
+
+        db["d"] = Dummy("d")
+        del db["c"]
+        db.save()
+
+        db = churrodb.ChurroDb(self.churrodb_path, factory=TestRootFactory, lazy=True)
+        self.assertListEqual(["_index", "a", "b", "d"], sorted(db))
+        self.assertEqual("d", db.get("d").value)
+        self.assertEqual("d", db.idx_find_first(db.fs.hash("d.churro")))
+
+    def test_deferred_registration(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, factory=TestRootFactory)
+        db.init_index()
+        db["_index"]["_git"] = churrodb.GitObjectHashIndex(name="root_git", inverse=True)
+        db["coll"] = GitIndexedCollection(idx_name="coll", idx_supply="root_git")
+        db["coll"].init_index()
+        db["coll"]["x"] = Dummy("e")
+        db.save()
+
+        tx = transaction.begin()
+        folder = churrodb.ChurroDbRoot()
+        for i in range(50):
+            folder[str(i)] = churrodb.ChurroDbRoot()
+
+        db = churrodb.ChurroDb(
+            self.churrodb_path, factory=TestRootFactory, deferred_registration=True)
+        self.assertFalse("root_git" in db.named_indexes)
+
+        with unittest.mock.patch.object(
+                churrodb.ChurroDbAware, "register", autospec=True) as register:
+            folder.churrodb = db
+        self.assertEqual(0, register.call_count)
+        self.assertIs(db, folder["7"].churrodb)
+
+        db["coll"]["y"] = Dummy("f")
+        db.save()
+
+        db = churrodb.ChurroDb(self.churrodb_path, factory=TestRootFactory)
+        self.assertEqual("f", db["coll"][db.idx_find("3534c705a203d4ef38e2e4d1b6b6d2a63dd3866d")[0]].value)
+
+    def test_scan(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["folder"] = churro.PersistentFolder()
+        for i in range(20):
+            db["folder"][str(i)] = Dummy(i)
+        db["folder"]["sub"] = churro.PersistentFolder()
+        db.save()
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["folder"]["3"].value = "changed"
+
+        scanned = dict(db.scan("folder", batch_size=7))
+
+        self.assertEqual(21, len(scanned))
+        self.assertEqual(5, scanned["5"].value)
+        self.assertEqual("changed", scanned["3"].value)
+        self.assertIsInstance(scanned["sub"], churro.PersistentFolder)
+        loaded = [name for name, (type, obj) in db["folder"]._contents.items() if obj is not None]
+        self.assertEqual(["3"], loaded)
+
+    def test_child_cache(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["folder"] = churro.PersistentFolder()
+        for i in range(20):
+            db["folder"]["{i:02}".format(i=i)] = Dummy(i)
+        db.save()
+
+        tx = transaction.begin()
+        cache = churrodb.ChildCache(max_objects=5)
+        db = churrodb.ChurroDb(self.churrodb_path, child_cache=cache)
+        folder = db["folder"]
+
+        kept = folder["00"]
+        changed = folder["01"]
+        changed.value = "changed"
+        values = [obj.value for obj in folder.values()]
+
+        self.assertEqual(list(range(2, 20)), values[2:])
+        self.assertEqual(5, len(cache))
+        loaded = [name for name, (type, obj) in folder._contents.items() if obj is not None]
+        # the dirty child is never evicted
+        self.assertTrue("01" in loaded)
+        self.assertTrue(len(loaded) <= 6)
+        self.assertEqual(20, cache.stats()["misses"])
+        self.assertTrue(cache.stats()["evictions"] >= 14)
+
+        # evicted, but still referenced: the same object is handed out
+        self.assertFalse("00" in loaded)
+        self.assertIs(kept, folder["00"])
+
+        kept.value = "kept"
+        for obj in folder.values():
+            pass
+        db.save()
+
+        db = churrodb.ChurroDb(self.churrodb_path)
+        self.assertEqual("kept", db["folder"]["00"].value)
+        self.assertEqual("changed", db["folder"]["01"].value)
+
+    def test_child_cache_lfu(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["folder"] = churro.PersistentFolder()
+        for i in range(10):
+            db["folder"][str(i)] = Dummy(i)
+        db.save()
+
+        tx = transaction.begin()
+        cache = churrodb.ChildCache(max_objects=3, policy="lfu")
+        db = churrodb.ChurroDb(self.churrodb_path, child_cache=cache)
+        folder = db["folder"]
+        for i in range(3):
+            folder["0"]
+        for name in "123456789":
+            folder[name]
+
+        self.assertTrue(folder._contents["0"][1] is not None)
+        self.assertEqual(3, len(cache))
+        self.assertRaises(ValueError, churrodb.ChildCache, policy="random")
+
     def test_changing_branches(self):
         tx = transaction.begin()
 
@@ -304,6 +464,63 @@ class ChurroDbTests(unittest.TestCase):
             "__churro_class__": "churro.Persistent"
         }, result)
 
+    def test_saving_dirty_only(self):
+        tx = transaction.begin()
+
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["folder"] = churro.PersistentFolder()
+        db["folder"]["sub"] = churro.PersistentFolder()
+        for name in "abc":
+            db["folder"][name] = churro.PersistentDict()
+            db["folder"]["sub"][name] = churro.PersistentDict()
+        db.save()
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        list(db["folder"]["sub"].values())
+        db["folder"]["a"]["c"] = "changed"
+        db.flush()
+
+        self.assertEqual(1, db.flush_stats["objects"])
+        # the root and "folder" manifests, "sub" is clean
+        self.assertEqual(2, db.flush_stats["folders"])
+        self.assertEqual(1, db.flush_stats["skipped"])
+
+        db.flush()
+        self.assertEqual(0, db.flush_stats["objects"])
+        db.save()
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        self.assertEqual("changed", db["folder"]["a"]["c"])
+
+    def test_saving_compact_codec(self):
+        tx = transaction.begin()
+
+        db = churrodb.ChurroDb(self.churrodb_path, codec=churrodb.CompactJsonCodec())
+        db["a"] = churro.Persistent()
+        db.save()
+        with open(os.path.join(self.churrodb_path, "a.churro")) as fh:
+            compact = fh.read()
+
+        self.assertEqual(
+            '{"__churro_class__":"churro.Persistent","__churro_data__":{}}', compact)
+
+        # compact and indented blobs are read back by either codec
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        self.assertIsInstance(db["a"], churro.Persistent)
+        db["b"] = churro.Persistent()
+        db.save()
+        self.assertDictEqual({
+            "__churro_data__": {},
+            "__churro_class__": "churro.Persistent"
+        }, read_json(os.path.join(self.churrodb_path, "b.churro")))
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, codec=churrodb.CompactJsonCodec())
+        self.assertIsInstance(db["b"], churro.Persistent)
+
     def test_concurrent_noconflict(self):
         # initial commit so that we do not generate a false conflict
         # strange, but see acidfs code for reference
@@ -640,6 +857,1056 @@ class ChurroDbTests(unittest.TestCase):
 
         transaction.abort()
 
+    def test_index_git_object_hash_incremental(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+
+        db["a"] = IndexedCollection()
+        db["a"].init_index()
+        db["a"]["_index"]["_a"] = churrodb.GitObjectHashIndex(True)
+        db["a"]["_index"]["_b"] = churrodb.GitObjectHashIndex()
+        db["a"]["b"] = Dummy("c")
+        db["a"]["c"] = Dummy("d")
+        db["a"]["d"] = Dummy("e")
+
+        db.save()
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["a"]["b"].value = "x"
+        db["a"]["e"] = Dummy("f")
+        del db["a"]["d"]
+
+        with unittest.mock.patch.object(db.fs, "hash", wraps=db.fs.hash) as fs_hash:
+            db.save()
+
+        # the changed items are found by diffing the collection's tree
+        # against the one the indexes were updated from
+        hashed = set(call[0][0] for call in fs_hash.call_args_list)
+        self.assertFalse("/a/c.churro" in hashed)
+        self.assertFalse("/a/e.churro" in hashed)
+        self.assertTrue("/a" in hashed)
+
+        db = churrodb.ChurroDb(self.churrodb_path)
+        coll = db["a"]
+
+        self.assertEqual("a58a8f0b987cbb685ac125a060fb4ad0be7e76a0", coll["_index"]["_b"].idx_find_first("b"))
+        self.assertEqual("ab3a9aad770bc930fef6b1fd4eb03ad6d67fd407", coll["_index"]["_b"].idx_find_first("c"))
+        self.assertEqual("3534c705a203d4ef38e2e4d1b6b6d2a63dd3866d", coll["_index"]["_b"].idx_find_first("e"))
+        self.assertEqual("b", coll["_index"]["_a"].idx_find_first("a58a8f0b987cbb685ac125a060fb4ad0be7e76a0"))
+        self.assertEqual("e", coll["_index"]["_a"].idx_find_first("3534c705a203d4ef38e2e4d1b6b6d2a63dd3866d"))
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+
+        with unittest.mock.patch.object(db.fs, "hash", wraps=db.fs.hash) as fs_hash:
+            db["a"].idx_rebuild()
+
+        # a full rebuild hashes all items at once, by listing the folder
+        hashed = set(call[0][0] for call in fs_hash.call_args_list)
+        self.assertTrue("/a" in hashed)
+
+        tx.abort()
+
+    def test_index_git_object_hash_added_later(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["a"] = IndexedCollection()
+        db["a"].init_index()
+        db["a"]["_index"]["_a"] = churrodb.GitObjectHashIndex()
+        for i in range(5):
+            db["a"]["d{i}".format(i=i)] = churro.PersistentDict({"value": i})
+        db.save()
+
+        # an index added to a collection with items indexes all of them,
+        # not just those changed along with it
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["a"]["_index"]["_b"] = churrodb.GitObjectHashIndex()
+        db["a"]["_index"]["_c"] = churrodb.GitObjectHashIndex(True)
+        db["a"]["d0"]["value"] = "changed"
+        db.save()
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        names = ["_index", "d0", "d1", "d2", "d3", "d4"]
+        self.assertEqual(names, sorted(db["a"]["_index"]["_b"]))
+        self.assertEqual(names, sorted(db["a"]["_index"]["_c"].values()))
+        for name in names[1:]:
+            self.assertEqual(
+                db.fs.hash("/a/{name}.churro".format(name=name)),
+                db["a"]["_index"]["_b"].idx_find_first(name))
+        tx.abort()
+
+    def test_index_tree_checkpoint(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["a"] = IndexedCollection()
+        db["a"].init_index()
+        db["a"]["_index"]["_a"] = churrodb.GitObjectHashIndex(True)
+        db["a"]["_index"]["_b"] = churrodb.GitObjectHashIndex()
+        for i in range(5):
+            db["a"]["d{i}".format(i=i)] = Dummy(str(i))
+        db.save()
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        index = db["a"]["_index"]["_b"]
+        tree = index.trees[""]
+        self.assertEqual(tree, db["a"]["_index"]["_a"].trees[""])
+        self.assertTrue(churrodb.git.is_oid(tree))
+
+        # nothing changed but the indexes, nothing to do
+        with unittest.mock.patch.object(churrodb.RebuildSet, "_read") as read:
+            db["a"].idx_rebuild()
+        read.assert_not_called()
+        self.assertEqual(tree, index.trees[""])
+        self.assertFalse(index._dirty)
+
+        # changes the indexes didn't see are found in the tree
+        db["a"]["d1"].value = "x"
+        del db["a"]["d2"]
+        db["a"].idx_rebuild()
+        self.assertNotEqual(tree, index.trees[""])
+        self.assertEqual(db.fs.hash("/a/d1.churro"), index["d1"])
+        self.assertEqual("d1", db["a"]["_index"]["_a"][index["d1"]])
+        self.assertTrue("d2" in index)
+        db.save()
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        index = db["a"]["_index"]["_b"]
+        # without the previous tree, the index is rebuilt
+        index.trees = {"": "0" * 40}
+        index["d3"] = "0" * 40
+        db["a"].idx_rebuild()
+        self.assertEqual(db.fs.hash("/a/d3.churro"), index["d3"])
+        tx.abort()
+
+    def test_index_git_object_hash_duplicate_key(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+
+        db["a"] = IndexedCollection()
+        db["a"].init_index()
+        db["a"]["_index"]["_a"] = churrodb.GitObjectHashIndex(True)
+        db["a"]["b"] = Dummy("c")
+        db["a"]["c"] = Dummy("c")
+
+        self.assertRaisesRegex(
+            churrodb.IndexUpdateError,
+            "duplicate key '46d49b1a588f3684e0dc9f5ea6426a60512fd89d' for values '[bc]' and '[bc]'",
+            lambda: db["a"].idx_rebuild())
+
+        tx.abort()
+
+    def test_index_git_object_hash_sharded(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+
+        db["a"] = IndexedCollection()
+        db["a"].init_index()
+        db["a"]["_index"]["_a"] = churrodb.ShardedGitObjectHashIndex(True, shard_digits=1)
+        db["a"]["_index"]["_b"] = churrodb.ShardedGitObjectHashIndex(shard_digits=1)
+        for i in range(50):
+            db["a"][str(i)] = Dummy(str(i))
+
+        db.save()
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        coll = db["a"]
+        index = coll["_index"]["_b"]
+
+        loaded = []
+        load = churro.PersistentFolder._load
+
+        def counting_load(folder, name, *args):
+            loaded.append(name)
+            return load(folder, name, *args)
+
+        with unittest.mock.patch.object(churro.PersistentFolder, "_load", counting_load):
+            self.assertEqual(index["7"], db.fs.hash("/a/7.churro"))
+        self.assertEqual([index.shard_name("7")], loaded)
+
+        self.assertEqual(coll.idx_find_first(index["7"]), "7")
+        self.assertEqual(51, len(index))
+        self.assertTrue(len(list(index.shards())) > 2)
+
+        coll["7"].value = "x"
+        db.save()
+
+        changed = subprocess.check_output(
+            ["git", "diff", "--name-only", "HEAD~1", "HEAD", "--", "a/_index/_b"],
+            cwd=self.churrodb_path).decode("utf-8").split()
+        # the shards of "7" and "_index", which changes with every commit
+        self.assertTrue(0 < len(changed) <= 2)
+        self.assertTrue("a/_index/_b/" + index.shard_name("7") + ".churro" in changed)
+
+        db = churrodb.ChurroDb(self.churrodb_path)
+        coll = db["a"]
+        self.assertEqual("7", coll.idx_find_first(db.fs.hash("/a/7.churro")))
+        self.assertEqual("x", coll[coll.idx_find_first(coll["_index"]["_b"]["7"])].value)
+
+    def test_index_field(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+
+        db["a"] = IndexedCollection()
+        db["a"].init_index()
+        db["a"]["_index"]["_status"] = churrodb.FieldIndex("status")
+        db["a"]["_index"]["_created"] = churrodb.SortedFieldIndex("meta.created")
+        db["a"]["_index"]["_created"].page_size = 4
+        for i in range(20):
+            db["a"]["d{i:02}".format(i=i)] = churro.PersistentDict({
+                "status": "open" if i % 3 else "closed",
+                "meta": {"created": "2016-01-{day:02}".format(day=i + 1)}})
+        db["a"]["e"] = Dummy("x")
+
+        db.save()
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        status = db["a"]["_index"]["_status"]
+        created = db["a"]["_index"]["_created"]
+
+        self.assertEqual(["d00", "d03", "d06", "d09", "d12", "d15", "d18"], status.idx_find("closed"))
+        self.assertEqual([], status.idx_find("missing"))
+        self.assertEqual(["d03"], created.idx_find("2016-01-04"))
+        self.assertEqual(
+            ["d04", "d05", "d06"],
+            created.idx_find(churrodb.Range("2016-01-05", "2016-01-07")))
+        self.assertEqual(
+            ["d04"],
+            created.idx_find(churrodb.Range("2016-01-04", "2016-01-06", low_inclusive=False, high_inclusive=False)))
+        self.assertEqual(
+            ["d17", "d18", "d19"],
+            created.idx_find(churrodb.Range(low="2016-01-18")))
+        self.assertEqual(
+            ["d09", "d10", "d11", "d12", "d13", "d14", "d15", "d16", "d17", "d18"],
+            created.idx_find(churrodb.Prefix("2016-01-1")))
+        self.assertEqual(["d00", "d03"], status.idx_find(churrodb.Range(high="closed", low="a"))[:2])
+        self.assertTrue(len(created.pages) > 1)
+
+        db["a"]["d03"]["status"] = "open"
+        db["a"]["d04"]["meta"] = {"created": "2015-12-31"}
+        del db["a"]["d05"]
+        db["a"]["f"] = churro.PersistentDict({"status": "closed"})
+
+        with unittest.mock.patch.object(churrodb, "_field_value", wraps=churrodb._field_value) as field_value:
+            db.save()
+        self.assertTrue(field_value.call_count < 20)
+
+        db = churrodb.ChurroDb(self.churrodb_path)
+        status = db["a"]["_index"]["_status"]
+        created = db["a"]["_index"]["_created"]
+
+        self.assertEqual(["d00", "d06", "d09", "d12", "d15", "d18", "f"], status.idx_find("closed"))
+        self.assertEqual(["d04", "d00"], created.idx_find(churrodb.Range(high="2016-01-01")))
+        self.assertEqual(["d06"], created.idx_find(churrodb.Range("2016-01-05", "2016-01-07")))
+
+        db["a"].idx_rebuild()
+        self.assertEqual(["d00", "d06", "d09", "d12", "d15", "d18", "f"], status.idx_find("closed"))
+        self.assertEqual(["d04", "d00"], created.idx_find(churrodb.Range(high="2016-01-01")))
+
+    def test_index_field_added_later(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["a"] = IndexedCollection()
+        db["a"].init_index()
+        db["a"]["_index"]["_status"] = churrodb.FieldIndex("status")
+        for i in range(6):
+            db["a"]["d{i}".format(i=i)] = churro.PersistentDict({
+                "status": "open" if i % 2 else "closed", "rank": i})
+        db.save()
+
+        # indexes added to a collection with documents index all of them
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["a"]["_index"]["_rank"] = churrodb.FieldIndex("rank")
+        db["a"]["_index"]["_sorted"] = churrodb.SortedFieldIndex("rank")
+        db["a"]["_index"]["_missing"] = churrodb.FieldIndex("missing")
+        db["a"]["d0"]["status"] = "open"
+        db.save()
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        self.assertEqual(["d3"], db["a"].idx_find(3, "_rank"))
+        self.assertEqual(
+            ["d2", "d3", "d4"], db["a"].idx_find(churrodb.Range(2, 4), "_sorted"))
+        self.assertEqual(
+            ["d1", "d2", "d3"], db["a"].query({"rank": churrodb.Range(1, 3)}))
+        self.assertEqual(["d0", "d1", "d3", "d5"], db["a"].idx_find("open", "_status"))
+
+        # a built index stays incremental, even if it's empty
+        db["a"]["d6"] = churro.PersistentDict({"missing": "found"})
+        with unittest.mock.patch.object(churrodb, "_field_value", wraps=churrodb._field_value) as field_value:
+            db.save()
+        self.assertTrue(field_value.call_count < 10)
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        self.assertEqual(["d6"], db["a"].idx_find("found", "_missing"))
+        tx.abort()
+
+    def test_index_rebuild_workers(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+
+        db["a"] = IndexedCollection()
+        db["a"].init_index()
+        db["a"]["_index"]["_hash"] = churrodb.GitObjectHashIndex(True)
+        db["a"]["_index"]["_name"] = churrodb.GitObjectHashIndex()
+        db["a"]["_index"]["_id"] = churrodb.GitDictKeyHashIndex(dict_key="id")
+        db["a"]["_index"]["_status"] = churrodb.FieldIndex("status")
+        db["a"]["_index"]["_created"] = churrodb.SortedFieldIndex("created")
+        for i in range(1200):
+            db["a"]["d{i:04}".format(i=i)] = churro.PersistentDict({
+                "id": "id-{i}".format(i=i), "status": "s{s}".format(s=i % 7), "created": i})
+        db["a"]["f"] = churro.PersistentFolder()
+
+        db.save()
+
+        def rebuilt(index_workers):
+            transaction.begin()
+            db = churrodb.ChurroDb(self.churrodb_path, index_workers=index_workers)
+            loaded = []
+            load = churro.PersistentFolder._load
+
+            def counting_load(folder, name, *args):
+                loaded.append(name)
+                return load(folder, name, *args)
+
+            with unittest.mock.patch.object(churro.PersistentFolder, "_load", counting_load):
+                db["a"].idx_rebuild()
+            indexes = db["a"]["_index"]
+            self.assertEqual(len(loaded), len(set(loaded)))
+            found = dict(
+                (name, sorted(indexes[name].items()))
+                for name in ["_hash", "_name", "_id", "_status"])
+            found["_created"] = indexes["_created"].pages
+            transaction.abort()
+            return found
+
+        serial = rebuilt(None)
+        self.assertEqual(1202, len(serial["_name"]))
+        self.assertEqual(serial, rebuilt(3))
+
+    def test_index_deferred(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, merge=True)
+        db["a"] = DeferredCollection()
+        db["a"].init_index()
+        db["a"]["_index"]["_status"] = churrodb.FieldIndex("status")
+        db["a"]["_index"]["_name"] = churrodb.GitObjectHashIndex()
+        for i in range(5):
+            db["a"]["d{i}".format(i=i)] = churro.PersistentDict({"status": "open"})
+        db.save()
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        self.assertEqual(5, db["a"].idx_lag())
+        self.assertEqual([], db["a"].idx_find("open", "_status"))
+        self.assertEqual(5, len(db["a"].idx_find("open", "_status", sync=True)))
+        tx.abort()
+
+        worker = churrodb.IndexWorker(self.churrodb_path)
+        self.assertEqual(1, worker.run_once())
+        self.assertEqual(0, worker.run_once())
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        self.assertEqual(0, db["a"].idx_lag())
+        self.assertEqual(0, len(db["a"]["_index_log"]))
+        self.assertEqual(5, len(db["a"].idx_find("open", "_status")))
+        self.assertEqual(db.fs.hash("/a/d0.churro"), db["a"].idx_find_first("d0", "_name"))
+        tx.abort()
+
+        # deferred indexes refuse saves which would conflict with the worker
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["a"]["d0"]["status"] = "closed"
+        self.assertRaises(Exception, db.save)
+
+        # a writer whose transaction overlaps the worker's commit merges it
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, merge=True)
+        db["a"]["d6"] = churro.PersistentDict({"status": "closed"})
+        db.save()
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, merge=True)
+        db["a"]["d0"]["status"] = "closed"
+        db["a"]["d5"] = churro.PersistentDict({"status": "open"})
+        applied = []
+        overlapping = threading.Thread(target=lambda: applied.append(worker.run_once()))
+        overlapping.start()
+        overlapping.join()
+        self.assertEqual([1], applied)
+        db.save()
+        self.assertEqual(1, worker.run_once())
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, merge=True)
+        self.assertEqual(["d0", "d6"], db["a"].idx_find("closed", "_status"))
+        self.assertEqual(["d1", "d2", "d3", "d4", "d5"], db["a"].idx_find("open", "_status"))
+        db["a"]["d0"]["status"] = "open"
+        del db["a"]["d5"]
+        del db["a"]["d6"]
+        db.save()
+        self.assertEqual(1, worker.run_once())
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, merge=True)
+        worker.interval = 60
+        worker.start()
+        try:
+            db["a"]["d1"]["status"] = "closed"
+            del db["a"]["d2"]
+            db.save()
+            self.assertTrue(worker.wait(30))
+        finally:
+            worker.stop()
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        self.assertEqual(0, db["a"].idx_lag())
+        self.assertEqual(["d0", "d3", "d4"], db["a"].idx_find("open", "_status"))
+        self.assertEqual(["d1"], db["a"].idx_find("closed", "_status"))
+
+        # only the children with a log are loaded
+        db["b"] = churro.PersistentFolder()
+        db.save()
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, lazy=True)
+        self.assertEqual([db["a"]], worker._collections(db))
+        self.assertEqual(["a"], list(db._data.loaded))
+        tx.abort()
+
+        # conflicts wait for the next round
+        with unittest.mock.patch.object(
+                worker, "run_once", side_effect=acidfs.ConflictError()) as run_once:
+            worker.start()
+            try:
+                time.sleep(0.2)
+            finally:
+                worker.stop()
+        self.assertEqual(1, run_once.call_count)
+
+    def test_bulk_load(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["a"] = IndexedCollection()
+        db["a"].init_index()
+        db["a"]["_index"]["_status"] = churrodb.FieldIndex("status")
+        db["a"]["_index"]["_name"] = churrodb.GitObjectHashIndex()
+        db["a"]["x"] = churro.PersistentDict({"status": "open", "i": 3})
+        db["a"]["f"] = churro.PersistentFolder()
+        db.save()
+
+        def commits():
+            return int(subprocess.check_output(
+                ["git", "rev-list", "--count", "HEAD"], cwd=self.churrodb_path))
+
+        before = commits()
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        documents = (
+            ("d{i:02}".format(i=i), churro.PersistentDict({"status": "open" if i % 2 else "closed", "i": i}))
+            for i in range(25))
+        self.assertEqual(25, db.bulk_load(documents, "a", batch_size=10))
+        self.assertEqual(before + 1, commits())
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        coll = db["a"]
+        self.assertEqual(27 + 1, len(coll))
+        self.assertEqual({"status": "open", "i": 3}, dict(coll["d03"].items()))
+        self.assertEqual(db.fs.hash("/a/x.churro"), db.fs.hash("/a/d03.churro"))
+        self.assertEqual(13, len(coll.idx_find("closed", "_status")))
+        self.assertEqual(["d03", "x"], [name for name in coll.idx_find("open", "_status") if name in ("d03", "x")])
+        self.assertEqual(db.fs.hash("/a/d24.churro"), coll.idx_find_first("d24", "_name"))
+
+        self.assertRaises(ValueError, db.bulk_load, [("f", churro.PersistentDict())], "a")
+        tx.abort()
+
+        # indexes of the ancestors are updated
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["c"] = IndexedCollection()
+        db["c"].init_index()
+        db["c"]["_index"]["_name"] = churrodb.GitObjectHashIndex()
+        db["c"]["_index"]["_inv"] = churrodb.GitObjectHashIndex(True)
+        db["c"]["a"] = churro.PersistentFolder()
+        db.save()
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db.bulk_load([("d0", churro.PersistentDict({"i": 0}))], "c/a")
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        oid = db.fs.hash("/c/a")
+        self.assertEqual(oid, db["c"].idx_find_first("a", "_name"))
+        self.assertEqual("a", db["c"].idx_find_first(oid, "_inv"))
+        self.assertEqual({"i": 0}, dict(db["c"]["a"]["d0"]))
+        tx.abort()
+
+    def test_snapshot(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["a"] = IndexedCollection()
+        db["a"].init_index()
+        db["a"]["_index"]["_name"] = churrodb.GitObjectHashIndex()
+        for i in range(20):
+            db["a"]["d{i:02}".format(i=i)] = churro.PersistentDict({"value": i})
+        db["b"] = Dummy("b")
+        db.save()
+
+        first = db.snapshot()
+        first_oid = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=self.churrodb_path).decode().strip()
+        self.assertEqual(first_oid, first.oid)
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, object_cache=first.object_cache)
+        db["a"]["d00"]["value"] = "changed"
+        del db["b"]
+        db.save()
+
+        second = db.snapshot()
+        self.assertEqual(0, first["a"]["d00"]["value"])
+        self.assertEqual("changed", second["a"]["d00"]["value"])
+        self.assertEqual("b", first["b"].value)
+        self.assertFalse("b" in second)
+        self.assertRaises(KeyError, lambda: second["b"])
+        self.assertEqual(["a", "b"], list(first))
+        self.assertEqual(21, len(first["a"]))
+        self.assertIs(first.resolve("a/d05"), second["a"]["d05"])
+        self.assertEqual(
+            db.fs.hash("/a/d07.churro"), second.resolve("/a/_index/_name").idx_find_first("d07"))
+        self.assertTrue("b" in churrodb.Snapshot(db.fs.db, first_oid, db.object_cache))
+        self.assertRaises(KeyError, churrodb.Snapshot, db.fs.db, "missing")
+
+        errors = []
+
+        def read():
+            try:
+                for i in range(20):
+                    values = [doc["value"] for name, doc in first["a"].items() if name != "_index"]
+                    if values != list(range(20)):
+                        errors.append(values)
+            except Exception as why:
+                errors.append(why)
+
+        readers = [threading.Thread(target=read) for i in range(4)]
+        for reader in readers:
+            reader.start()
+        for i in range(3):
+            tx = transaction.begin()
+            db = churrodb.ChurroDb(self.churrodb_path)
+            db["a"]["d01"]["value"] = i
+            db.save()
+        for reader in readers:
+            reader.join()
+        self.assertEqual([], errors)
+
+        # names are decoded with the db's path encoding
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, path_encoding="latin-1")
+        db["a"]["d\xe9"] = churro.PersistentDict({"value": "latin"})
+        db.save()
+        self.assertEqual("latin", db.snapshot()["a"]["d\xe9"]["value"])
+        shared = churrodb.ThreadedChurroDb(self.churrodb_path, path_encoding="latin-1")
+        self.assertTrue("d\xe9" in shared.snapshot()["a"])
+        self.assertTrue("d\xe9" in shared["a"])
+        transaction.abort()
+
+    def test_changes(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["a"] = churro.PersistentFolder()
+        for i in range(5):
+            db["a"]["d{i}".format(i=i)] = churro.PersistentDict({"value": i})
+        db["b"] = Dummy("b")
+        db.save()
+        first = db.snapshot().oid
+        self.assertEqual([], list(db.changes(first)))
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        old_d0 = db.fs.hash("/a/d0.churro")
+        db["a"]["d0"]["value"] = "changed"
+        del db["a"]["d1"]
+        db["a"]["c"] = churro.PersistentFolder()
+        db["a"]["c"]["x"] = churro.PersistentDict({"value": "x"})
+        del db["b"]
+        db.save()
+
+        changes = list(db.changes(first))
+        self.assertEqual([
+            ("added", "/a/c"),
+            ("added", "/a/c/x"),
+            ("modified", "/a/d0"),
+            ("removed", "/a/d1"),
+            ("removed", "/b")],
+            [(change.action, change.path) for change in changes])
+        modified = changes[2]
+        self.assertEqual(old_d0, modified.old_oid)
+        self.assertEqual(db.fs.hash("/a/d0.churro"), modified.new_oid)
+        self.assertEqual(0, modified.old["value"])
+        self.assertEqual("changed", modified.new["value"])
+        self.assertIsNone(changes[0].old)
+        self.assertIsNone(changes[3].new)
+        self.assertEqual("b", changes[4].old.value)
+
+        self.assertEqual(
+            ["/a/c", "/a/c/x"], [change.path for change in db.changes(first, path="a/c")])
+        self.assertEqual(
+            [("removed", "/a/c"), ("removed", "/a/c/x"),
+             ("modified", "/a/d0"), ("added", "/a/d1")],
+            [(change.action, change.path) for change in db.changes("HEAD", first, path="/a/")])
+        self.assertEqual([], list(db.changes(first, first)))
+        self.assertRaises(KeyError, lambda: list(db.changes("missing")))
+
+    def test_maintenance(self):
+        maintenance = churrodb.Maintenance(loose_objects=0, check_every=2, sample=10)
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, maintenance=maintenance)
+        db["a"] = churro.PersistentFolder()
+        for i in range(10):
+            db["a"]["d{i}".format(i=i)] = churro.PersistentDict({"value": i})
+        db.save()
+        self.assertEqual(0, maintenance.stats["checks"])
+        self.assertIsNone(maintenance.report)
+
+        tx = transaction.begin()
+        reader = churrodb.ChurroDb(self.churrodb_path)
+        self.assertEqual(0, reader["a"]["d0"]["value"])
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, maintenance=maintenance)
+        db["a"]["d0"]["value"] = "changed"
+        db.save()
+        self.assertEqual(1, maintenance.stats["checks"])
+        # the save doesn't wait for the maintenance
+        maintenance.join()
+        report = maintenance.report
+        self.assertEqual(["repack", "multi_pack_index", "commit_graph"], report["steps"])
+        self.assertEqual(0, report["before"]["packs"])
+        self.assertEqual(1, report["after"]["packs"])
+        self.assertLess(report["after"]["count"], report["before"]["count"])
+        self.assertGreater(report["after"]["latency"], 0)
+        self.assertTrue(os.path.exists(os.path.join(db.fs.db, "objects", "pack", "multi-pack-index")))
+
+        # the repository is still readable and writable by open dbs
+        self.assertEqual(1, reader["a"]["d1"]["value"])
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        self.assertEqual("changed", db["a"]["d0"]["value"])
+        db["a"]["d1"]["value"] = "changed"
+        db.save()
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        self.assertEqual("changed", db["a"]["d1"]["value"])
+
+        self.assertIsNone(churrodb.Maintenance(loose_objects=10 ** 6).run(db.fs.db))
+        report = db.maintain(force=True)
+        self.assertEqual("geometric_repack", report["steps"][0])
+        self.assertEqual(0, report["after"]["count"])
+        transaction.abort()
+
+        # saves return while the maintenance they started runs
+        running = threading.Event()
+        release = threading.Event()
+
+        def run(db, force=False, wait=True):
+            running.set()
+            release.wait(5)
+        with unittest.mock.patch.object(maintenance, "run", side_effect=run):
+            for value in range(2):
+                tx = transaction.begin()
+                db = churrodb.ChurroDb(self.churrodb_path, maintenance=maintenance)
+                db["a"]["d2"]["value"] = value
+                db.save()
+            self.assertTrue(running.wait(5))
+            release.set()
+            maintenance.join()
+
+    def test_threaded(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["a"] = churro.PersistentFolder()
+        db["a"]["d00"] = churro.PersistentDict({"value": 0})
+        for n in range(4):
+            # writers only add documents, acidfs can't merge concurrent
+            # changes to existing objects (such as indexes)
+            db["c{n}".format(n=n)] = churro.PersistentFolder()
+        db.save()
+
+        shared = churrodb.ThreadedChurroDb(self.churrodb_path)
+        views = {}
+        errors = []
+
+        def write(n):
+            collection = "c{n}".format(n=n)
+            try:
+                for i in range(5):
+                    transaction.begin()
+                    views.setdefault(n, set()).add(id(shared.local))
+                    self.assertIs(shared.local, shared.local)
+                    shared[collection]["d{i}".format(i=i)] = churro.PersistentDict({"value": i})
+                    shared.save()
+                    snapshot = shared.snapshot()
+                    self.assertEqual(0, snapshot["a"]["d00"]["value"])
+                    self.assertEqual(i, snapshot[collection]["d{i}".format(i=i)]["value"])
+            except Exception as why:
+                errors.append(why)
+
+        writers = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        self.assertEqual([], errors)
+        self.assertEqual(4, len(views))
+        self.assertTrue(all(len(ids) == 5 for ids in views.values()))
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        for n in range(4):
+            self.assertEqual(list(range(5)), [doc["value"] for doc in db["c{n}".format(n=n)].values()])
+        first = shared.snapshot()["a"]["d00"]
+        self.assertIs(first, shared.snapshot()["a"]["d00"])
+
+    def test_async(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["a"] = churro.PersistentFolder()
+        db["a"]["d00"] = churro.PersistentDict({"value": 0})
+        db.save()
+        oid = db.fs.hash("/a/d00.churro")
+        read = churrodb.git.Repository.read
+
+        async def run():
+            async with churrodb.AsyncChurroDb(self.churrodb_path) as adb:
+                with unittest.mock.patch.object(
+                        churrodb.git.Repository, "read", autospec=True, side_effect=read) as reads:
+                    found = await asyncio.gather(*[adb.object_by_hash(oid) for i in range(10)])
+                self.assertEqual(1, [call.args[1] for call in reads.call_args_list].count(oid))
+                self.assertTrue(all(obj is found[0] for obj in found))
+                self.assertEqual({}, adb._reading)
+                self.assertIs(found[0], await adb.object_by_hash(oid))
+
+                def add(db):
+                    db["a"]["d01"] = churro.PersistentDict({"value": 1})
+                await adb.transact(add)
+                folder = await adb.get("a")
+                self.assertIsInstance(folder, churrodb.SnapshotFolder)
+                self.assertEqual(1, (await adb.read(folder.__getitem__, "d01"))["value"])
+                self.assertFalse(hasattr(adb, "save"))
+
+                def fail(db):
+                    db["a"]["d02"] = churro.PersistentDict({"value": 2})
+                    raise ValueError()
+                with self.assertRaises(ValueError):
+                    await adb.transact(fail)
+
+                def change(db, value):
+                    db["a"]["d00"]["value"] = value
+                    return db["a"]["d00"]["value"]
+                self.assertEqual("changed", await adb.transact(change, "changed"))
+
+                snapshot = await adb.snapshot()
+                self.assertEqual(1, (await adb.read(snapshot.resolve, "a/d01"))["value"])
+                self.assertEqual("changed", (await adb.read(snapshot.resolve, "a/d00"))["value"])
+                self.assertFalse("d02" in await adb.read(snapshot.resolve, "a"))
+
+                # writes and reads after switching go to the branch
+                subprocess.check_call(["git", "branch", "other"], cwd=adb.db.git_dir)
+                await adb.switch("other")
+
+                def branched(db):
+                    db["a"]["d03"] = churro.PersistentDict({"value": 3})
+                await adb.transact(branched)
+                await adb.transact(change, "branched")
+                other = await adb.get("a")
+                self.assertEqual(3, (await adb.read(other.__getitem__, "d03"))["value"])
+                self.assertEqual("branched", (await adb.read(other.__getitem__, "d00"))["value"])
+                master = await adb.get("a", commit="master")
+                self.assertFalse("d03" in await adb.read(lambda: list(master)))
+                self.assertEqual("changed", (await adb.read(master.__getitem__, "d00"))["value"])
+                self.assertEqual(0, found[0]["value"])
+                self.assertIsNone(await adb.get("missing"))
+
+        asyncio.run(run())
+
+    @unittest.mock.patch("churrodb.unique_branch_name")
+    def test_merge(self, unique_branch_name):
+        unique_branch_name.return_value = "conflict"
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["a"] = IndexedCollection()
+        db["a"].init_index()
+        db["a"]["_index"]["_name"] = churrodb.GitObjectHashIndex()
+        db["a"]["_index"]["_inv"] = churrodb.GitObjectHashIndex(True)
+        db["a"]["_index"]["_shards"] = churrodb.ShardedGitObjectHashIndex(True, shard_digits=1)
+        db["a"]["_index"]["_id"] = churrodb.GitDictKeyHashIndex(dict_key="id")
+        db["a"]["_index"]["_status"] = churrodb.FieldIndex("status")
+        db["a"]["_index"]["_rank"] = churrodb.SortedFieldIndex("rank")
+        db["a"]["d00"] = churro.PersistentDict({
+            "title": "x", "count": 0, "id": "i00", "status": "open", "rank": 0})
+        db.save()
+
+        def concurrently(first, second):
+            # first begins, second commits in between, then first commits
+            changed = threading.Event()
+            committed = threading.Event()
+            results = {}
+
+            def run(name, change, wait, done):
+                transaction.begin()
+                db = results[name] = churrodb.ChurroDb(self.churrodb_path, merge=True)
+                change(db)
+                wait and wait.wait()
+                try:
+                    db.save()
+                except Exception as why:
+                    results[name + "_error"] = why
+                done.set()
+
+            threads = [
+                threading.Thread(target=run, args=("first", first, committed, threading.Event())),
+                threading.Thread(target=run, args=("second", second, changed, committed))]
+            threads[0].start()
+            changed.set()
+            threads[1].start()
+            for thread in threads:
+                thread.join()
+            return results
+
+        def first(db):
+            db["a"]["d00"]["title"] = "y"
+            db["a"]["d00"]["status"] = "closed"
+            db["a"]["d01"] = churro.PersistentDict({
+                "title": "first", "id": "i01", "status": "open", "rank": 1})
+
+        def second(db):
+            db["a"]["d00"]["count"] = 1
+            db["a"]["d00"]["rank"] = 3
+            db["a"]["d02"] = churro.PersistentDict({
+                "title": "second", "id": "i02", "status": "open", "rank": 2})
+
+        results = concurrently(first, second)
+        self.assertEqual([], [results[k] for k in results if k.endswith("_error")])
+        self.assertEqual(1, results["first"].merge_stats["merges"])
+        # d00 and the indexes
+        self.assertEqual(7, results["first"].merge_stats["documents"])
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        self.assertEqual(
+            {"title": "y", "count": 1, "id": "i00", "status": "closed", "rank": 3},
+            dict(db["a"]["d00"]))
+        for name in ["d00", "d01", "d02"]:
+            oid = db.fs.hash("/a/{name}.churro".format(name=name))
+            self.assertEqual(oid, db["a"]["_index"]["_name"].idx_find_first(name))
+            self.assertEqual(name, db["a"]["_index"]["_inv"].idx_find_first(oid))
+            self.assertEqual(name, db["a"]["_index"]["_shards"].idx_find_first(oid))
+            self.assertEqual(
+                oid, db["a"]["_index"]["_id"].idx_find_first(db["a"][name]["id"]))
+        # the oids d00 had before and after the merge, not those of either side
+        for index in ["_inv", "_shards"]:
+            self.assertEqual(
+                2, list(db["a"]["_index"][index].values()).count("d00"))
+        self.assertEqual(["d00"], db["a"].idx_find("closed", "_status"))
+        self.assertEqual(["d01", "d02"], db["a"].idx_find("open", "_status"))
+        self.assertEqual(
+            ["d01", "d02", "d00"], db["a"].idx_find(churrodb.Range(1, 3), "_rank"))
+        self.assertEqual([], db["a"].idx_find(0, "_rank"))
+        parents = subprocess.check_output(
+            ["git", "log", "-1", "--format=%P"], cwd=self.churrodb_path).split()
+        self.assertEqual(1, len(parents))
+
+        def title(value):
+            def change(db):
+                db["a"]["d00"]["title"] = value
+            return change
+
+        results = concurrently(title("z"), title("w"))
+        self.assertIsInstance(results["first_error"], acidfs.ConflictError)
+        self.assertEqual(1, results["first"].merge_stats["conflicts"])
+        branches = subprocess.check_output(["git", "branch"], cwd=self.churrodb_path).decode()
+        self.assertTrue("conflict" in branches)
+
+        self.assertEqual({"a": 1, "b": {"c": 2, "d": 2}}, churrodb._merge_json(
+            {"a": 0, "b": {"c": 0}}, {"a": 1, "b": {"c": 2}}, {"a": 0, "b": {"c": 0, "d": 2}}))
+        self.assertEqual({}, churrodb._merge_json({"a": 0}, {}, {"a": 0}))
+        self.assertRaises(acidfs.ConflictError, churrodb._merge_json, [0], [1], [2])
+
+    @unittest.mock.patch("churrodb.unique_branch_name")
+    def test_group_commit(self, unique_branch_name):
+        unique_branch_name.return_value = "conflict"
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["a"] = IndexedCollection()
+        db["a"].init_index()
+        db["a"]["_index"]["_name"] = churrodb.GitObjectHashIndex()
+        db["a"]["_index"]["_inv"] = churrodb.GitObjectHashIndex(True)
+        db["a"]["_index"]["_shards"] = churrodb.ShardedGitObjectHashIndex(True, shard_digits=1)
+        db["a"]["_index"]["_status"] = churrodb.FieldIndex("status")
+        db["a"]["_index"]["_rank"] = churrodb.SortedFieldIndex("rank")
+        db["a"]["d00"] = churro.PersistentDict({"title": "x", "status": "closed", "rank": 0})
+        db.save()
+
+        def commits():
+            return int(subprocess.check_output(
+                ["git", "rev-list", "--count", "HEAD"], cwd=self.churrodb_path))
+
+        group = churrodb.GroupCommit(window=5, size=4)
+        shared = churrodb.ThreadedChurroDb(self.churrodb_path, group_commit=group)
+
+        def save_all(changes):
+            errors = {}
+
+            def save(n, change):
+                transaction.begin()
+                change(shared.local)
+                try:
+                    shared.save()
+                except Exception as why:
+                    errors[n] = why
+
+            threads = [threading.Thread(target=save, args=item) for item in enumerate(changes)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return errors
+
+        def add(name):
+            def change(db):
+                db["a"][name] = churro.PersistentDict({
+                    "title": name, "status": "open", "rank": int(name[1:])})
+            return change
+
+        before = commits()
+        self.assertEqual({}, save_all([add("d{i}".format(i=i)) for i in range(1, 5)]))
+        self.assertEqual(before + 1, commits())
+        self.assertEqual(1, group.stats["groups"])
+        self.assertEqual(4, group.stats["saves"])
+        # the five indexes of "a" were updated once, for all four saves
+        self.assertEqual(5, group.stats["indexes"])
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        for name in ["d00", "d1", "d2", "d3", "d4"]:
+            oid = db.fs.hash("/a/{name}.churro".format(name=name))
+            self.assertEqual(oid, db["a"]["_index"]["_name"].idx_find_first(name))
+            self.assertEqual(name, db["a"]["_index"]["_inv"].idx_find_first(oid))
+            self.assertEqual(name, db["a"]["_index"]["_shards"].idx_find_first(oid))
+        self.assertEqual(["d1", "d2", "d3", "d4"], db["a"].idx_find("open", "_status"))
+        self.assertEqual(
+            ["d00", "d1", "d2", "d3", "d4"], db["a"].idx_find(churrodb.Range(0, 4), "_rank"))
+
+        def title(value):
+            def change(db):
+                db["a"]["d00"]["title"] = value
+            return change
+
+        group.size = 3
+        errors = save_all([title("y"), title("z"), add("d5")])
+        self.assertEqual(1, len(errors))
+        self.assertIsInstance(list(errors.values())[0], acidfs.ConflictError)
+        self.assertEqual(1, group.stats["conflicts"])
+        self.assertEqual(10, group.stats["indexes"])
+        self.assertEqual(before + 2, commits())
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        self.assertTrue("d5" in db["a"])
+        self.assertTrue(db["a"]["d00"]["title"] in ["y", "z"])
+        self.assertEqual(["d5"], db["a"].idx_find(5, "_rank"))
+        self.assertEqual(
+            "d00", db["a"]["_index"]["_inv"].idx_find_first(db.fs.hash("/a/d00.churro")))
+
+    def test_query(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+
+        db["a"] = IndexedCollection()
+        db["a"].init_index()
+        db["a"]["_index"]["_status"] = churrodb.FieldIndex("status")
+        db["a"]["_index"]["_created"] = churrodb.SortedFieldIndex("created")
+        for i in range(30):
+            db["a"]["d{i:02}".format(i=i)] = churro.PersistentDict({
+                "status": "open" if i % 10 else "closed",
+                "kind": "even" if i % 2 == 0 else "odd",
+                "created": i})
+
+        db.save()
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        coll = db["a"]
+
+        conditions = {"status": "open", "created": churrodb.Range(4, 6), "kind": "even"}
+        plan = coll.explain(conditions)
+        self.assertEqual(
+            "lookup created Range(4, 6) using index _created (SortedFieldIndex), ~3 documents\n"
+            "intersect status 'open' using index _status (FieldIndex), ~27 documents\n"
+            "filter kind 'even'",
+            str(plan))
+        self.assertEqual(["d04", "d06"], coll.query(conditions))
+
+        plan = coll.explain({"status": "closed", "created": churrodb.Range(low=5)})
+        self.assertEqual("_status", plan.lookups[0][2])
+        self.assertEqual(["d10", "d20"], plan.execute())
+
+        plan = coll.explain({"kind": "odd", "created": churrodb.Range(high=3, high_inclusive=False)})
+        self.assertEqual(["d01"], plan.execute())
+
+        plan = coll.explain([("kind", "odd"), ("title", churrodb.Prefix("x"))])
+        self.assertEqual("scan all documents", str(plan).split("\n")[0])
+        self.assertEqual([], plan.execute())
+        self.assertEqual(15, len(coll.query({"kind": "odd"})))
+
+        # scans don't keep the documents they read
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        coll = db["a"]
+        self.assertEqual(15, len(coll.query({"kind": "odd"})))
+        self.assertEqual(
+            ["_index"], [name for name, (type, obj) in coll._contents.items() if obj is not None])
+        self.assertEqual(30, len(coll.query({})))
+
+    def test_query_equality(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["a"] = IndexedCollection()
+        db["a"].init_index()
+        db["a"]["_index"]["_field"] = churrodb.FieldIndex("n")
+        db["a"]["_index"]["_sorted"] = churrodb.SortedFieldIndex("n")
+        values = {
+            "int": 1, "float": 1.0, "true": True, "zero": 0, "false": False,
+            "none": None, "list": [1], "floats": [1.0], "text": "1"}
+        for name, value in values.items():
+            db["a"][name] = churro.PersistentDict({"n": value})
+        db.save()
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        coll = db["a"]
+        # pairs, 1, 1.0 and True are one key of a dict
+        expected = [
+            (1, ["float", "int"]), (1.0, ["float", "int"]), (True, ["true"]),
+            (0, ["zero"]), (False, ["false"]), (None, ["none"]), ("1", ["text"])]
+        for condition, names in expected:
+            for name in ["_field", "_sorted"]:
+                self.assertEqual(names, coll.idx[name].idx_find(condition), (condition, name))
+            scan = churrodb.QueryPlan(coll, {"n": condition}, [])
+            self.assertEqual(names, scan.execute(), condition)
+        for condition in ([1], [1.0]):
+            for name in ["_field", "_sorted"]:
+                self.assertEqual(["floats", "list"], coll.idx[name].idx_find(condition))
+            self.assertEqual(
+                ["floats", "list"], churrodb.QueryPlan(coll, {"n": condition}, []).execute())
+        self.assertEqual(["float", "int"], coll.query({"n": 1.0}))
+        tx.abort()
+
     def test_index_root_factory(self):
         tx = transaction.begin()
 
@@ -662,6 +1929,126 @@ class ChurroDbTests(unittest.TestCase):
             "__churro_class__": "churrodb.tests.Dummy"
         }, read_json(a_path))
 
+    def test_git_batch_reads(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        db["a"] = churro.PersistentFolder()
+        for i in range(20):
+            db["a"][str(i)] = Dummy(str(i))
+        db.save()
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path)
+        oid = db.fs.hash("/a/1.churro")
+        self.assertEqual("1", db.object_by_hash(oid).value)
+
+        with unittest.mock.patch("subprocess.Popen", wraps=subprocess.Popen) as popen:
+            values = sorted(value.value for key, value in db["a"].items())
+            self.assertEqual("1", db.object_by_hash(oid).value)
+
+        self.assertListEqual(sorted(str(i) for i in range(20)), values)
+        self.assertEqual(0, popen.call_count)
+        self.assertListEqual(
+            [oid, None],
+            churrodb.git.repository(db.fs.db).oids(["HEAD:a/1.churro", "HEAD:a/x.churro"]))
+
+        tx.abort()
+
+    def test_object_by_hash_cache(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, object_cache=churrodb.ObjectCache(2))
+        db["a"] = Dummy("a")
+        db["b"] = Dummy("b")
+        db["c"] = Dummy("c")
+        db.save()
+
+        oids = [db.fs.hash(name + ".churro") for name in ["a", "b", "c"]]
+
+        self.assertEqual("a", db.object_by_hash(oids[0]).value)
+        self.assertIs(db.object_by_hash(oids[0]), db.object_by_hash(oids[0]))
+        db.object_by_hash(oids[1])
+        db.object_by_hash(oids[2])
+
+        self.assertDictEqual(
+            {"size": 2, "maxsize": 2, "hits": 2, "misses": 3, "evictions": 1},
+            db.object_cache.stats())
+        self.assertFalse(oids[0] in db.object_cache)
+
+        # objects referring to their db are cached per db
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, object_cache=db.object_cache)
+        db["i"] = churrodb.GitObjectHashIndex()
+        db.save()
+        tx = transaction.begin()
+        oid = db.fs.hash("i.churro")
+        other = churrodb.ChurroDb(self.churrodb_path, object_cache=db.object_cache)
+        db.object_cache.hits = db.object_cache.misses = 0
+        index = db.object_by_hash(oid)
+        self.assertIs(db, index.churrodb)
+        self.assertIs(index, db.object_by_hash(oid))
+        self.assertIs(other, other.object_by_hash(oid).churrodb)
+        self.assertIs(db, index.churrodb)
+        self.assertIs(
+            db.object_by_hash(oids[2]), other.object_by_hash(oids[2]))
+        # one lookup each, the blob of the index is read once
+        self.assertEqual((4, 1), (db.object_cache.hits, db.object_cache.misses))
+        self.assertEqual("GitObjectHashIndex", type(
+            churrodb.Snapshot(db.fs.db, "HEAD", db.object_cache)["i"]).__name__)
+        tx.abort()
+
+        # the cache doesn't keep dbs alive
+        cache = churrodb.ObjectCache()
+        transaction.begin()
+        other = churrodb.ChurroDb(self.churrodb_path, object_cache=cache)
+        self.assertIs(other, other.object_by_hash(oid).churrodb)
+        transaction.abort()
+        other = weakref.ref(other)
+        gc.collect()
+        self.assertIsNone(other())
+
+    def test_git_object_database(self):
+        db = churrodb.ChurroDb(self.churrodb_path)
+        for i in range(5):
+            db["a"] = churro.PersistentDict({"values": list(range(100 + i))})
+            db.save()
+            db = churrodb.ChurroDb(self.churrodb_path)
+
+        subprocess.check_call(
+            ["git", "repack", "-q", "-a", "-d", "-f", "--window=10"], cwd=self.churrodb_path)
+        db["b"] = churro.Persistent()
+        db.save()
+
+        git_dir = os.path.join(self.churrodb_path, ".git")
+        listed = subprocess.check_output(
+            ["git", "cat-file", "--batch-all-objects", "--batch-check=%(objectname) %(objecttype)"],
+            cwd=self.churrodb_path).decode().split("\n")
+        objects = churrodb.git.ObjectDatabase(git_dir)
+
+        for line in filter(None, listed):
+            oid, type = line.split()
+            expected = subprocess.check_output(["git", "cat-file", type, oid], cwd=self.churrodb_path)
+            self.assertEqual((type, expected), objects.read(oid))
+
+        objects.close()
+
+    def test_git_blob_writer(self):
+        db = churrodb.ChurroDb(self.churrodb_path)
+        git_dir = os.path.join(self.churrodb_path, ".git")
+        blobs = [json.dumps({"values": list(range(i))}).encode("utf-8") for i in range(300)]
+
+        with churrodb.git.BlobWriter(git_dir) as writer:
+            oids = writer.write_many(blobs[:100]) + writer.write_many(blobs[100:])
+
+        expected = subprocess.check_output(
+            ["git", "hash-object", "--stdin"], cwd=self.churrodb_path, input=blobs[7])
+        self.assertEqual(expected.decode().strip(), oids[7])
+
+        # similar blobs written in a row are stored as a chain of deltas
+        objects = churrodb.git.ObjectDatabase(git_dir)
+        self.assertEqual([("blob", blob) for blob in blobs], [objects.read(oid) for oid in oids])
+        objects.close()
+        transaction.abort()
+
     def test_git_object_proxy(self):
         a = {"b": "c", "d": {"e": {"f": "g"}}}
         x = churrodb.GitObjectProxy(a)
@@ -762,6 +2149,106 @@ class ChurroDbTests(unittest.TestCase):
         self.assertEqual("e", db[db.idx_find("c6326067e195c781848cdca50797407bdbc6faeb")[0]].value)
         self.assertEqual("f", db["coll"][db.idx_find("3534c705a203d4ef38e2e4d1b6b6d2a63dd3866d")[0]].value)
 
+    def test_index_git_index_namespaces(self):
+        tx = transaction.begin()
+
+        db = churrodb.ChurroDb(self.churrodb_path, factory=TestRootFactory)
+        db.init_index()
+
+        db["_index"]["_git"] = churrodb.GitObjectHashIndex(name="root_git")
+        for name in ["c1", "c2"]:
+            db[name] = GitIndexedCollection(idx_name=name, idx_supply="root_git")
+            db[name].init_index()
+        db["a"] = Dummy("a")
+        db["c1"]["x"] = Dummy("x")
+        db["c1"]["y"] = Dummy("y1")
+        db["c2"]["y"] = Dummy("y2")
+        db["c2"]["z"] = Dummy("z")
+
+        db.save()
+
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, factory=TestRootFactory)
+        index = db.named_index("root_git")
+
+        self.assertEqual({"x": "c1", "y": "c1", "z": "c2"}, dict(index.namespace_keys))
+        self.assertIs(index.auxiliary["c2"], index.by_name("c2"))
+
+        with unittest.mock.patch.object(index, "_scan_auxiliary") as scan:
+            self.assertEqual(db.fs.hash("/c2/z.churro"), db.idx_find_first("z"))
+            self.assertEqual(db.fs.hash("/c1/y.churro"), db.idx_find_first("y"))
+            self.assertEqual([], db.idx_find("missing"))
+            self.assertEqual({
+                "a": db.fs.hash("/a.churro"),
+                "x": db.fs.hash("/c1/x.churro"),
+                "y": db.fs.hash("/c1/y.churro"),
+                "z": db.fs.hash("/c2/z.churro"),
+            }, db.idx_find_many(["a", "x", "y", "z", "missing"]))
+        self.assertFalse(scan.called)
+
+        # indexes written before namespace_keys existed get it on their
+        # next update, lookups don't write it
+        index.namespace_keys = None
+        db.save()
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, factory=TestRootFactory)
+        index = db.named_index("root_git")
+        self.assertIsNone(index.namespace_keys)
+        self.assertEqual(db.fs.hash("/c2/z.churro"), db.idx_find_first("z"))
+        self.assertIsNone(index.namespace_keys)
+        db["c2"]["w"] = Dummy("w")
+        db.save()
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, factory=TestRootFactory)
+        self.assertEqual(
+            {"w": "c2", "x": "c1", "y": "c1", "z": "c2"},
+            dict(db.named_index("root_git").namespace_keys))
+        tx.abort()
+
+    def test_index_git_index_namespace_ranks(self):
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, factory=TestRootFactory)
+        db.init_index()
+        db["_index"]["_git"] = churrodb.GitObjectHashIndex(name="root_git")
+        db["c2"] = GitIndexedCollection(idx_name="c2", idx_supply="root_git")
+        db["c2"].init_index()
+        db["c2"]["y"] = Dummy("y2")
+        db.save()
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, factory=TestRootFactory)
+        db["c1"] = GitIndexedCollection(idx_name="c1", idx_supply="root_git")
+        db["c1"].init_index()
+        db["c1"]["x"] = Dummy("x")
+        db["c1"]["y"] = Dummy("y1")
+        db.save()
+
+        # "c2" was created first, whatever order the namespaces reload in
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, factory=TestRootFactory)
+        db["c1"]["y"] = Dummy("y1 changed")
+        db.save()
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, factory=TestRootFactory)
+        index = db.named_index("root_git")
+        self.assertEqual({"x": "c1", "y": "c2"}, dict(index.namespace_keys))
+        self.assertEqual(db.fs.hash("/c2/y.churro"), db.idx_find_first("y"))
+
+        # keys a rebuild removes from a namespace are mapped to the next
+        # namespace holding them, or dropped
+        index.clear_before_update = True
+        del db["c2"]["y"]
+        del db["c1"]["x"]
+        db.save()
+        tx = transaction.begin()
+        db = churrodb.ChurroDb(self.churrodb_path, factory=TestRootFactory)
+        index = db.named_index("root_git")
+        self.assertEqual({"y": "c1"}, dict(index.namespace_keys))
+        with unittest.mock.patch.object(index, "_scan_auxiliary") as scan:
+            self.assertEqual(db.fs.hash("/c1/y.churro"), db.idx_find_first("y"))
+            self.assertEqual([], db.idx_find("x"))
+        self.assertFalse(scan.called)
+        tx.abort()
+
     def test_index_git_dict_key_hash_index(self):
         tx = transaction.begin()
         db = churrodb.ChurroDb(self.churrodb_path, factory=TestRootFactory)